@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Replay benchmark for the bot's download pipeline.
+
+Runs the real MEGA and ffsend backends (and the wget progress path) against the
+stub executables in bench/stubs/bin (MEGA_TRANSFER_MODE picks the MEGA backend),
+and the native Send client ("send") against the stand-in server in bench/stubs, with a fake Discord message standing in for
+the REST API, and reports CPU time, event-loop lag, embed edits per minute and
+raw ProgressParser throughput. Nothing touches Discord or the network; all files
+go to a temporary STORAGE_ROOT.
+
+Usage:
+    python bench/run_bench.py [--tools mega-get,ffsend,send,wget] [--downloads 3]
+                              [--size 200M] [--rate 20M] [--edit-latency 0.15]
+                              [--json report.json] [--verbose]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+STUB_BIN = os.path.join(BENCH_DIR, "stubs", "bin")
+
+URLS = {
+    "mega-get": "https://mega.nz/file/bench{n}#key",
+    "ffsend": "https://send.vis.ee/download/bench{n}/#secret",
+    "wget": "https://example.com/bench{n}.bin",
+}
+SEND_ORIGIN = None  # the stand-in Send server, once started
+
+def tool_url(tool: str, n: int) -> str:
+    if tool == "send":
+        import send_server
+        return send_server.link(SEND_ORIGIN, f"bench{n}")
+    return URLS[tool].format(n=n)
+
+def start_send_server():
+    """Run the stand-in Send server in its own process so its encryption isn't billed to the bot"""
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "stubs", "send_server.py")], stdout=subprocess.PIPE, text=True
+    )
+    line = process.stdout.readline()
+    if not line.startswith("PORT "):
+        process.kill()
+        raise RuntimeError("stand-in Send server failed to start")
+    return process, f"http://127.0.0.1:{line.split()[1]}"
+
+def parse_size(text: str) -> int:
+    """'200M' / '1.5G' / '4096' -> bytes"""
+    text = text.strip().upper().rstrip("B").rstrip("I")
+    scale = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}.get(text[-1:], 1)
+    return int(float(text.rstrip("KMG")) * scale)
+
+class FakeAuthor:
+    id = 0
+
+class FakeMessage:
+    """Just enough of discord.Message for the renderer: edit() sleeps like a REST round trip"""
+    def __init__(self, latency: float):
+        self.id = 0
+        self.author = FakeAuthor()
+        self.latency = latency
+        self.edits = []
+
+    async def edit(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.edits.append(time.monotonic())
+
+def _cpu_seconds(who) -> float:
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+async def run_tool(bot, tool: str, downloads: int, latency: float) -> dict:
+    """Run `downloads` concurrent transfers of one tool and measure the bot process"""
+    monitor = bot.LoopLagMonitor(interval=0.02)
+    monitor.start()
+    managers = []
+    for n in range(downloads):
+        manager = bot.DownloadManager(FakeMessage(latency), tool_url(tool, n))
+        manager.download_start_time = time.time()
+        managers.append(manager)
+
+    async def run_one(manager):
+        if tool == "mega-get":
+            await manager._download_with_mega()
+        elif tool == "ffsend":
+            await manager._download_with_ffsend_binary()
+        elif tool == "send":
+            await manager._download_with_send_client()
+        else:
+            # No wget backend: drive its output through the same progress path
+            process = await asyncio.create_subprocess_exec(
+                "wget", manager.url, "-P", manager.temp_dir,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+            )
+            if await manager._follow_progress(process, "wget") != 0:
+                raise Exception("wget stub failed")
+        await manager.renderer.flush()
+        manager.renderer.close()
+
+    polls_before = bot.mega_transfers.polls
+    cpu_before = _cpu_seconds(resource.RUSAGE_SELF)
+    children_before = _cpu_seconds(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+    await asyncio.gather(*(run_one(manager) for manager in managers))
+    wall = time.monotonic() - start
+    cpu = _cpu_seconds(resource.RUSAGE_SELF) - cpu_before
+    monitor.stop()
+
+    edits = sum(manager.renderer.edit_count for manager in managers)
+    skipped = sum(manager.renderer.skipped_count for manager in managers)
+    return {
+        "tool": tool,
+        "downloads": downloads,
+        "wall_s": round(wall, 3),
+        "bot_cpu_s": round(cpu, 3),
+        "bot_cpu_pct": round(cpu * 100 / wall, 2) if wall else 0,
+        "stub_cpu_s": round(_cpu_seconds(resource.RUSAGE_CHILDREN) - children_before, 3),
+        "loop_lag_max_ms": round(monitor.max_lag * 1000, 1),
+        "loop_stalls": monitor.stalls,
+        "embed_edits": edits,
+        "embed_edits_skipped": skipped,
+        "edits_per_min_per_download": round(edits * 60 / wall / downloads, 1) if wall else 0,
+        "mega_transfers_calls": bot.mega_transfers.polls - polls_before,
+        "final_progress": [round(manager.progress, 2) for manager in managers],
+    }
+
+def parser_throughput(bot, replay_tool, tool: str, size: int, steps: int = 20000, chunk: int = 4096) -> dict:
+    """Feed a synthetic progress stream through ProgressParser in tool-sized reads"""
+    data = replay_tool.progress_stream(tool, size, steps).encode()
+    parser = bot.ProgressParser(tool)
+    events = 0
+    start = time.perf_counter()
+    for offset in range(0, len(data), chunk):
+        if parser.feed(data[offset:offset + chunk]):
+            events += 1
+    parser.flush()
+    elapsed = time.perf_counter() - start
+    return {
+        "tool": tool,
+        "bytes": len(data),
+        "lines": steps,
+        "events": events,
+        "mb_per_s": round(len(data) / elapsed / (1024 * 1024), 1),
+        "lines_per_s": round(steps / elapsed),
+        "last_percent": round(parser.last_event.percent, 2) if parser.last_event else None,
+    }
+
+def print_report(report: dict):
+    print(f"\nReplay benchmark ({report['size']} bytes per download at {report['rate']} B/s, "
+          f"edit latency {report['edit_latency']}s)\n")
+    header = f"{'tool':<9} {'dl':>3} {'wall s':>8} {'cpu s':>7} {'cpu %':>6} {'lag max ms':>10} {'stalls':>6} {'edits':>6} {'edits/min/dl':>12}"
+    print(header)
+    print("-" * len(header))
+    for row in report["runs"]:
+        print(f"{row['tool']:<9} {row['downloads']:>3} {row['wall_s']:>8} {row['bot_cpu_s']:>7} {row['bot_cpu_pct']:>6} "
+              f"{row['loop_lag_max_ms']:>10} {row['loop_stalls']:>6} {row['embed_edits']:>6} {row['edits_per_min_per_download']:>12}")
+    print(f"\n{'parser':<9} {'MB/s':>8} {'lines/s':>10} {'events':>7}")
+    for row in report["parser"]:
+        print(f"{row['tool']:<9} {row['mb_per_s']:>8} {row['lines_per_s']:>10} {row['events']:>7}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tools", default="mega-get,ffsend,send,wget")
+    parser.add_argument("--downloads", type=int, default=3, help="concurrent downloads per tool")
+    parser.add_argument("--size", default="200M", help="bytes per download (K/M/G suffixes)")
+    parser.add_argument("--rate", default="20M", help="bytes per second per download")
+    parser.add_argument("--update-hz", type=float, default=10, help="progress redraws per second from each stub")
+    parser.add_argument("--edit-latency", type=float, default=0.15, help="simulated Discord edit round trip in seconds")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own output")
+    args = parser.parse_args()
+
+    global SEND_ORIGIN
+    size, rate = parse_size(args.size), parse_size(args.rate)
+    tools = [tool.strip() for tool in args.tools.split(",") if tool.strip()]
+    storage_root = tempfile.mkdtemp(prefix="zurg-bench-")
+    os.environ.update({
+        "DISCORD_TOKEN": "bench",
+        "DOWNLOAD_CHANNEL_ID": "0",
+        "GUILD_ID": "0",
+        "STORAGE_ROOT": storage_root,
+        "BENCH_STATE_DIR": os.path.join(storage_root, "megacmd"),
+        "PATH": STUB_BIN + os.pathsep + os.environ.get("PATH", ""),
+        "PYTHON": sys.executable,
+        "BENCH_SIZE": str(size),
+        "BENCH_RATE": str(rate),
+        "BENCH_UPDATE_HZ": str(args.update_hz),
+    })
+    sys.path[:0] = [REPO_DIR, os.path.join(BENCH_DIR, "stubs")]
+    send_process = None
+    if "send" in tools:
+        try:
+            send_process, SEND_ORIGIN = start_send_server()
+            os.environ["SEND_HOSTS"] = urlparse(SEND_ORIGIN).netloc
+        except RuntimeError as e:
+            print(f"Skipping send: {e} (is cryptography installed?)")
+            tools.remove("send")
+    import bot
+    import replay_tool
+
+    report = {"size": size, "rate": rate, "edit_latency": args.edit_latency, "runs": [], "parser": []}
+    try:
+        for tool in tools:
+            output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+            with output:
+                report["runs"].append(asyncio.run(run_tool(bot, tool, args.downloads, args.edit_latency)))
+        for tool in tools:
+            if tool not in bot.PROGRESS_GRAMMARS:
+                continue
+            report["parser"].append(parser_throughput(bot, replay_tool, tool, size))
+    finally:
+        if send_process:
+            send_process.kill()
+        shutil.rmtree(storage_root, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Stand-in for mega-get, ffsend and wget that replays their progress output
+(the formats documented in notes.md) at a configurable rate, then writes a
+sparse output file of the reported size so post-processing has something to find.
+
+`mega-get -q` instead queues the transfer in a fake MEGAcmd server (a state file
+per transfer) and returns; `mega-transfers` lists those transfers with progress
+computed from the elapsed time, writing each output file once it completes.
+
+Usage: replay_tool.py TOOL [the tool's own arguments]
+
+Environment:
+    BENCH_SIZE       bytes to "download" (default 100 MiB)
+    BENCH_RATE       bytes per second (default 50 MiB/s)
+    BENCH_DURATION   seconds for the whole transfer; overrides BENCH_RATE
+    BENCH_UPDATE_HZ  progress redraws per second (default 10)
+    BENCH_STATE_DIR  where queued MEGA transfers are kept (default: a dir in $TMPDIR)
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from urllib.parse import urlparse
+
+MIB = 1024 * 1024
+
+def _mega_unit(total):
+    for unit, scale in (("GB", 1024 ** 3), ("MB", MIB), ("KB", 1024)):
+        if total >= scale:
+            return unit, scale
+    return "B", 1
+
+def mega_get_line(done, total, elapsed):
+    unit, scale = _mega_unit(total)
+    filled = int(40 * done / total) if total else 40
+    bar = "#" * filled + "." * (40 - filled)
+    return f"\x1b[KTRANSFERRING ||{bar}||({done // scale}/{total // scale} {unit}: {done * 100 / total:6.2f} %)\r"
+
+def ffsend_line(done, total, elapsed):
+    speed = done / elapsed if elapsed else 0
+    remaining = int((total - done) / speed) if speed else 0
+    filled = int(16 * done / total) if total else 16
+    bar = "=" * filled + ">" + "-" * (16 - filled)
+    return (f"\x1b[2KDownload & Decrypt {done / MIB:.2f} MB / {total / MIB:.2f} MB [{bar}] "
+            f"{done * 100 / total:.2f} % {speed / MIB:.2f} MB/s {remaining}s\r")
+
+def wget_line(done, total, elapsed, name="file"):
+    speed = done / elapsed if elapsed else 0
+    percent = int(done * 100 / total) if total else 100
+    filled = int(19 * done / total) if total else 19
+    bar = "=" * filled + ">" + " " * (19 - filled)
+    if done >= total:
+        tail = f"in {int(elapsed)}s"
+    else:
+        tail = f"eta {int((total - done) / speed) if speed else 0}s"
+    return f"{name[:18]:<18} {percent:3d}%[{bar}] {done / MIB:6.2f}M  {speed / MIB:.2f}MB/s    {tail}    \r"
+
+FORMATTERS = {"mega-get": mega_get_line, "ffsend": ffsend_line, "wget": wget_line}
+
+def progress_stream(tool, size, steps):
+    """The whole progress output for a transfer in `steps` redraws (used by the parser benchmark too)"""
+    line = FORMATTERS[tool]
+    return "".join(line(size * i // steps, size, max(i, 1) / 10) for i in range(1, steps + 1))
+
+def _output_path(tool, args):
+    if tool == "mega-get":
+        # mega-get URL TARGET_DIR
+        url, target = args[0], args[1] if len(args) > 1 else "."
+        handle = urlparse(url).path.rstrip("/").rsplit("/", 1)[-1] or "file"
+        return os.path.join(target, f"{handle}.bin")
+    if tool == "ffsend":
+        # ffsend download -y URL --output DIR
+        target = args[args.index("--output") + 1] if "--output" in args else "."
+        url = next(arg for arg in args if "://" in arg)
+        file_id = [part for part in urlparse(url).path.split("/") if part][-1]
+        return os.path.join(target, f"{file_id}.bin")
+    # wget URL [-O FILE | -P DIR]
+    url = next(arg for arg in args if "://" in arg)
+    if "-O" in args:
+        return args[args.index("-O") + 1]
+    target = args[args.index("-P") + 1] if "-P" in args else "."
+    return os.path.join(target, os.path.basename(urlparse(url).path) or "index.html")
+
+def _state_dir():
+    path = os.getenv("BENCH_STATE_DIR") or os.path.join(tempfile.gettempdir(), "replay-megacmd")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def mega_queue(args, size, duration):
+    """mega-get -q URL TARGET_DIR: record the transfer and return immediately"""
+    state_dir = _state_dir()
+    tag = len([name for name in os.listdir(state_dir) if name.endswith(".json")]) + 1
+    transfer = {
+        "tag": tag,
+        "source": args[0],
+        "path": os.path.abspath(_output_path("mega-get", args)),
+        "size": size,
+        "start": time.time(),
+        "duration": duration,
+        "cancelled": False,
+    }
+    with open(os.path.join(state_dir, f"{tag}.json"), "w") as f:
+        json.dump(transfer, f)
+
+def mega_transfers(args):
+    """mega-transfers [-c TAG] [--col-separator=X] ...: list (or cancel) queued transfers"""
+    state_dir = _state_dir()
+    if "-c" in args:
+        path = os.path.join(state_dir, f"{args[args.index('-c') + 1]}.json")
+        with open(path) as f:
+            transfer = json.load(f)
+        transfer["cancelled"] = True
+        with open(path, "w") as f:
+            json.dump(transfer, f)
+        return
+    separator = next((arg.split("=", 1)[1] for arg in args if arg.startswith("--col-separator=")), " ")
+    lines = [separator.join(["TAG", "SOURCEPATH", "DESTINYPATH", "PROGRESS", "STATE"])]
+    for name in sorted(os.listdir(state_dir), key=lambda name: int(name.split(".")[0])):
+        with open(os.path.join(state_dir, name)) as f:
+            transfer = json.load(f)
+        size, elapsed = transfer["size"], time.time() - transfer["start"]
+        done = min(size, int(size * elapsed / transfer["duration"])) if transfer["duration"] else size
+        if transfer["cancelled"]:
+            state = "CANCELLED"
+        elif done < size:
+            state = "ACTIVE"
+        else:
+            state = "COMPLETED"
+            if not os.path.exists(transfer["path"]):
+                os.makedirs(os.path.dirname(transfer["path"]), exist_ok=True)
+                with open(transfer["path"], "wb") as f:
+                    f.truncate(size)
+        progress = f"{done * 100 / size:6.2f}% of {size / MIB:7.2f} MB"
+        lines.append(separator.join([str(transfer["tag"]), transfer["source"], transfer["path"], progress, state]))
+    print("\n".join(lines))
+
+def main():
+    tool, args = sys.argv[1], sys.argv[2:]
+    size = int(os.getenv("BENCH_SIZE", str(100 * MIB)))
+    rate = float(os.getenv("BENCH_RATE", str(50 * MIB)))
+    duration = float(os.getenv("BENCH_DURATION") or size / rate)
+    if tool == "mega-transfers":
+        mega_transfers(args)
+        return
+    if tool == "mega-get" and "-q" in args:
+        mega_queue([arg for arg in args if arg != "-q"], size, duration)
+        return
+    hz = float(os.getenv("BENCH_UPDATE_HZ", "10"))
+    steps = max(1, int(duration * hz))
+    path = _output_path(tool, args)
+    name = os.path.basename(path)
+    out = sys.stdout
+
+    if tool == "wget":
+        url = next(arg for arg in args if "://" in arg)
+        out.write(f"--{datetime.now():%Y-%m-%d %H:%M:%S}--  {url}\n")
+        out.write("HTTP request sent, awaiting response... 200 OK\n")
+        out.write(f"Length: {size} ({size // MIB}M) [application/octet-stream]\n")
+        out.write(f"Saving to: ‘{name}’\n\n")
+
+    start = time.monotonic()
+    for i in range(1, steps + 1):
+        # Sleep until this redraw is due, like the real tools' fixed refresh rate
+        delay = start + i / hz - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        done = size * i // steps
+        elapsed = time.monotonic() - start
+        if tool == "wget":
+            out.write(wget_line(done, size, elapsed, name))
+        else:
+            out.write(FORMATTERS[tool](done, size, elapsed))
+        out.flush()
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "wb") as f:
+        f.truncate(size)
+    if tool == "wget":
+        out.write(f"\n\n{datetime.now():%Y-%m-%d %H:%M:%S} ({size / MIB / max(duration, 0.001):.2f} MB/s) - ‘{name}’ saved [{size}/{size}]\n")
+    else:
+        out.write(f"\nDownload finished: {path}\n")
+    out.flush()
+
+if __name__ == "__main__":
+    main()
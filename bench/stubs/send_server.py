@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Stand-in Send server for the native Send client: serves /api/metadata/<id> and
+/api/download/<id> with Send's nonce/HMAC authentication, encrypted metadata and
+an aes128gcm-encrypted body streamed at a configurable rate. Every file id exists;
+its secret is derived from the id, so links can be built with link() without
+asking the server.
+
+Usage: send_server.py [--host 127.0.0.1] [--port 0]   (prints "PORT <n>" once listening)
+
+Environment:
+    BENCH_SIZE  plaintext bytes per file (default 100 MiB)
+    BENCH_RATE  encrypted bytes per second (default 50 MiB/s)
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import struct
+import sys
+import time
+
+from aiohttp import web
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+MIB = 1024 * 1024
+RECORD_SIZE = 64 * 1024
+TAG_LENGTH = 16
+PATTERN = bytes(range(256)) * 256  # plaintext of every record (one record's worth)
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+def hkdf_expand(prk: bytes, info: bytes, length: int) -> bytes:
+    output, block, counter = b"", b"", 1
+    while len(output) < length:
+        block = hmac.new(prk, block + info + bytes([counter]), hashlib.sha256).digest()
+        output += block
+        counter += 1
+    return output[:length]
+
+def hkdf(ikm: bytes, info: bytes, length: int) -> bytes:
+    return hkdf_expand(hmac.new(b"", ikm, hashlib.sha256).digest(), info, length)
+
+def secret_for(file_id: str) -> bytes:
+    return hashlib.sha256(file_id.encode()).digest()[:16]
+
+def link(origin: str, file_id: str) -> str:
+    """The share link a Send client would hand out for file_id"""
+    return f"{origin}/download/{file_id}/#{b64url(secret_for(file_id))}"
+
+def encrypted_size(size: int) -> int:
+    data = RECORD_SIZE - TAG_LENGTH - 1
+    return 21 + size + (TAG_LENGTH + 1) * max(1, -(-size // data))
+
+def encrypted_records(secret: bytes, size: int):
+    """Header, then aes128gcm records padded the way Send pads them"""
+    salt = os.urandom(16)
+    prk = hmac.new(salt, secret, hashlib.sha256).digest()
+    aead = AESGCM(hkdf_expand(prk, b"Content-Encoding: aes128gcm\0", 16))
+    nonce_base = hkdf_expand(prk, b"Content-Encoding: nonce\0", 12)
+    yield salt + struct.pack(">IB", RECORD_SIZE, 0)
+    chunk = RECORD_SIZE - TAG_LENGTH - 1
+    offset, sequence = 0, 0
+    while True:
+        data = PATTERN[:min(chunk, size - offset)]
+        offset += len(data)
+        last = offset >= size
+        nonce = nonce_base[:8] + struct.pack(">I", struct.unpack(">I", nonce_base[8:])[0] ^ sequence)
+        yield aead.encrypt(nonce, data + (b"\x02" if last else b"\x01"), None)
+        sequence += 1
+        if last:
+            return
+
+class SendServer:
+    def __init__(self, size: int, rate: float):
+        self.size = size
+        self.rate = rate
+        self.nonces = {}  # file id -> nonce the next request must sign
+
+    def _authorize(self, request, file_id: str):
+        """Check the request's signature over the current nonce and rotate it; returns (ok, headers)"""
+        nonce = self.nonces.setdefault(file_id, base64.b64encode(os.urandom(16)).decode())
+        auth_key = hkdf(secret_for(file_id), b"authentication", 64)
+        expected = "send-v1 " + b64url(hmac.new(auth_key, base64.b64decode(nonce), hashlib.sha256).digest())
+        ok = hmac.compare_digest(request.headers.get("Authorization", ""), expected)
+        if ok:
+            self.nonces[file_id] = base64.b64encode(os.urandom(16)).decode()
+        return ok, {"WWW-Authenticate": f"send-v1 {self.nonces[file_id]}"}
+
+    async def metadata(self, request):
+        file_id = request.match_info["id"]
+        ok, headers = self._authorize(request, file_id)
+        if not ok:
+            return web.Response(status=401, headers=headers)
+        name = f"{file_id}.bin"
+        metadata = json.dumps({
+            "name": name,
+            "size": self.size,
+            "type": "application/octet-stream",
+            "manifest": {"files": [{"name": name, "size": self.size, "type": "application/octet-stream"}]},
+        }).encode()
+        meta_key = hkdf(secret_for(file_id), b"metadata", 16)
+        body = {"metadata": b64url(AESGCM(meta_key).encrypt(bytes(12), metadata, None)), "finalDownload": False, "ttl": 86400000}
+        return web.json_response(body, headers=headers)
+
+    async def download(self, request):
+        file_id = request.match_info["id"]
+        ok, headers = self._authorize(request, file_id)
+        if not ok:
+            return web.Response(status=401, headers=headers)
+        response = web.StreamResponse(headers=headers)
+        response.content_length = encrypted_size(self.size)
+        response.content_type = "application/octet-stream"
+        await response.prepare(request)
+        start, sent = time.monotonic(), 0
+        for record in encrypted_records(secret_for(file_id), self.size):
+            await response.write(record)
+            sent += len(record)
+            # Pace the stream to the configured rate
+            delay = start + sent / self.rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await response.write_eof()
+        return response
+
+async def serve(host: str, port: int, size: int, rate: float):
+    server = SendServer(size, rate)
+    app = web.Application()
+    app.router.add_get("/api/metadata/{id}", server.metadata)
+    app.router.add_get("/api/download/{id}", server.download)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    print(f"PORT {runner.addresses[0][1]}", flush=True)
+    await asyncio.Event().wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    args = parser.parse_args()
+    size = int(os.getenv("BENCH_SIZE", str(100 * MIB)))
+    rate = float(os.getenv("BENCH_RATE", str(50 * MIB)))
+    try:
+        asyncio.run(serve(args.host, args.port, size, rate))
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+if __name__ == "__main__":
+    main()
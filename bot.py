@@ -5,129 +5,3073 @@ from discord import app_commands
 from dotenv import load_dotenv
 from discord import Interaction
 import asyncio
+import aiohttp
 import subprocess
 import re
 import time
 import json
 import uuid
+import sqlite3
+import threading
 import shutil
-from datetime import datetime
+import stat
+import hashlib
+import hmac
+import glob
+import io
+import struct
+import tarfile
+import zipfile
+import zlib
+import gzip
+import bz2
+import lzma
+import concurrent.futures
+import functools
+import errno
+import math
+import codecs
+import base64
+from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
-from urllib.parse import urlparse
+from urllib.parse import urlparse, unquote
+from aiohttp import web
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:  # Optional: link metadata probes and the native Send client; Send falls back to ffsend without it
+    Cipher = None
 
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
 DOWNLOAD_CHANNEL_ID = int(os.getenv("DOWNLOAD_CHANNEL_ID"))
 GUILD_ID = discord.Object(id=int(os.getenv("GUILD_ID")))
 
+# Root of the download drive: tmp/, logs/, storage/ and the destination folders live here
+STORAGE_ROOT = os.getenv("STORAGE_ROOT", "/mnt/transformer")
+
+# Embed refresh cadence in seconds (normal progress / status transitions)
+EMBED_UPDATE_INTERVAL = float(os.getenv("EMBED_UPDATE_INTERVAL", "2.0"))
+EMBED_URGENT_INTERVAL = float(os.getenv("EMBED_URGENT_INTERVAL", "0.5"))
+
+# History backend: "sqlite" (indexed, default) or "jsonl" (append-only log only)
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "sqlite")
+
+# Direct downloads: parallel Range segments for files large enough to split
+DIRECT_SEGMENTS = int(os.getenv("DIRECT_SEGMENTS", "4"))
+DIRECT_MIN_SEGMENT_SIZE = int(os.getenv("DIRECT_MIN_SEGMENT_SIZE", str(16 * 1024 * 1024)))
+DIRECT_CHUNK_SIZE = 256 * 1024
+DIRECT_MAX_RETRIES = int(os.getenv("DIRECT_MAX_RETRIES", "5"))
+DIRECT_CHECKPOINT_INTERVAL = float(os.getenv("DIRECT_CHECKPOINT_INTERVAL", "5"))
+
+# Speed/ETA smoothing: time constant in seconds of the moving average over byte samples
+SPEED_WINDOW = float(os.getenv("SPEED_WINDOW", "5"))
+
+# MEGA: "background" queues links in the MEGAcmd server (mega-get -q) and follows every MEGA
+# download with one shared mega-transfers call per MEGA_POLL_INTERVAL; "foreground" runs and
+# scrapes one mega-get per link. A queued transfer that never shows up fails after MEGA_TRANSFER_GRACE s
+MEGA_TRANSFER_MODE = os.getenv("MEGA_TRANSFER_MODE", "background")
+MEGA_POLL_INTERVAL = float(os.getenv("MEGA_POLL_INTERVAL", "1.0"))
+MEGA_TRANSFER_GRACE = float(os.getenv("MEGA_TRANSFER_GRACE", "15"))
+
+# Send (ffsend) links: hosts treated as Send instances, and whether to download them in-process
+# (links the native client can't handle, e.g. password-protected ones, still go to the ffsend binary)
+SEND_HOSTS = [host.strip().lower() for host in os.getenv("SEND_HOSTS", "send.vis.ee,send.richy.sh").split(",") if host.strip()]
+SEND_NATIVE = os.getenv("SEND_NATIVE", "1") != "0"
+
+# Pre-flight probes (name/size before transferring): timeout and how long results are reused
+PREFLIGHT_TIMEOUT = float(os.getenv("PREFLIGHT_TIMEOUT", "15"))
+PREFLIGHT_CACHE_TTL = float(os.getenv("PREFLIGHT_CACHE_TTL", "300"))
+
+# Disk admission: downloads reserve their size (plus archive size x EXTRACT_EXPANSION_FACTOR
+# for extraction) and only start if DISK_FREE_FLOOR bytes would still be free afterwards
+DISK_FREE_FLOOR = int(os.getenv("DISK_FREE_FLOOR", str(1024 * 1024 * 1024)))
+EXTRACT_EXPANSION_FACTOR = float(os.getenv("EXTRACT_EXPANSION_FACTOR", "1.0"))
+DISK_RECHECK_INTERVAL = float(os.getenv("DISK_RECHECK_INTERVAL", "30"))
+
+# Scheduling: how many downloads may transfer at once (overall and per service),
+# and an optional total bandwidth cap in bytes/s for in-process transfers (0 = unlimited)
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "3"))
+SERVICE_CONCURRENCY = {
+    "MEGA": int(os.getenv("MAX_CONCURRENT_MEGA", "1")),
+    "ffsend": int(os.getenv("MAX_CONCURRENT_FFSEND", "2")),
+    "Direct Download": int(os.getenv("MAX_CONCURRENT_DIRECT", "2")),
+}
+BANDWIDTH_LIMIT = int(os.getenv("BANDWIDTH_LIMIT", "0"))
+
+# Extraction: archives unpacked at once across all downloads, and how deep to follow nested archives
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "2"))
+EXTRACT_MAX_DEPTH = int(os.getenv("EXTRACT_MAX_DEPTH", "2"))
+EXTRACT_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix="extract")
+EXTRACT_SLOTS = asyncio.Semaphore(EXTRACT_WORKERS)
+
+# Blocking filesystem work (walks, moves, log writes) runs on this many threads,
+# and the event loop is reported if it stalls for longer than LOOP_LAG_THRESHOLD seconds
+FS_WORKERS = int(os.getenv("FS_WORKERS", "4"))
+FS_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=FS_WORKERS, thread_name_prefix="fs")
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.1"))
+
+# Prometheus-style metrics are served on http://METRICS_HOST:METRICS_PORT/metrics (0 disables)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# Copy chunk size when moving output across filesystems
+MOVE_CHUNK_SIZE = int(os.getenv("MOVE_CHUNK_SIZE", str(64 * 1024 * 1024)))
+
+# Deduplication of files already in the library/archives: "off", "link" (hardlink) or "skip".
+# Off by default: hardlinked copies share their content, so editing one in place (retagging) changes both.
+# Files smaller than DEDUP_MIN_SIZE (covers, cue sheets) are left alone
+DEDUP_MODE = os.getenv("DEDUP_MODE", "off")
+DEDUP_MIN_SIZE = int(os.getenv("DEDUP_MIN_SIZE", str(1024 * 1024)))
+DEDUP_INDEX_PATH = f"{STORAGE_ROOT}/logs/content_index.db"
+
+# Bulk downloads: most links accepted per command (also bounded by the embed's size)
+BULK_MAX_URLS = int(os.getenv("BULK_MAX_URLS", "50"))
+
+# In-flight downloads are journaled here (one file each) so they survive a restart
+JOURNAL_DIR = f"{STORAGE_ROOT}/logs/journal"
+
 intents = discord.Intents.default()
 intents.message_content = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
 # Global variables
 downloads = {}  # download_id -> DownloadManager
-last_downloads = {}  # user_id -> download_id (for /note command)
+batches = {}  # batch_id -> BatchDownload
+finished_batches = {}  # batch_id -> item download_ids, so notes still reach a finished batch's logs
+last_downloads = {}  # user_id -> download_id or batch_id (for /note command)
 
 # Helper function to format URLs for Discord embeds
 def format_url(url: str) -> str:
     if not url:
         return url
     
-    # If URL already has a scheme, return as-is
-    parsed = urlparse(url)
-    if parsed.scheme in ['http', 'https']:
-        return url
+    # If URL already has a scheme, return as-is
+    parsed = urlparse(url)
+    if parsed.scheme in ['http', 'https']:
+        return url
+    
+    # If no scheme, assume https
+    if not parsed.scheme:
+        return f"https://{url}"
+    
+    # For other schemes, convert to https
+    return f"https://{parsed.netloc or url}"
+
+URL_RE = re.compile(r"https?://[^\s<>\"']+")
+
+def extract_urls(text: str):
+    """URLs in pasted text or a links file, in order and without repeats"""
+    urls = []
+    for match in URL_RE.finditer(text or ""):
+        url = format_url(match.group(0).rstrip(").,;]>"))
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+def is_send_link(url: str) -> bool:
+    """True for links to a Send instance (downloaded with the native client or ffsend)"""
+    return urlparse(url).netloc.lower() in SEND_HOSTS or "ffsend" in url
+
+def get_service_icon(service: str) -> str:
+    """Get the icon URL for a service"""
+    icons = {
+        "MEGA": "https://github.com/slink-y/zurg/blob/main/assets/icons/mega.png?raw=true",
+        "ffsend": "https://github.com/slink-y/zurg/blob/main/assets/icons/ffsend.png?raw=true",
+        "Direct Download": "https://github.com/slink-y/zurg/blob/main/assets/icons/direct.png?raw=true"
+    }
+    return icons.get(service, "https://github.com/slink-y/zurg/blob/main/assets/icons/direct.png?raw=true")
+
+SERVICE_EMOJI = {
+    "MEGA": "🔴",
+    "ffsend": "✉️", 
+    "Direct Download": "🔗"
+}
+
+def format_size(size_bytes) -> str:
+    """Format a byte count as a human-readable size"""
+    size_bytes = size_bytes or 0
+    if size_bytes >= 1024 * 1024 * 1024:  # GB
+        return f"{size_bytes / (1024 * 1024 * 1024):.1f} GB"
+    elif size_bytes >= 1024 * 1024:  # MB
+        return f"{size_bytes / (1024 * 1024):.1f} MB"
+    elif size_bytes >= 1024:  # KB
+        return f"{size_bytes / 1024:.1f} KB"
+    return f"{size_bytes} bytes"
+
+def format_duration(seconds) -> str:
+    """Format seconds as '1h 02m', '3m 05s' or '12s'"""
+    seconds = int(max(0, seconds or 0))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+def format_timestamp(timestamp: str, fmt: str = "%Y-%m-%d %H:%M:%S") -> str:
+    """Format an ISO timestamp from a log record"""
+    if not timestamp:
+        return "Unknown"
+    try:
+        dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        return dt.strftime(fmt)
+    except ValueError:
+        return timestamp
+
+
+# Binary multipliers for the unit suffixes the download tools print (their "MB" is MiB too)
+SIZE_UNITS = {
+    "": 1, "b": 1, "bytes": 1,
+    "k": 1024, "kb": 1024, "kib": 1024,
+    "m": 1024 ** 2, "mb": 1024 ** 2, "mib": 1024 ** 2,
+    "g": 1024 ** 3, "gb": 1024 ** 3, "gib": 1024 ** 3,
+    "t": 1024 ** 4, "tb": 1024 ** 4, "tib": 1024 ** 4,
+}
+
+def _to_bytes(value: str, unit: str = "", default_unit: str = "b") -> int:
+    """Convert '1,5' + 'GiB' style tool output into bytes"""
+    return int(float(value.replace(",", ".")) * SIZE_UNITS.get((unit or default_unit).lower(), 1))
+
+def _parse_duration(text: str) -> Optional[float]:
+    """Parse an ETA such as '00:01:05', '1m 5s', '1h2m' or '12s' into seconds"""
+    text = (text or "").strip()
+    if re.fullmatch(r"\d+(:\d{1,2}){1,2}", text):
+        seconds = 0
+        for part in text.split(":"):
+            seconds = seconds * 60 + int(part)
+        return float(seconds)
+    parts = re.findall(r"(\d+(?:\.\d+)?)\s*([dhms])", text.lower())
+    if not parts:
+        return None
+    scale = {"d": 86400, "h": 3600, "m": 60, "s": 1}
+    return sum(float(value) * scale[unit] for value, unit in parts)
+
+class ProgressEvent:
+    """One progress reading from a download tool; sizes in bytes, speed in bytes/s, ETA in seconds"""
+    __slots__ = ("done_bytes", "total_bytes", "percent", "speed", "eta")
+    
+    def __init__(self, done_bytes: int = None, total_bytes: int = None, percent: float = None,
+                 speed: float = None, eta: float = None):
+        self.done_bytes = done_bytes
+        self.total_bytes = total_bytes
+        self.percent = percent
+        self.speed = speed
+        self.eta = eta
+        if self.percent is None and done_bytes is not None and total_bytes:
+            self.percent = done_bytes * 100 / total_bytes
+        if self.done_bytes is None and percent is not None and total_bytes:
+            self.done_bytes = int(total_bytes * percent / 100)
+    
+    def __repr__(self):
+        return (f"ProgressEvent(done_bytes={self.done_bytes}, total_bytes={self.total_bytes}, "
+                f"percent={self.percent}, speed={self.speed}, eta={self.eta})")
+
+_SIZE = r"([\d.,]+)\s*([KMGT]?i?B|bytes)?"
+
+# mega-get: TRANSFERRING ||#############...||(112/147 MB:  76.12 %)
+_MEGA_PROGRESS_RE = re.compile(r"\(([\d.,]+)/([\d.,]+)\s*([KMGT]?B):\s*([\d.,]+)\s*%\s*\)", re.IGNORECASE)
+
+# ffsend: 12.34 MiB / 56.78 MiB [=====>    ] 21.73 % 1.23 MiB/s 30s
+_FFSEND_PROGRESS_RE = re.compile(
+    _SIZE + r"\s*/\s*" + _SIZE + r".*?([\d.,]+)\s*%(?:\s+" + _SIZE + r"/s)?(?:\s+(\S.*?))?\s*$", re.IGNORECASE
+)
+_FFSEND_PERCENT_RE = re.compile(r"([\d.,]+)\s*%.*?" + _SIZE + r"/s(?:\s+(\S.*?))?\s*$", re.IGNORECASE)
+
+# wget (bar): file.zip  45%[=====>     ]  12.34M  1.23MB/s    eta 12s
+# wget (dot):  1024K .......... .......... 45% 1.23M 12s
+_WGET_BAR_RE = re.compile(
+    r"(\d+)%\[[^\]]*\]\s+([\d.,]+)([KMGT]?)\s+([\d.,]+)\s*([KMGT]?B)/s(?:\s+(eta|in)\s+(.+?))?\s*$", re.IGNORECASE
+)
+_WGET_DOT_RE = re.compile(r"^\s*(\d+)([KMGT]?)\s+[. ]+\s+(\d+)%\s+([\d.,]+)([KMGT]?)\s*(?:=)?(\S+)?\s*$", re.IGNORECASE)
+_WGET_LENGTH_RE = re.compile(r"^Length:\s*(\d+)")
+
+def _parse_mega_get(line: str, state: dict) -> Optional[ProgressEvent]:
+    m = _MEGA_PROGRESS_RE.search(line)
+    if not m:
+        return None
+    # The sizes are whole units (a GB-sized transfer counts in whole GB); the percentage is finer
+    total = _to_bytes(m.group(2), m.group(3))
+    percent = float(m.group(4).replace(",", "."))
+    return ProgressEvent(done_bytes=int(total * percent / 100), total_bytes=total, percent=percent)
+
+def _parse_ffsend(line: str, state: dict) -> Optional[ProgressEvent]:
+    m = _FFSEND_PROGRESS_RE.search(line)
+    if m:
+        speed = _to_bytes(m.group(6), m.group(7), "mb") if m.group(6) else None
+        return ProgressEvent(
+            done_bytes=_to_bytes(m.group(1), m.group(2), "mb"),
+            total_bytes=_to_bytes(m.group(3), m.group(4), "mb"),
+            percent=float(m.group(5).replace(",", ".")),
+            speed=speed,
+            eta=_parse_duration(m.group(8)),
+        )
+    m = _FFSEND_PERCENT_RE.search(line)
+    if m:
+        return ProgressEvent(
+            percent=float(m.group(1).replace(",", ".")),
+            speed=_to_bytes(m.group(2), m.group(3), "mb"),
+            eta=_parse_duration(m.group(4)),
+        )
+    return None
+
+def _parse_wget(line: str, state: dict) -> Optional[ProgressEvent]:
+    m = _WGET_LENGTH_RE.match(line)
+    if m:
+        state["total_bytes"] = int(m.group(1))
+        return None
+    total = state.get("total_bytes")
+    m = _WGET_BAR_RE.search(line)
+    if m:
+        return ProgressEvent(
+            done_bytes=_to_bytes(m.group(2), m.group(3)),
+            total_bytes=total,
+            percent=float(m.group(1)),
+            speed=_to_bytes(m.group(4), m.group(5)),
+            # The final line reports the elapsed time ("in 5.0s") instead of an ETA
+            eta=0.0 if (m.group(6) or "").lower() == "in" else _parse_duration(m.group(7)),
+        )
+    m = _WGET_DOT_RE.match(line)
+    if m:
+        # The offset is where the line started; the dots on it were received since
+        return ProgressEvent(
+            total_bytes=total,
+            percent=float(m.group(3)),
+            speed=_to_bytes(m.group(4), m.group(5)),
+            eta=_parse_duration(m.group(6)),
+        )
+    return None
+
+# Per-tool line grammars: (line, per-download state) -> ProgressEvent or None
+PROGRESS_GRAMMARS = {
+    "mega-get": _parse_mega_get,
+    "ffsend": _parse_ffsend,
+    "wget": _parse_wget,
+}
+
+class ProgressParser:
+    """
+    Incremental parser for a download tool's progress output. Splits on \r and \n as
+    bytes arrive, keeps only the unfinished current line, strips ANSI codes once per
+    line and returns the newest ProgressEvent found in each chunk.
+    """
+    ANSI_RE = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+    LINE_BREAK_RE = re.compile(r"[\r\n]")
+    MAX_LINE = 4096
+    
+    def __init__(self, grammar: str):
+        self.grammar = PROGRESS_GRAMMARS[grammar]
+        self.state = {}
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self._line = ""
+        self.last_event = None
+    
+    def feed(self, data: bytes) -> Optional[ProgressEvent]:
+        """Consume a chunk of output; returns the newest event it completed, if any"""
+        text = self._decoder.decode(data)
+        if not self.LINE_BREAK_RE.search(text):
+            self._line = (self._line + text)[-self.MAX_LINE:]
+            return None
+        lines = self.LINE_BREAK_RE.split(self._line + text)
+        self._line = lines.pop()[-self.MAX_LINE:]
+        return self._parse_lines(lines)
+    
+    def flush(self) -> Optional[ProgressEvent]:
+        """Parse whatever is left once the tool has exited"""
+        line, self._line = self._line + self._decoder.decode(b"", final=True), ""
+        return self._parse_lines([line])
+    
+    def _parse_lines(self, lines) -> Optional[ProgressEvent]:
+        newest = None
+        for line in lines:
+            if not line:
+                continue
+            try:
+                event = self.grammar(self.ANSI_RE.sub("", line).replace("\x00", ""), self.state)
+            except ValueError:
+                # A line that only looks like progress ("1,234.5", "0.2.76"); skip it
+                continue
+            if event is not None:
+                newest = event
+        if newest is not None:
+            self.last_event = newest
+        return newest
+
+class SpeedEstimator:
+    """
+    Smoothed transfer speed and ETA from (time, bytes done) samples, whatever the source:
+    an exponentially weighted moving average of the byte deltas with a time constant of
+    `window` seconds, so irregular sample spacing (one tool line per second, one callback
+    per chunk) weighs the same.
+    """
+    MIN_INTERVAL = 0.2  # samples closer together than this are folded into the next one
+    
+    def __init__(self, window: float = SPEED_WINDOW):
+        self.window = max(0.1, window)
+        self.rate = 0.0  # bytes/s
+        self.peak = 0.0
+        self._first = None  # (time, bytes) at the first sample
+        self._last = None
+    
+    def update(self, done_bytes: int, now: float = None) -> float:
+        """Add a sample; returns the smoothed speed in bytes/s"""
+        now = time.monotonic() if now is None else now
+        if self._last is None or done_bytes < self._last[1]:
+            # First sample, or the transfer restarted from an earlier offset
+            self._first = self._last = (now, done_bytes)
+            return self.rate
+        elapsed = now - self._last[0]
+        if elapsed < self.MIN_INTERVAL:
+            return self.rate
+        instant = (done_bytes - self._last[1]) / elapsed
+        if self.rate == 0.0 and self._last == self._first:
+            self.rate = instant
+        else:
+            alpha = 1 - math.exp(-elapsed / self.window)
+            self.rate += alpha * (instant - self.rate)
+        self.peak = max(self.peak, self.rate)
+        self._last = (now, done_bytes)
+        return self.rate
+    
+    def eta(self, total_bytes: int) -> Optional[float]:
+        """Seconds left at the smoothed speed, or None if unknown"""
+        if not total_bytes or self._last is None or self.rate <= 0:
+            return None
+        return max(0.0, (total_bytes - self._last[1]) / self.rate)
+    
+    @property
+    def average(self) -> float:
+        """Bytes/s over everything sampled (excluding resumed bytes already on disk)"""
+        if self._first is None or self._last[0] <= self._first[0]:
+            return 0.0
+        return (self._last[1] - self._first[1]) / (self._last[0] - self._first[0])
+
+def generate_download_id():
+    """Generate a unique download ID"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    unique_id = str(uuid.uuid4())[:8]
+    return f"dl_{timestamp}_{unique_id}"
+
+async def run_fs(func, *args, **kwargs):
+    """Run blocking filesystem work on the bounded filesystem pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(FS_POOL, functools.partial(func, *args, **kwargs))
+
+async def run_fs_write(func, *args):
+    """
+    run_fs for writes to an open fd: if the caller is cancelled while the write is
+    running, wait for it to finish so the fd isn't closed (and reused) underneath it.
+    """
+    future = FS_POOL.submit(func, *args)
+    try:
+        return await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        if not future.cancelled():
+            await asyncio.wait([asyncio.wrap_future(future)])
+        raise
+
+async def stop_process(process):
+    """Kill a download tool that is still running and reap it"""
+    if process is None or process.returncode is not None:
+        return
+    try:
+        process.kill()
+    except ProcessLookupError:
+        pass
+    await process.wait()
+
+class LoopLagMonitor:
+    """
+    Measure how late a periodic timer fires to detect anything blocking the event loop.
+    Stalls over the threshold are logged; with PYTHONASYNCIODEBUG=1 asyncio also names
+    the callback responsible.
+    """
+    def __init__(self, interval: float = 0.05, threshold: float = LOOP_LAG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.samples = 0
+        self._task = None
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            loop = asyncio.get_running_loop()
+            loop.slow_callback_duration = self.threshold
+            self._task = loop.create_task(self._run())
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+    
+    def reset(self):
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.samples = 0
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - start - self.interval
+            self.samples += 1
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.stalls += 1
+                print(f"⚠️ Event loop blocked for {lag * 1000:.0f} ms")
+
+loop_monitor = LoopLagMonitor()
+
+DOWNLOAD_PHASES = ("identify", "queue", "transfer", "extract", "wait_destination", "move", "logging")
+
+class PhaseTimer:
+    """Wall-clock seconds and bytes per download phase; entering a phase ends the previous one"""
+    def __init__(self):
+        self.seconds = {}
+        self.bytes = {}
+        self.current = None
+        self._started = None
+    
+    def enter(self, phase: str):
+        self.stop()
+        self.current = phase
+        self._started = time.monotonic()
+    
+    def stop(self):
+        if self.current is not None:
+            self.seconds[self.current] = self.seconds.get(self.current, 0.0) + time.monotonic() - self._started
+            self.current = None
+    
+    def add_bytes(self, phase: str, nbytes: int):
+        self.bytes[phase] = self.bytes.get(phase, 0) + int(nbytes)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Finished phases in pipeline order, for the log record"""
+        return {
+            "seconds": {phase: round(self.seconds[phase], 3) for phase in DOWNLOAD_PHASES if phase in self.seconds},
+            "bytes": {phase: self.bytes[phase] for phase in DOWNLOAD_PHASES if phase in self.bytes},
+        }
+
+class Histogram:
+    """Cumulative-bucket histogram per label set, rendered in Prometheus text format"""
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.series = {}  # labels -> [bucket counts..., +Inf count, sum]
+    
+    def observe(self, labels: tuple, value: float):
+        series = self.series.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[len(self.buckets)] += 1
+        series[-1] += value
+    
+    def count(self, labels: tuple) -> int:
+        series = self.series.get(labels)
+        return series[len(self.buckets)] if series else 0
+    
+    def total(self, labels: tuple) -> float:
+        series = self.series.get(labels)
+        return series[-1] if series else 0.0
+    
+    def render(self, name: str, label_names: tuple):
+        for labels, series in sorted(self.series.items()):
+            base = ",".join(f'{key}="{_prometheus_escape(value)}"' for key, value in zip(label_names, labels))
+            for bound, count in zip(self.buckets, series):
+                yield f'{name}_bucket{{{base},le="{bound}"}} {count}'
+            yield f'{name}_bucket{{{base},le="+Inf"}} {series[len(self.buckets)]}'
+            yield f"{name}_sum{{{base}}} {series[-1]}"
+            yield f"{name}_count{{{base}}} {series[len(self.buckets)]}"
+
+def _prometheus_escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class DownloadMetrics:
+    """Process-wide download counters and histograms behind /metrics and /stats"""
+    PHASE_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, 14400)
+    THROUGHPUT_BUCKETS = tuple(256 * 1024 * 2 ** i for i in range(10))  # 256 KiB/s .. 128 MiB/s
+    
+    def __init__(self):
+        self.started = time.time()
+        self.downloads = {}  # (service, status) -> count
+        self.phase_bytes = {}  # (service, phase) -> bytes
+        self.phase_seconds = Histogram(self.PHASE_BUCKETS)
+        self.throughput = Histogram(self.THROUGHPUT_BUCKETS)
+        self.embed_edits = 0
+    
+    def observe_transfer(self, service: str, nbytes: int, seconds: float):
+        if nbytes and seconds > 0:
+            self.throughput.observe((service,), nbytes / seconds)
+    
+    def record_download(self, manager, status: str):
+        """Fold a finished (completed, failed or cancelled) download's phases into the totals"""
+        key = (manager.service, status)
+        self.downloads[key] = self.downloads.get(key, 0) + 1
+        for phase, seconds in manager.timer.seconds.items():
+            self.phase_seconds.observe((manager.service, phase), seconds)
+        for phase, nbytes in manager.timer.bytes.items():
+            self.phase_bytes[(manager.service, phase)] = self.phase_bytes.get((manager.service, phase), 0) + nbytes
+    
+    def render(self) -> str:
+        """Prometheus text exposition of everything recorded since startup"""
+        lines = [
+            "# HELP zurg_downloads_total Downloads finished, by service and outcome",
+            "# TYPE zurg_downloads_total counter",
+        ]
+        for (service, status), count in sorted(self.downloads.items()):
+            lines.append(f'zurg_downloads_total{{service="{_prometheus_escape(service)}",status="{status}"}} {count}')
+        lines += [
+            "# HELP zurg_phase_bytes_total Bytes handled in each download phase",
+            "# TYPE zurg_phase_bytes_total counter",
+        ]
+        for (service, phase), nbytes in sorted(self.phase_bytes.items()):
+            lines.append(f'zurg_phase_bytes_total{{service="{_prometheus_escape(service)}",phase="{phase}"}} {nbytes}')
+        lines += [
+            "# HELP zurg_phase_seconds Time spent in each download phase",
+            "# TYPE zurg_phase_seconds histogram",
+        ]
+        lines.extend(self.phase_seconds.render("zurg_phase_seconds", ("service", "phase")))
+        lines += [
+            "# HELP zurg_transfer_throughput_bytes_per_second Average transfer speed per download",
+            "# TYPE zurg_transfer_throughput_bytes_per_second histogram",
+        ]
+        lines.extend(self.throughput.render("zurg_transfer_throughput_bytes_per_second", ("service",)))
+        lines += [
+            "# HELP zurg_active_downloads Downloads holding a transfer slot",
+            "# TYPE zurg_active_downloads gauge",
+            f"zurg_active_downloads {len(scheduler.active)}",
+            "# HELP zurg_queued_downloads Downloads waiting for a transfer slot",
+            "# TYPE zurg_queued_downloads gauge",
+            f"zurg_queued_downloads {len(scheduler.queue)}",
+            "# HELP zurg_disk_reserved_bytes Disk space booked by downloads but not yet written",
+            "# TYPE zurg_disk_reserved_bytes gauge",
+            f"zurg_disk_reserved_bytes {space.reserved()}",
+            "# HELP zurg_embed_edits_total Progress message edits sent to Discord",
+            "# TYPE zurg_embed_edits_total counter",
+            f"zurg_embed_edits_total {self.embed_edits}",
+            "# HELP zurg_event_loop_lag_max_seconds Longest event loop stall observed",
+            "# TYPE zurg_event_loop_lag_max_seconds gauge",
+            f"zurg_event_loop_lag_max_seconds {loop_monitor.max_lag}",
+            "# HELP zurg_event_loop_stalls_total Event loop stalls over the lag threshold",
+            "# TYPE zurg_event_loop_stalls_total counter",
+            f"zurg_event_loop_stalls_total {loop_monitor.stalls}",
+        ]
+        return "\n".join(lines) + "\n"
+
+metrics = DownloadMetrics()
+_metrics_runner = None
+
+async def start_metrics_server():
+    """Serve metrics.render() on localhost (once, even if on_ready fires again)"""
+    global _metrics_runner
+    if METRICS_PORT <= 0 or _metrics_runner is not None:
+        return
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    _metrics_runner = runner
+    print(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+class EmbedRenderer:
+    """
+    Coalesce embed updates for a single message.
+    Callers mark the state dirty; a background task renders at most once per
+    interval and skips the edit when the embed is unchanged since the last one sent.
+    A failed edit pushes the next one back, doubling the wait each time up to MAX_BACKOFF.
+    """
+    MAX_BACKOFF = 60.0
+    
+    def __init__(self, message: discord.Message, build_embed, interval: float = EMBED_UPDATE_INTERVAL,
+                 urgent_interval: float = EMBED_URGENT_INTERVAL):
+        self.message = message
+        self.build_embed = build_embed
+        self.interval = interval
+        self.urgent_interval = urgent_interval
+        self.edit_count = 0
+        self.skipped_count = 0
+        self._dirty = asyncio.Event()
+        self._wake = asyncio.Event()
+        self._urgent = False
+        self._closed = False
+        self._last_payload = None
+        self._last_edit = 0.0
+        self._backoff = 0.0  # extra seconds before the next edit after failures
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def mark_dirty(self, urgent: bool = False):
+        """Schedule a render; never waits on Discord"""
+        if self._closed:
+            return
+        if urgent:
+            self._urgent = True
+            self._wake.set()
+        self._dirty.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while not self._closed:
+            await self._dirty.wait()
+            # Hold off until the cadence allows another edit, waking early for urgent updates
+            while not self._closed:
+                interval = self.urgent_interval if self._urgent else self.interval
+                delay = self._last_edit + interval + self._backoff - time.monotonic()
+                if delay <= 0:
+                    break
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+            if self._closed:
+                break
+            self._dirty.clear()
+            self._urgent = False
+            await self._render()
+
+    async def _render(self) -> bool:
+        """Build the embed and edit the message if it changed. Returns True if an edit was sent."""
+        async with self._lock:
+            embed = self.build_embed()
+            payload = json.dumps(embed.to_dict(), sort_keys=True)
+            if payload == self._last_payload:
+                self.skipped_count += 1
+                return False
+            try:
+                await self.message.edit(embed=embed)
+                self._last_payload = payload
+                self._last_edit = time.monotonic()
+                self._backoff = 0.0
+                self.edit_count += 1
+                metrics.embed_edits += 1
+                print(f"Embed updated: {embed.title}")
+                return True
+            except discord.NotFound:
+                # Message was deleted
+                self._closed = True
+            except discord.HTTPException as e:
+                # Rate limited or failing: wait longer before trying again, and retry this state then
+                self._last_edit = time.monotonic()
+                self._backoff = min(self.MAX_BACKOFF, max(self.interval, self._backoff * 2))
+                self._dirty.set()
+                print(f"Error updating embed (retrying in {self._backoff + self.interval:.0f}s): {e}")
+            return False
+
+    async def flush(self):
+        """Render immediately, bypassing the cadence (used for final states)"""
+        if self._closed:
+            return
+        self._dirty.clear()
+        self._urgent = False
+        await self._render()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+    
+    def close(self):
+        """Stop rendering; pending updates are dropped"""
+        self._closed = True
+        self._dirty.set()
+        self._wake.set()
+
+def _fsync_dir(path: str):
+    """fsync a directory so a rename inside it survives power loss"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _write_atomic(path: str, data: bytes):
+    """Replace path with data so readers (and a power cut) see either the old or the new file"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(path))
+
+class JsonlHistoryStore:
+    """
+    Append-only JSON-lines history (one record per line), so logging a download
+    is a single fsync'd append no matter how long the history gets.
+    Updates append a new copy of the record; an id -> offset index always points
+    at the latest copy, so readers never see duplicates.
+    """
+    def __init__(self, history_file: str, legacy_history_file: str = None):
+        self.history_file = history_file
+        self.legacy_history_file = legacy_history_file
+        self._offsets = None  # download id -> byte offset of its latest copy, built on first use
+        self.migrate_legacy_history()
+    
+    def migrate_legacy_history(self):
+        """One-time conversion of the old downloads.json into the JSON-lines log"""
+        if not self.legacy_history_file:
+            return
+        if os.path.exists(self.history_file) or not os.path.exists(self.legacy_history_file):
+            return
+        try:
+            with open(self.legacy_history_file, 'r') as f:
+                records = json.load(f).get("downloads", [])
+        except (OSError, ValueError) as e:
+            print(f"Error reading legacy history, skipping migration: {e}")
+            return
+        
+        self._write_records_atomic(records)
+        # Keep the old file around but out of the way so migration never runs twice
+        os.replace(self.legacy_history_file, f"{self.legacy_history_file}.migrated")
+        print(f"Migrated {len(records)} downloads to {self.history_file}")
+    
+    def _write_records_atomic(self, records):
+        """Replace the history file with the given records (temp file + rename)"""
+        tmp_path = f"{self.history_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.history_file)
+        _fsync_dir(os.path.dirname(self.history_file))
+    
+    def add(self, log_data):
+        """Append a download to the history, superseding any earlier copy with the same id"""
+        line = (json.dumps(log_data, ensure_ascii=False, separators=(',', ':')) + "\n").encode()
+        fd = os.open(self.history_file, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # Start on a fresh line if a previous append was torn by a crash
+            offset = os.fstat(fd).st_size
+            if offset and os.pread(fd, 1, offset - 1) != b"\n":
+                line = b"\n" + line
+                offset += 1
+            # A single O_APPEND write lands as one unit at the end of the file
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if self._offsets is not None:
+            self._offsets[log_data.get("id") or f"@{offset}"] = offset
+    
+    def _load_index(self):
+        """Build the id -> offset index with one scan of the log (first use only)"""
+        if self._offsets is None:
+            offsets = {}
+            if os.path.exists(self.history_file):
+                with open(self.history_file, 'rb') as f:
+                    offset = 0
+                    for line in f:
+                        if line.strip():
+                            try:
+                                record = json.loads(line)
+                                offsets[record.get("id") or f"@{offset}"] = offset
+                            except ValueError:
+                                pass
+                        offset += len(line)
+            self._offsets = offsets
+        return self._offsets
+    
+    def _iter_at(self, offsets):
+        """Yield the records stored at the given offsets"""
+        with open(self.history_file, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                yield json.loads(f.readline())
+    
+    def get(self, download_id: str):
+        """Return the latest copy of a record by id, or None"""
+        offset = self._load_index().get(download_id)
+        if offset is None:
+            return None
+        return next(self._iter_at([offset]))
+    
+    def update_fields(self, download_id: str, **fields):
+        """Patch fields of an existing record. Returns the updated record, or None if unknown."""
+        record = self.get(download_id)
+        if record is None:
+            return None
+        record.update(fields)
+        self.add(record)
+        return record
+    
+    def iter_latest(self):
+        """Yield the latest copy of every record, oldest download first"""
+        offsets = self._load_index()
+        if not offsets:
+            return
+        yield from self._iter_at(list(offsets.values()))
+    
+    def iter_downloads(self):
+        """Yield history records oldest first, skipping torn lines"""
+        if not os.path.exists(self.history_file):
+            return
+        with open(self.history_file, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+    
+    def last(self):
+        """Return the most recently added download (updates don't change its position)"""
+        offsets = self._load_index()
+        if not offsets:
+            return None
+        return next(self._iter_at([next(reversed(offsets.values()))]))
+    
+    def search(self, query: str = None, service: str = None, destination: str = None,
+               since: str = None, until: str = None, limit: int = 10, offset: int = 0):
+        """Linear-scan search, newest first. Returns (records, total_matches)."""
+        terms = _search_terms(query)
+        dest_key = _normalize_destination(destination) if destination else None
+        matches = []
+        for record in reversed(list(self.iter_latest())):
+            timestamp = record.get("timestamp") or ""
+            if service and (record.get("service") or "").lower() != service.lower():
+                continue
+            if dest_key is not None and _normalize_destination(record.get("destination")) != dest_key:
+                continue
+            if since and timestamp < since:
+                continue
+            if until and timestamp >= until:
+                continue
+            if terms:
+                haystack = " ".join(str(record.get(k) or "") for k in ("file_name", "note", "url")).lower()
+                if not all(term in haystack for term in terms):
+                    continue
+            matches.append(record)
+        return matches[offset:offset + limit], len(matches)
+    
+    def find_by_remote_key(self, key: str):
+        """Linear-scan for the newest completed download of the same remote file"""
+        for record in reversed(list(self.iter_latest())):
+            if record.get("status") == "completed" and (record.get("remote_key") or remote_key(record.get("url"))) == key:
+                return record
+        return None
+    
+    def compact(self):
+        """Rewrite the log without torn lines or superseded copies (latest record per id wins)"""
+        if not os.path.exists(self.history_file):
+            return
+        self._write_records_atomic(list(self.iter_latest()))
+        self._offsets = None
+
+class SqliteHistoryStore:
+    """
+    SQLite (WAL) history with indexes on id, timestamp, service and destination
+    and an FTS5 index over file_name/note/url, so lookups never load the whole history.
+    """
+    SCHEMA_VERSION = 1
+    
+    def __init__(self, db_path: str, import_from: JsonlHistoryStore = None):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+        if import_from is not None:
+            self._import_once(import_from)
+    
+    def _create_schema(self):
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                id TEXT PRIMARY KEY,
+                timestamp TEXT,
+                service TEXT COLLATE NOCASE,
+                destination TEXT,
+                file_name TEXT,
+                url TEXT,
+                note TEXT,
+                size_bytes INTEGER,
+                remote_key TEXT,
+                record TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_downloads_timestamp ON downloads(timestamp);
+            CREATE INDEX IF NOT EXISTS idx_downloads_service ON downloads(service, timestamp);
+            CREATE INDEX IF NOT EXISTS idx_downloads_destination ON downloads(destination, timestamp);
+            CREATE VIRTUAL TABLE IF NOT EXISTS downloads_fts USING fts5(
+                file_name, note, url, content='downloads', content_rowid='rowid'
+            );
+            CREATE TRIGGER IF NOT EXISTS downloads_ai AFTER INSERT ON downloads BEGIN
+                INSERT INTO downloads_fts(rowid, file_name, note, url)
+                VALUES (new.rowid, new.file_name, new.note, new.url);
+            END;
+            CREATE TRIGGER IF NOT EXISTS downloads_ad AFTER DELETE ON downloads BEGIN
+                INSERT INTO downloads_fts(downloads_fts, rowid, file_name, note, url)
+                VALUES ('delete', old.rowid, old.file_name, old.note, old.url);
+            END;
+            CREATE TRIGGER IF NOT EXISTS downloads_au AFTER UPDATE ON downloads BEGIN
+                INSERT INTO downloads_fts(downloads_fts, rowid, file_name, note, url)
+                VALUES ('delete', old.rowid, old.file_name, old.note, old.url);
+                INSERT INTO downloads_fts(rowid, file_name, note, url)
+                VALUES (new.rowid, new.file_name, new.note, new.url);
+            END;
+        """)
+        self._add_remote_key_column()
+    
+    def _add_remote_key_column(self):
+        """Add and backfill the remote_key column on databases created before it existed"""
+        self.conn.create_function("remote_key", 1, remote_key, deterministic=True)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(downloads)")]
+        if "remote_key" not in columns:
+            self.conn.execute("ALTER TABLE downloads ADD COLUMN remote_key TEXT")
+            self.conn.execute("UPDATE downloads SET remote_key = remote_key(url) WHERE url IS NOT NULL")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_downloads_remote_key ON downloads(remote_key, timestamp)")
+    
+    def _import_once(self, source: JsonlHistoryStore):
+        """Import the JSON-lines history the first time the database is created"""
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+        count = 0
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                for record in source.iter_downloads():
+                    self._upsert(record)
+                    count += 1
+                self.conn.execute(f"PRAGMA user_version={self.SCHEMA_VERSION}")
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        if count:
+            print(f"Imported {count} downloads into {self.db_path}")
+    
+    def _upsert(self, record):
+        self.conn.execute(
+            """
+            INSERT INTO downloads (id, timestamp, service, destination, file_name, url, note, size_bytes, remote_key, record)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                timestamp=excluded.timestamp, service=excluded.service, destination=excluded.destination,
+                file_name=excluded.file_name, url=excluded.url, note=excluded.note,
+                size_bytes=excluded.size_bytes, remote_key=excluded.remote_key, record=excluded.record
+            """,
+            (
+                record.get("id") or generate_download_id(),
+                record.get("timestamp"),
+                record.get("service"),
+                _normalize_destination(record.get("destination")),
+                record.get("file_name"),
+                record.get("url"),
+                record.get("note"),
+                record.get("size_bytes"),
+                record.get("remote_key") or remote_key(record.get("url")),
+                json.dumps(record, ensure_ascii=False),
+            )
+        )
+    
+    def add(self, log_data):
+        """Insert a download (or replace the record with the same id)"""
+        with self._lock:
+            self._upsert(log_data)
+    
+    def get(self, download_id: str):
+        """Return a record by id via the primary key, or None"""
+        with self._lock:
+            row = self.conn.execute("SELECT record FROM downloads WHERE id = ?", (download_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def update_fields(self, download_id: str, **fields):
+        """Patch fields of an existing row in place. Returns the updated record, or None if unknown."""
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT record FROM downloads WHERE id = ?", (download_id,)).fetchone()
+                if row is None:
+                    self.conn.execute("COMMIT")
+                    return None
+                record = json.loads(row[0])
+                record.update(fields)
+                self._upsert(record)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return record
+    
+    def last(self):
+        """Return the most recent record via the timestamp index"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT record FROM downloads ORDER BY timestamp DESC LIMIT 1"
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def search(self, query: str = None, service: str = None, destination: str = None,
+               since: str = None, until: str = None, limit: int = 10, offset: int = 0):
+        """Indexed search, newest first. Returns (records, total_matches)."""
+        clauses = []
+        params = []
+        terms = _search_terms(query)
+        if terms:
+            clauses.append("rowid IN (SELECT rowid FROM downloads_fts WHERE downloads_fts MATCH ?)")
+            params.append(" ".join('"{}"*'.format(term.replace('"', '""')) for term in terms))
+        if service:
+            clauses.append("service = ?")
+            params.append(service)
+        if destination:
+            clauses.append("destination = ?")
+            params.append(_normalize_destination(destination))
+        if since:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until:
+            clauses.append("timestamp < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            total = self.conn.execute(f"SELECT COUNT(*) FROM downloads {where}", params).fetchone()[0]
+            rows = self.conn.execute(
+                f"SELECT record FROM downloads {where} ORDER BY timestamp DESC LIMIT ? OFFSET ?",
+                params + [limit, offset]
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows], total
+    
+    def find_by_remote_key(self, key: str):
+        """Return the newest completed download of the same remote file via the remote_key index"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT record FROM downloads WHERE remote_key = ? ORDER BY timestamp DESC", (key,)
+            ).fetchall()
+        for row in rows:
+            record = json.loads(row[0])
+            if record.get("status") == "completed":
+                return record
+        return None
+    
+    def compact(self):
+        """Merge FTS segments and fold the WAL back into the database"""
+        with self._lock:
+            self.conn.execute("INSERT INTO downloads_fts(downloads_fts) VALUES ('optimize')")
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def _normalize_destination(destination) -> str:
+    """Reduce '/mnt/transformer/music/' or 'music' to the comparable key 'music'"""
+    if not destination:
+        return ""
+    destination = destination.strip()
+    if destination.startswith(STORAGE_ROOT):
+        destination = destination[len(STORAGE_ROOT):]
+    return destination.strip("/")
+
+def _search_terms(query: str):
+    """Split a free-text query into lowercase word terms"""
+    if not query:
+        return []
+    return [term for term in re.findall(r"\w+", query.lower()) if term]
+
+def remote_key(url: str) -> str:
+    """
+    Identify what a link points at, so the same upload shared twice is recognised:
+    'mega:file:<handle>', 'ffsend:<host>:<file id>', or the normalised URL for anything else.
+    """
+    if not url:
+        return ""
+    parsed = urlparse(format_url(url.strip()))
+    host = (parsed.hostname or "").lower()
+    if host.endswith("mega.nz") or host.endswith("mega.co.nz"):
+        # mega.nz/file/<handle>#<key>, mega.nz/folder/<handle>#<key>, legacy mega.nz/#!<handle>!<key> and #F!<handle>!<key>
+        match = re.match(r"^/(file|folder)/([\w-]+)", parsed.path)
+        if match:
+            return f"mega:{match.group(1)}:{match.group(2)}"
+        match = re.match(r"^(F?)!([\w-]+)", parsed.fragment)
+        if match:
+            return f"mega:{'folder' if match.group(1) else 'file'}:{match.group(2)}"
+    if is_send_link(url):
+        # <host>/download/<file id>/#<secret>
+        match = re.match(r"^/download/([\w-]+)", parsed.path)
+        if match:
+            return f"ffsend:{host}:{match.group(1)}"
+    port = f":{parsed.port}" if parsed.port and parsed.port not in (80, 443) else ""
+    query = f"?{parsed.query}" if parsed.query else ""
+    return f"url:{parsed.scheme.lower()}://{host}{port}{parsed.path or '/'}{query}"
+
+_shared_history = None
+_shared_history_lock = threading.Lock()
+
+def get_history():
+    """Return the process-wide DownloadHistory (opened on first use, from the loop or a worker thread)"""
+    global _shared_history
+    if _shared_history is None:
+        with _shared_history_lock:
+            if _shared_history is None:
+                _shared_history = DownloadHistory()
+    return _shared_history
+
+class DownloadHistory:
+    """Manage download history and logging"""
+    def __init__(self):
+        self.ensure_logs_directory()
+        jsonl_store = JsonlHistoryStore(
+            f"{STORAGE_ROOT}/logs/downloads.jsonl",
+            legacy_history_file=f"{STORAGE_ROOT}/logs/downloads.json"
+        )
+        if HISTORY_BACKEND == "jsonl":
+            self.store = jsonl_store
+        else:
+            self.store = SqliteHistoryStore(f"{STORAGE_ROOT}/logs/downloads.db", import_from=jsonl_store)
+    
+    def ensure_logs_directory(self):
+        """Ensure logs directory exists"""
+        os.makedirs(f"{STORAGE_ROOT}/logs", exist_ok=True)
+        os.makedirs(f"{STORAGE_ROOT}/tmp", exist_ok=True)
+        os.makedirs(f"{STORAGE_ROOT}/storage/archives", exist_ok=True)
+    
+    def add_download(self, log_data):
+        """Add a download to the history"""
+        self.store.add(log_data)
+    
+    def upsert(self, log_data):
+        """Insert a download or replace the record with the same id"""
+        self.store.add(log_data)
+    
+    def update_fields(self, download_id: str, **fields):
+        """Patch fields of a stored download by id. Returns the updated record, or None."""
+        return self.store.update_fields(download_id, **fields)
+    
+    def get(self, download_id: str):
+        """Return a stored download by id, or None"""
+        return self.store.get(download_id)
+    
+    def last_download(self):
+        """Return the most recent download record, or None"""
+        return self.store.last()
+    
+    def search(self, **filters):
+        """Search the history; see the store's search() for filters. Returns (records, total)."""
+        return self.store.search(**filters)
+    
+    def find_previous(self, url: str):
+        """Return the newest completed download of the same remote file as url, or None"""
+        key = remote_key(url)
+        return self.store.find_by_remote_key(key) if key else None
+    
+    def compact(self):
+        """Compact the underlying store"""
+        self.store.compact()
+    
+    def write_log(self, download_id, log_data):
+        """
+        Write the individual log (serialized once, temp file + rename) and hardlink
+        the archive's download_log.json to it if the download has an archive folder
+        """
+        data = json.dumps(log_data, indent=2).encode()
+        individual_log_path = f"{STORAGE_ROOT}/logs/{download_id}.json"
+        _write_atomic(individual_log_path, data)
+        
+        archive_dir = f"{STORAGE_ROOT}/storage/archives/{download_id}"
+        if not os.path.isdir(archive_dir):
+            return
+        archive_log_path = f"{archive_dir}/download_log.json"
+        tmp_path = f"{archive_log_path}.tmp"
+        try:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            os.link(individual_log_path, tmp_path)
+        except OSError:
+            # Archives on another filesystem: fall back to a second copy
+            _write_atomic(archive_log_path, data)
+            return
+        os.replace(tmp_path, archive_log_path)
+        _fsync_dir(archive_dir)
+
+def write_note_to_logs(download_id: str, note: str):
+    """Store a note on a finished download: its individual log, history record and archive log"""
+    try:
+        # Read the current log data
+        individual_log_path = f"{STORAGE_ROOT}/logs/{download_id}.json"
+        if os.path.exists(individual_log_path):
+            with open(individual_log_path, 'r') as f:
+                log_data = json.load(f)
+            
+            # Update the note and rewrite the individual and archive logs
+            log_data["note"] = note
+            history = get_history()
+            history.write_log(download_id, log_data)
+            
+            # Patch the history record in place
+            history.update_fields(download_id, note=note)
+            
+            print(f"Note saved to logs: {note}")
+    except Exception as e:
+        print(f"Error saving note to logs: {e}")
+
+class DownloadJournal:
+    """
+    Crash-safe record of in-flight downloads: one JSON file per download, replaced atomically
+    on every phase transition and removed once the download completes, fails or is cancelled.
+    """
+    def __init__(self, journal_dir: str):
+        self.journal_dir = journal_dir
+    
+    def _path(self, download_id: str) -> str:
+        return os.path.join(self.journal_dir, f"{download_id}.json")
+    
+    def save(self, state: Dict[str, Any]):
+        """Replace the entry for state["id"] (temp file + rename)"""
+        os.makedirs(self.journal_dir, exist_ok=True)
+        path = self._path(state["id"])
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        _fsync_dir(self.journal_dir)
+    
+    def remove(self, download_id: str):
+        try:
+            os.remove(self._path(download_id))
+        except FileNotFoundError:
+            return
+        _fsync_dir(self.journal_dir)
+    
+    def load_all(self):
+        """Journaled downloads, oldest first; unreadable entries are skipped"""
+        try:
+            names = sorted(os.listdir(self.journal_dir))
+        except FileNotFoundError:
+            return []
+        states = []
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.journal_dir, name), 'r') as f:
+                    states.append(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"Skipping unreadable journal entry {name}: {e}")
+        return states
+
+journal = DownloadJournal(JOURNAL_DIR)
+
+class TreeStats:
+    """
+    Total bytes, file count, top-level name and per-extension breakdown of a file tree,
+    gathered in a single scandir pass with one stat per file.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.total_bytes = 0
+        self.file_count = 0
+        self.top_level = None
+        self.top_level_is_dir = False
+        self.extensions = {}
+        self._scan()
+    
+    def _scan(self):
+        if not os.path.isdir(self.path):
+            if os.path.isfile(self.path):
+                self.top_level = os.path.basename(self.path)
+                self._add_file(self.top_level, os.stat(self.path).st_size)
+            return
+        
+        top_dirs, top_files = [], []
+        stack = [(self.path, True)]
+        while stack:
+            directory, is_top = stack.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, False))
+                            if is_top:
+                                top_dirs.append(entry.name)
+                        elif entry.is_file():
+                            self._add_file(entry.name, entry.stat().st_size)
+                            if is_top:
+                                top_files.append(entry.name)
+            except OSError:
+                # Entries vanishing mid-scan are simply not counted
+                continue
+        
+        # Prefer a top-level folder (album/pack name) over loose files
+        if top_dirs:
+            self.top_level = min(top_dirs)
+            self.top_level_is_dir = True
+        elif top_files:
+            self.top_level = min(top_files)
+    
+    def _add_file(self, name: str, size: int):
+        self.total_bytes += size
+        self.file_count += 1
+        ext = os.path.splitext(name)[1].lower() or "(none)"
+        counts = self.extensions.setdefault(ext, {"count": 0, "bytes": 0})
+        counts["count"] += 1
+        counts["bytes"] += size
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Per-extension breakdown for the log record, largest first"""
+        return dict(sorted(self.extensions.items(), key=lambda item: item[1]["bytes"], reverse=True))
+
+class MoveEngine:
+    """
+    Move download output into place with as little copying as possible:
+    rename within a filesystem, hardlink for archive copies, and kernel-side
+    copy_file_range/sendfile (falling back to buffered copies) across filesystems.
+    """
+    def __init__(self, on_progress=None, chunk_size: int = MOVE_CHUNK_SIZE):
+        self.on_progress = on_progress  # called with (bytes_copied, bytes_to_copy) during real copies
+        self.chunk_size = chunk_size
+        self.bytes_copied = 0
+        self.bytes_to_copy = 0
+        self.renamed = 0
+        self.linked = 0
+    
+    def move(self, src: str, dst: str):
+        """Move a file or directory to dst, merging into an existing directory"""
+        if os.path.isdir(dst) and os.path.isdir(src) and not os.path.islink(src):
+            for name in os.listdir(src):
+                self.move(os.path.join(src, name), os.path.join(dst, name))
+            os.rmdir(src)
+            return
+        try:
+            os.rename(src, dst)
+            self.renamed += 1
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        # Different filesystem: copy, then remove the source
+        if os.path.isdir(src) and not os.path.islink(src):
+            self.bytes_to_copy += TreeStats(src).total_bytes
+            shutil.copytree(src, dst, symlinks=True, copy_function=self.copy_file, dirs_exist_ok=True)
+            shutil.rmtree(src)
+        else:
+            self.bytes_to_copy += os.path.getsize(src)
+            self.copy_file(src, dst)
+            os.remove(src)
+    
+    def link(self, src: str, dst: str):
+        """Hardlink src at dst, copying if links aren't possible"""
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+            self.linked += 1
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+                raise
+        self.bytes_to_copy += os.path.getsize(src)
+        self.copy_file(src, dst)
+    
+    def _advance(self, nbytes: int):
+        self.bytes_copied += nbytes
+        if self.on_progress:
+            self.on_progress(self.bytes_copied, self.bytes_to_copy)
+    
+    def copy_file(self, src: str, dst: str):
+        """Copy one file's data in the kernel where possible, then its metadata"""
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            infd, outfd = fsrc.fileno(), fdst.fileno()
+            size = os.fstat(infd).st_size
+            copied = 0
+            for method in ("copy_file_range", "sendfile"):
+                if copied >= size or not hasattr(os, method):
+                    continue
+                # sendfile writes at the output position, so line it up with what's been copied
+                os.lseek(outfd, copied, os.SEEK_SET)
+                try:
+                    while copied < size:
+                        count = min(self.chunk_size, size - copied)
+                        if method == "copy_file_range":
+                            n = os.copy_file_range(infd, outfd, count, copied, copied)
+                        else:
+                            n = os.sendfile(outfd, infd, copied, count)
+                        if n == 0:
+                            break
+                        copied += n
+                        self._advance(n)
+                except OSError as e:
+                    if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                        raise
+            if copied < size:
+                # Plain buffered copy for whatever the kernel paths couldn't do
+                fsrc.seek(copied)
+                fdst.seek(copied)
+                while True:
+                    buffer = fsrc.read(self.chunk_size)
+                    if not buffer:
+                        break
+                    fdst.write(buffer)
+                    self._advance(len(buffer))
+        shutil.copystat(src, dst)
+
+class ContentIndex:
+    """
+    Persistent index of library and archive files keyed by size, with content hashes
+    filled in lazily: a file is only hashed once another file of the same size shows up.
+    """
+    SCHEMA_VERSION = 1
+    
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                hash TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_files_size ON files(size);
+        """)
+    
+    @staticmethod
+    def hash_file(path: str) -> str:
+        digest = hashlib.blake2b(digest_size=32)
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    def add(self, path: str, st: os.stat_result, digest: str = None):
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO files (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, hash = excluded.hash",
+                (path, st.st_size, st.st_mtime_ns, digest)
+            )
+    
+    def remove(self, path: str):
+        with self._lock:
+            self.conn.execute("DELETE FROM files WHERE path = ?", (path,))
+    
+    def find_duplicate(self, path: str, st: os.stat_result, digest: str = None):
+        """
+        Return (existing_path, hash) of an indexed file with the same content, or (None, hash).
+        digest is path's hash if the caller already knows it.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT path, mtime_ns, hash FROM files WHERE size = ? AND path != ?", (st.st_size, path)
+            ).fetchall()
+        if not rows:
+            return None, digest
+        
+        candidates = []
+        for other, mtime_ns, other_digest in rows:
+            try:
+                other_st = os.stat(other)
+            except OSError:
+                self.remove(other)
+                continue
+            if (other_st.st_dev, other_st.st_ino) == (st.st_dev, st.st_ino):
+                # Already the same file (hardlinked)
+                continue
+            if other_st.st_size != st.st_size:
+                self.add(other, other_st)
+                continue
+            if other_st.st_mtime_ns != mtime_ns:
+                # Rewritten since it was hashed
+                other_digest = None
+            candidates.append((other, other_st, other_digest))
+        if not candidates:
+            return None, digest
+        
+        digest = digest or self.hash_file(path)
+        for other, other_st, other_digest in candidates:
+            if other_digest is None:
+                other_digest = self.hash_file(other)
+                self.add(other, other_st, other_digest)
+            if other_digest == digest:
+                return other, digest
+        return None, digest
+    
+    def scan_once(self, roots, min_size: int, exclude=()):
+        """Index existing files under roots (sizes only) the first time the index is created"""
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+        rows = []
+        stack = [root for root in roots if os.path.isdir(root)]
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.path not in exclude:
+                                stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat(follow_symlinks=False)
+                            if st.st_size >= min_size:
+                                rows.append((entry.path, st.st_size, st.st_mtime_ns))
+            except OSError:
+                continue
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany("INSERT OR IGNORE INTO files (path, size, mtime_ns) VALUES (?, ?, ?)", rows)
+                self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        print(f"Indexed {len(rows)} existing files for deduplication")
+
+_shared_content_index = None
+_shared_content_index_lock = threading.Lock()
+
+def get_content_index():
+    """Return the process-wide ContentIndex (opened on first use, from the loop or a worker thread)"""
+    global _shared_content_index
+    if _shared_content_index is None:
+        with _shared_content_index_lock:
+            if _shared_content_index is None:
+                _shared_content_index = ContentIndex(DEDUP_INDEX_PATH)
+    return _shared_content_index
+
+class Deduplicator:
+    """
+    Apply DEDUP_MODE to one download's files: "link" replaces a file whose content is
+    already in the library/archives with a hardlink to it, "skip" drops it before it is moved.
+    """
+    def __init__(self, index: ContentIndex, mode: str = DEDUP_MODE, min_size: int = DEDUP_MIN_SIZE,
+                 known_digests: dict = None):
+        self.index = index
+        self.mode = mode
+        self.min_size = min_size
+        self.known_digests = known_digests or {}  # (st_dev, st_ino) -> hash already computed while downloading
+        self.files = 0
+        self.bytes_saved = 0
+    
+    def _files(self, path: str):
+        """Yield (path, lstat) for regular files under path that are large enough to dedupe"""
+        paths = [path] if not os.path.isdir(path) else (
+            os.path.join(root, name) for root, _, files in os.walk(path) for name in files
+        )
+        for file_path in paths:
+            st = os.lstat(file_path)
+            if stat.S_ISREG(st.st_mode) and st.st_size >= self.min_size:
+                yield file_path, st
+    
+    def before_move(self, path: str):
+        """Drop duplicates from a download's temp output before it is moved (skip mode)"""
+        if self.mode != "skip":
+            return
+        for file_path, st in list(self._files(path)):
+            existing, _ = self.index.find_duplicate(file_path, st, self.known_digests.get((st.st_dev, st.st_ino)))
+            if existing:
+                os.remove(file_path)
+                self.files += 1
+                self.bytes_saved += st.st_size
+                print(f"Skipped duplicate {file_path} (already at {existing})")
+        if os.path.isdir(path):
+            for root, _, _ in os.walk(path, topdown=False):
+                if not os.listdir(root):
+                    os.rmdir(root)
+    
+    def after_move(self, path: str):
+        """Hardlink duplicates in their final place (link mode) and add the files to the index"""
+        if self.mode not in ("link", "skip"):
+            return
+        for file_path, st in list(self._files(path)):
+            digest = self.known_digests.get((st.st_dev, st.st_ino))
+            if self.mode == "link":
+                existing, digest = self.index.find_duplicate(file_path, st, digest)
+                if existing and self._link(existing, file_path):
+                    self.files += 1
+                    self.bytes_saved += st.st_size
+                    st = os.lstat(file_path)
+            self.index.add(file_path, st, digest or self.known_digests.get((st.st_dev, st.st_ino)))
+    
+    def _link(self, existing: str, path: str) -> bool:
+        temp_link = f"{path}.dedup"
+        try:
+            os.link(existing, temp_link)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+                raise
+            return False
+        os.replace(temp_link, path)
+        return True
+    
+    def summary(self) -> Dict[str, Any]:
+        return {"mode": self.mode, "files": self.files, "bytes_saved": self.bytes_saved}
+
+class BandwidthLimiter:
+    """Token bucket shared by all in-process transfers to cap total throughput"""
+    def __init__(self, rate: int):
+        self.rate = rate  # bytes per second
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def consume(self, nbytes: int):
+        """Account for nbytes just transferred, sleeping if we're over the cap"""
+        async with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= nbytes
+            if self.tokens < 0:
+                # Holding the lock while sleeping makes waiters take turns
+                await asyncio.sleep(-self.tokens / self.rate)
+
+def _filename_from_response(url: str, content_disposition: str = None) -> str:
+    """Pick a safe file name from Content-Disposition or the URL path"""
+    name = None
+    if content_disposition:
+        # RFC 5987 filename* takes precedence over the plain filename parameter
+        m = re.search(r"filename\*\s*=\s*[^']*'[^']*'([^;]+)", content_disposition, re.IGNORECASE)
+        if m:
+            name = unquote(m.group(1).strip().strip('"'))
+        else:
+            m = re.search(r'filename\s*=\s*"?([^";]+)"?', content_disposition, re.IGNORECASE)
+            if m:
+                name = m.group(1).strip()
+    if not name:
+        name = unquote(os.path.basename(urlparse(url).path))
+    name = os.path.basename(name.replace("\\", "/")).strip()
+    if name in ("", ".", ".."):
+        name = "download"
+    return name
+
+class ExtractionUnsupported(Exception):
+    """The archive can't be extracted in streaming mode; fall back to extracting the finished file"""
+
+def _safe_join(base: str, name: str) -> str:
+    """Join an archive member name onto base, refusing paths that escape it"""
+    target = os.path.realpath(os.path.join(base, name.lstrip("/\\")))
+    if os.path.commonpath([os.path.realpath(base), target]) != os.path.realpath(base):
+        raise Exception(f"Unsafe path in archive: {name}")
+    return target
+
+def archive_format(file_name: str):
+    """
+    Classify an archive by name: 'zip', 'tar', 'gzip', 'bz2', 'xz', '7z' or 'rar'.
+    Multi-part sets are identified by their first volume; later volumes return None.
+    """
+    name = file_name.lower()
+    m = re.search(r"\.part(\d+)\.rar$", name)
+    if m:
+        return "rar" if int(m.group(1)) == 1 else None
+    m = re.search(r"\.(7z|zip|rar)\.(\d{3})$", name)
+    if m:
+        # Split volumes (.001, .002, ...) are joined by 7z/unrar
+        return ("rar" if m.group(1) == "rar" else "7z") if int(m.group(2)) == 1 else None
+    if name.endswith((".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")):
+        return "tar"
+    for suffix, kind in ((".zip", "zip"), (".7z", "7z"), (".rar", "rar"), (".gz", "gzip"), (".bz2", "bz2"), (".xz", "xz")):
+        if name.endswith(suffix):
+            return kind
+    return None
+
+def is_archive_file(file_name: str) -> bool:
+    """True for any archive or archive volume (including continuation parts)"""
+    name = file_name.lower()
+    return archive_format(name) is not None or bool(
+        re.search(r"\.part\d+\.rar$|\.r\d{2}$|\.z\d{2}$|\.(7z|zip|rar)\.\d{3}$", name)
+    )
+
+def _extract_tar_members(tar, extract_dir: str, on_entry=None):
+    """Extract tar members one by one, refusing links and paths that escape extract_dir"""
+    for member in tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extract(member, extract_dir, filter="data")
+        else:
+            if member.issym() or member.islnk() or member.isdev():
+                continue
+            _safe_join(extract_dir, member.name)
+            tar.extract(member, extract_dir)
+        if member.isfile() and on_entry:
+            on_entry(member.name)
+
+class ArchiveExtractor:
+    """
+    Extract every archive in a download directory.
+    zip/tar/gz/bz2/xz are unpacked in-process on a bounded thread pool; 7z and rar
+    go to the 7z/unrar tools. Multi-part sets are extracted once from their first
+    volume, and archives found in the output are unpacked in place (up to EXTRACT_MAX_DEPTH).
+    """
+    NATIVE_FORMATS = ("zip", "tar", "gzip", "bz2", "xz")
+    
+    def __init__(self, source_dir: str, extract_dir: str, on_entry=None, skip=()):
+        self.source_dir = source_dir
+        self.extract_dir = extract_dir
+        self.on_entry = on_entry  # called (possibly from a worker thread) with each extracted name
+        self.skip = set(skip)
+        self.extracted = []
+        self.failed = []
+    
+    async def run(self) -> list:
+        """Extract top-level archives concurrently, then any nested ones. Returns extracted paths."""
+        top_level = [
+            os.path.join(self.source_dir, name) for name in sorted(os.listdir(self.source_dir))
+            if name not in self.skip and os.path.isfile(os.path.join(self.source_dir, name)) and archive_format(name)
+        ]
+        await asyncio.gather(*(self._extract(path, self.extract_dir) for path in top_level))
+        
+        for _ in range(EXTRACT_MAX_DEPTH):
+            nested = await run_fs(lambda: [
+                os.path.join(root, name)
+                for root, _, files in os.walk(self.extract_dir)
+                for name in files
+                if archive_format(name) and os.path.join(root, name) not in self.failed
+            ])
+            if not nested:
+                break
+            results = await asyncio.gather(*(
+                self._extract(path, os.path.join(os.path.dirname(path), self._stem(os.path.basename(path))))
+                for path in nested
+            ))
+            for path, ok in zip(nested, results):
+                if ok:
+                    # The nested archive's contents replace it (every volume of a multi-part set)
+                    for volume in [path] + await run_fs(self._other_volumes, path):
+                        await run_fs(os.remove, volume)
+        return self.extracted
+    
+    @staticmethod
+    def _other_volumes(path: str) -> list:
+        """The continuation volumes next to a multi-part set's first volume"""
+        directory, name = os.path.split(path)
+        m = (re.match(r"(.*)\.part\d+\.rar$", name, re.IGNORECASE)
+             or re.match(r"(.*\.(?:7z|zip|rar))\.\d{3}$", name, re.IGNORECASE))
+        if m:
+            suffix = r"\.part\d+\.rar" if name.lower().endswith(".rar") else r"\.\d{3}"
+        else:
+            m = re.match(r"(.*)\.(rar|zip)$", name, re.IGNORECASE)
+            if not m:
+                return []
+            # Old-style rar (.r00, .r01, ...) and split zip (.z01, .z02, ...) continuations
+            suffix = r"\.r\d{2}" if m.group(2).lower() == "rar" else r"\.z\d{2}"
+        pattern = re.compile(re.escape(m.group(1)) + suffix + "$", re.IGNORECASE)
+        return [
+            os.path.join(directory, other) for other in os.listdir(directory)
+            if other != name and pattern.match(other) and is_archive_file(other)
+        ]
+    
+    @staticmethod
+    def _stem(file_name: str) -> str:
+        stem = re.sub(r"(\.part\d+)?\.(tar\.gz|tar\.bz2|tar\.xz|tgz|tbz2|txz|tar|zip|7z|rar|gz|bz2|xz)(\.\d{3})?$", "",
+                      file_name, flags=re.IGNORECASE)
+        return stem or file_name
+    
+    async def _extract(self, path: str, dest: str) -> bool:
+        kind = archive_format(os.path.basename(path))
+        # Split zips (.z01, .z02, ... + .zip) need 7z
+        if kind == "zip" and glob.glob(glob.escape(path[:-4]) + ".z[0-9][0-9]"):
+            kind = "7z"
+        async with EXTRACT_SLOTS:
+            try:
+                os.makedirs(dest, exist_ok=True)
+                if kind in self.NATIVE_FORMATS:
+                    await asyncio.get_running_loop().run_in_executor(EXTRACT_POOL, self._extract_native, path, dest, kind)
+                else:
+                    await self._extract_external(path, dest, kind)
+                self.extracted.append(path)
+                return True
+            except Exception as e:
+                print(f"Error extracting {os.path.basename(path)}: {e}")
+                self.failed.append(path)
+                return False
+    
+    def _entry(self, name: str):
+        if self.on_entry:
+            self.on_entry(name)
     
-    # If no scheme, assume https
-    if not parsed.scheme:
-        return f"https://{url}"
+    def _extract_native(self, path: str, dest: str, kind: str):
+        if kind == "zip":
+            with zipfile.ZipFile(path) as archive:
+                for info in archive.infolist():
+                    # ZipFile.extract strips absolute paths and '..' components
+                    archive.extract(info, dest)
+                    if not info.is_dir():
+                        self._entry(info.filename)
+        elif kind == "tar" or tarfile.is_tarfile(path):
+            with tarfile.open(path, "r:*") as tar:
+                _extract_tar_members(tar, dest, self._entry)
+        else:
+            # Single compressed file
+            opener = {"gzip": gzip.open, "bz2": bz2.open, "xz": lzma.open}[kind]
+            target = os.path.join(dest, os.path.splitext(os.path.basename(path))[0])
+            with opener(path, "rb") as src, open(target, "wb") as out:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+            self._entry(os.path.basename(target))
     
-    # For other schemes, convert to https
-    return f"https://{parsed.netloc or url}"
+    async def _extract_external(self, path: str, dest: str, kind: str):
+        if kind == "rar" and shutil.which("unrar"):
+            command = ["unrar", "x", "-o+", "-y", path, dest + os.sep]
+        else:
+            tool = shutil.which("7z") or shutil.which("7za") or shutil.which("7zz")
+            if not tool:
+                raise Exception(f"No tool available to extract {kind} archives (install 7z or unrar)")
+            command = [tool, "x", "-y", f"-o{dest}", path]
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.DEVNULL
+        )
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise Exception(f"{os.path.basename(command[0])} exited with {process.returncode}: "
+                            f"{stderr.decode(errors='ignore').strip()[-200:]}")
+        self._entry(os.path.basename(path))
 
-def get_service_icon(service: str) -> str:
-    """Get the icon URL for a service"""
-    icons = {
-        "MEGA": "https://github.com/slink-y/zurg/blob/main/assets/icons/mega.png?raw=true",
-        "ffsend": "https://github.com/slink-y/zurg/blob/main/assets/icons/ffsend.png?raw=true",
-        "Direct Download": "https://github.com/slink-y/zurg/blob/main/assets/icons/direct.png?raw=true"
-    }
-    return icons.get(service, "https://github.com/slink-y/zurg/blob/main/assets/icons/direct.png?raw=true")
+def streaming_archive_kind(file_name: str):
+    """Return 'tar' or 'zip' if the file can be extracted while it downloads, else None"""
+    kind = archive_format(file_name)
+    return kind if kind in ("tar", "zip") else None
 
+class _GrowingFileReader(io.RawIOBase):
+    """Sequential reader over a file that is still being written; blocks until bytes are available"""
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.position = 0
+        self.pushed_back = b""
+        self._fd = None
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        if self.pushed_back:
+            n = min(len(buffer), len(self.pushed_back))
+            buffer[:n] = self.pushed_back[:n]
+            self.pushed_back = self.pushed_back[n:]
+            return n
+        available = self.extractor.wait_for(self.position + 1)
+        if available <= self.position:
+            return 0
+        if self._fd is None:
+            self._fd = os.open(self.extractor.path, os.O_RDONLY)
+        data = os.pread(self._fd, min(len(buffer), available - self.position), self.position)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+    
+    def read_exact(self, n: int) -> bytes:
+        data = bytearray()
+        while len(data) < n:
+            chunk = self.read(n - len(data))
+            if not chunk:
+                raise ExtractionUnsupported("Archive ended unexpectedly")
+            data += chunk
+        return bytes(data)
+    
+    def unread(self, data: bytes):
+        self.pushed_back = data + self.pushed_back
+    
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        super().close()
 
-def _parse_size_to_mb(size_str: str) -> float:
-    """Parse a size string like '21.26 MB', '12 KiB', '1.5 GB' into MB (float)."""
-    try:
-        parts = size_str.strip().split()
-        if not parts:
-            return 0.0
-        value = float(parts[0].replace(',', '.'))
-        unit = parts[1].lower() if len(parts) > 1 else 'mb'
-        if unit in ('b', 'bytes'):
-            return value / (1024 * 1024)
-        if unit in ('kb', 'kib'):
-            return value / 1024
-        if unit in ('mb', 'mib'):
-            return value
-        if unit in ('gb', 'gib'):
-            return value * 1024
-    except Exception:
-        return 0.0
-    return 0.0
+class StreamingExtractor:
+    """
+    Extract a tar or zip archive while it is still being downloaded.
+    A worker thread reads the contiguous, already-written prefix of the file,
+    so the archive itself stays on disk untouched for storage. The worker spends
+    most of the download waiting for bytes, so it gets its own thread rather than
+    one of EXTRACT_POOL's, which finished archives queue for.
+    """
+    def __init__(self, path: str, extract_dir: str, kind: str, on_entry=None):
+        self.path = path
+        self.extract_dir = extract_dir
+        self.kind = kind
+        self.on_entry = on_entry  # called from the worker thread with each extracted member name
+        self.entries = 0
+        self.error = None
+        self._available = 0
+        self._finished = False
+        self._aborted = False
+        self._cond = threading.Condition()
+        self._future = None
+    
+    def start(self):
+        os.makedirs(self.extract_dir, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        self._future = loop.create_future()
+        
+        def worker():
+            try:
+                self._run()
+            finally:
+                loop.call_soon_threadsafe(lambda: self._future.done() or self._future.set_result(None))
+        threading.Thread(target=worker, name="stream-extract", daemon=True).start()
+    
+    def feed(self, available: int):
+        """Tell the worker that the first `available` bytes of the file are written"""
+        with self._cond:
+            if available > self._available:
+                self._available = available
+                self._cond.notify_all()
+    
+    def wait_for(self, needed: int) -> int:
+        """Block until `needed` bytes are available or the download ends; returns bytes available"""
+        with self._cond:
+            while self._available < needed and not self._finished:
+                self._cond.wait()
+            if self._aborted:
+                raise ExtractionUnsupported("Download was aborted")
+            return self._available
+    
+    async def finish(self, ok: bool = True) -> bool:
+        """Signal end of download and wait for the worker. Returns True if extraction completed."""
+        with self._cond:
+            self._finished = True
+            self._aborted = not ok
+            self._cond.notify_all()
+        if self._future is None:
+            return False
+        await self._future
+        return ok and self.error is None
+    
+    def _entry_done(self, name: str):
+        self.entries += 1
+        if self.on_entry:
+            self.on_entry(name)
+    
+    def _run(self):
+        reader = _GrowingFileReader(self)
+        try:
+            if self.kind == "tar":
+                self._extract_tar(reader)
+            else:
+                self._extract_zip(reader)
+        except Exception as e:
+            self.error = e
+            if not self._aborted:
+                print(f"Streaming extraction of {os.path.basename(self.path)} stopped: {e}")
+            # Leave a clean slate for the regular extraction pass
+            shutil.rmtree(self.extract_dir, ignore_errors=True)
+            os.makedirs(self.extract_dir, exist_ok=True)
+        finally:
+            reader.close()
+    
+    def _extract_tar(self, reader):
+        with tarfile.open(fileobj=reader, mode="r|*") as tar:
+            _extract_tar_members(tar, self.extract_dir, self._entry_done)
+    
+    def _extract_zip(self, reader):
+        """Walk zip local file headers in order (stored and deflated entries only)"""
+        seen = 0
+        while True:
+            signature = reader.read_exact(4)
+            if signature in (b"PK\x01\x02", b"PK\x05\x06") and seen:
+                # Central directory (or end record) reached: every entry has been seen
+                return
+            if signature != b"PK\x03\x04":
+                # Self-extracting or prefixed zips, or not a zip at all: leave it to the regular pass
+                raise ExtractionUnsupported("Archive does not start with zip entries")
+            seen += 1
+            (_, flags, method, _, _, crc, compressed_size, _, name_len, extra_len) = \
+                struct.unpack("<HHHHHIIIHH", reader.read_exact(26))
+            raw_name = reader.read_exact(name_len)
+            extra = reader.read_exact(extra_len)
+            name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+            if flags & 0x1:
+                raise ExtractionUnsupported("Encrypted zip entries")
+            zip64 = False
+            pos = 0
+            while pos + 4 <= len(extra):
+                header_id, size = struct.unpack("<HH", extra[pos:pos + 4])
+                if header_id == 0x0001:
+                    zip64 = True
+                    if compressed_size == 0xFFFFFFFF and size >= 16:
+                        compressed_size = struct.unpack("<Q", extra[pos + 12:pos + 20])[0]
+                pos += 4 + size
+            has_descriptor = bool(flags & 0x8)
+            
+            target = _safe_join(self.extract_dir, name)
+            if name.endswith("/"):
+                os.makedirs(target, exist_ok=True)
+                out = None
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                out = open(target, "wb")
+            try:
+                checksum = 0
+                if method == 0:
+                    if has_descriptor:
+                        raise ExtractionUnsupported("Stored entry with unknown size")
+                    remaining = compressed_size
+                    while remaining:
+                        chunk = reader.read(min(remaining, DIRECT_CHUNK_SIZE))
+                        if not chunk:
+                            raise ExtractionUnsupported("Archive ended unexpectedly")
+                        remaining -= len(chunk)
+                        checksum = zlib.crc32(chunk, checksum)
+                        if out:
+                            out.write(chunk)
+                elif method == 8:
+                    decompressor = zlib.decompressobj(-15)
+                    remaining = None if has_descriptor else compressed_size
+                    while not decompressor.eof:
+                        chunk = reader.read(DIRECT_CHUNK_SIZE if remaining is None else min(remaining, DIRECT_CHUNK_SIZE))
+                        if not chunk:
+                            raise ExtractionUnsupported("Archive ended unexpectedly")
+                        if remaining is not None:
+                            remaining -= len(chunk)
+                        data = decompressor.decompress(chunk)
+                        checksum = zlib.crc32(data, checksum)
+                        if out:
+                            out.write(data)
+                    # The deflate stream ends on its own; hand back what belongs to the next record
+                    if decompressor.unused_data:
+                        reader.unread(decompressor.unused_data)
+                else:
+                    raise ExtractionUnsupported(f"Zip compression method {method}")
+            finally:
+                if out:
+                    out.close()
+            
+            if has_descriptor:
+                descriptor = reader.read_exact(4)
+                if descriptor == b"PK\x07\x08":
+                    descriptor = reader.read_exact(4)
+                crc = struct.unpack("<I", descriptor)[0]
+                reader.read_exact(16 if zip64 else 8)
+            if checksum != crc:
+                raise Exception(f"CRC mismatch in {name}")
+            if out:
+                self._entry_done(name)
 
-def generate_download_id():
-    """Generate a unique download ID"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_id = str(uuid.uuid4())[:8]
-    return f"dl_{timestamp}_{unique_id}"
+class RangeIgnored(Exception):
+    """The server answered a range request with the whole, unchanged file; download it as one stream"""
 
-class DownloadHistory:
-    """Manage download history and logging"""
-    def __init__(self):
-        self.history_file = "/mnt/transformer/logs/downloads.json"
-        self.ensure_logs_directory()
+class DirectDownloader:
+    """
+    In-process HTTP(S) downloader.
+    Probes the URL, then fetches large files as concurrent Range segments written
+    into a preallocated file, or as a single stream when ranges aren't supported.
+    Ranged downloads keep a checkpoint next to the .part file so they can resume
+    after dropped connections or a bot restart.
+    """
+    PART_SUFFIX = ".part"
+    CHECKPOINT_SUFFIX = ".checkpoint.json"
     
-    def ensure_logs_directory(self):
-        """Ensure logs directory exists"""
-        os.makedirs("/mnt/transformer/logs", exist_ok=True)
-        os.makedirs("/mnt/transformer/tmp", exist_ok=True)
-        os.makedirs("/mnt/transformer/storage/archives", exist_ok=True)
+    def __init__(self, url: str, dest_dir: str, segments: int = DIRECT_SEGMENTS,
+                 min_segment_size: int = DIRECT_MIN_SEGMENT_SIZE, max_retries: int = DIRECT_MAX_RETRIES,
+                 on_progress=None, limiter: BandwidthLimiter = None, on_probe=None):
+        self.requested_url = url
+        self.url = url
+        self.dest_dir = dest_dir
+        self.segments = max(1, segments)
+        self.min_segment_size = min_segment_size
+        self.max_retries = max_retries
+        self.on_progress = on_progress  # called with (downloaded_bytes, total_bytes or None)
+        self.limiter = limiter
+        self.on_probe = on_probe  # called with the downloader once name and size are known
+        self.stream_consumer = None  # optional object with feed(contiguous_bytes), e.g. a StreamingExtractor
+        self.file_name = None
+        self.path = None
+        self.part_path = None
+        self.checkpoint_path = None
+        self.total_size = None
+        self.downloaded = 0
+        self.accepts_ranges = False
+        self.etag = None
+        self.last_modified = None
+        self.resumed_bytes = 0
+        self.allocated = 0  # bytes preallocated for the .part file
+        self.segment_state = []  # [start, end, next_position] per segment; bytes start..next_position-1 are on disk
+    
+    async def probe(self, session: aiohttp.ClientSession):
+        """Learn the final URL, name, size and range support (HEAD, falling back to a 1-byte GET)"""
+        async with session.head(self.url, allow_redirects=True) as resp:
+            if resp.status < 400:
+                self._apply_headers(str(resp.url), resp.headers, resp.status)
+                return
+        # Some servers reject HEAD; a zero-offset range request tells us the same things
+        async with session.get(self.url, headers={"Range": "bytes=0-0"}, allow_redirects=True) as resp:
+            if resp.status >= 400:
+                raise Exception(f"HTTP {resp.status} from server")
+            self._apply_headers(str(resp.url), resp.headers, resp.status)
+    
+    def _apply_headers(self, final_url: str, headers, status: int):
+        self.url = final_url
+        self.file_name = _filename_from_response(final_url, headers.get("Content-Disposition"))
+        self.etag = headers.get("ETag")
+        self.last_modified = headers.get("Last-Modified")
+        if status == 206:
+            # Content-Range: bytes 0-0/12345
+            content_range = headers.get("Content-Range", "")
+            total = content_range.rsplit("/", 1)[-1]
+            self.total_size = int(total) if total.isdigit() else None
+            self.accepts_ranges = True
+        else:
+            length = headers.get("Content-Length")
+            self.total_size = int(length) if length and length.isdigit() else None
+            self.accepts_ranges = headers.get("Accept-Ranges", "").lower() == "bytes"
+        # Compressed transfer sizes don't match the bytes we write
+        if headers.get("Content-Encoding", "identity").lower() not in ("identity", ""):
+            self.total_size = None
+            self.accepts_ranges = False
+    
+    async def run(self) -> str:
+        """Download the URL into dest_dir and return the file path"""
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+        async with aiohttp.ClientSession(timeout=timeout, auto_decompress=False) as session:
+            await self.probe(session)
+            self.path = os.path.join(self.dest_dir, self.file_name)
+            self.part_path = self.path + self.PART_SUFFIX
+            self.checkpoint_path = self.path + self.CHECKPOINT_SUFFIX
+            if self.on_probe:
+                self.on_probe(self)
+            
+            if self.accepts_ranges and self.total_size:
+                try:
+                    await self._download_ranged(session)
+                except RangeIgnored as e:
+                    print(f"{e}; downloading {self.file_name} as a single stream")
+                    self.accepts_ranges = False
+                    self.segment_state = []
+                    self.allocated = 0
+                    if os.path.exists(self.checkpoint_path):
+                        os.remove(self.checkpoint_path)
+                    await self._download_single(session)
+            else:
+                await self._download_single(session)
         
-        # Initialize downloads.json if it doesn't exist
-        if not os.path.exists(self.history_file):
-            with open(self.history_file, 'w') as f:
-                json.dump({"downloads": []}, f, indent=2)
+        if self.total_size is not None and self.downloaded != self.total_size:
+            raise Exception(f"Incomplete download: {self.downloaded} of {self.total_size} bytes")
+        os.replace(self.part_path, self.path)
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        return self.path
     
-    def add_download(self, log_data):
-        """Add a download to the history"""
-        with open(self.history_file, 'r') as f:
-            data = json.load(f)
+    def _advance(self, nbytes: int):
+        self.downloaded += nbytes
+        if self.on_progress:
+            self.on_progress(self.downloaded, self.total_size)
+        if self.stream_consumer:
+            self.stream_consumer.feed(self.contiguous_bytes())
+    
+    def contiguous_bytes(self) -> int:
+        """Length of the prefix of the .part file that is fully written"""
+        if not self.segment_state:
+            return self.downloaded
+        for start, end, position in self.segment_state:
+            if position <= end:
+                return position
+        return self.total_size
+    
+    async def _download_single(self, session: aiohttp.ClientSession):
+        """Stream the whole body sequentially, restarting from zero on connection errors"""
+        attempt = 0
+        while True:
+            if self.downloaded and self.stream_consumer:
+                # A restarted stream rewrites the file from zero, so a streaming reader can't continue
+                asyncio.ensure_future(self.stream_consumer.finish(ok=False))
+                self.stream_consumer = None
+            self.downloaded = 0
+            fd = os.open(self.part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                async with session.get(self.url) as resp:
+                    if resp.status >= 400:
+                        raise Exception(f"HTTP {resp.status} from server")
+                    async for chunk in resp.content.iter_chunked(DIRECT_CHUNK_SIZE):
+                        await run_fs_write(os.write, fd, chunk)
+                        self._advance(len(chunk))
+                        if self.limiter:
+                            await self.limiter.consume(len(chunk))
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise Exception(f"Download failed after {attempt} attempts: {e}")
+                print(f"Direct download interrupted ({e}), restarting (attempt {attempt}/{self.max_retries})")
+                await asyncio.sleep(min(30, 2 ** attempt))
+            finally:
+                os.close(fd)
+        if self.total_size is None:
+            self.total_size = self.downloaded
+    
+    async def _download_ranged(self, session: aiohttp.ClientSession):
+        """Fetch the file as byte ranges, resuming from a valid checkpoint if there is one"""
+        resumed = self._load_checkpoint()
+        fd = os.open(self.part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if not resumed:
+                await run_fs(self._preallocate, fd)
+                parts = max(1, min(self.segments, self.total_size // self.min_segment_size))
+                segment_size = -(-self.total_size // parts)
+                self.segment_state = [
+                    [start, min(start + segment_size, self.total_size) - 1, start]
+                    for start in range(0, self.total_size, segment_size)
+                ]
+            self.downloaded = sum(position - start for start, _, position in self.segment_state)
+            self.resumed_bytes = self.downloaded
+            if resumed:
+                # Only count what the earlier run actually got onto disk (fallocate may have failed)
+                self.allocated = min(self.total_size, os.fstat(fd).st_blocks * 512)
+                print(f"Resuming {self.file_name} at {self.downloaded}/{self.total_size} bytes")
+                self._advance(0)
+            
+            saver = asyncio.create_task(self._checkpoint_loop(fd))
+            tasks = [
+                asyncio.create_task(self._fetch_segment(session, fd, segment))
+                for segment in self.segment_state if segment[2] <= segment[1]
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                # Record how far we got so the next attempt picks up from here
+                await self._save_checkpoint(fd)
+                raise
+            finally:
+                saver.cancel()
+        finally:
+            os.close(fd)
+    
+    def _preallocate(self, fd: int):
+        """Size the .part file for the whole download, reserving its blocks where the filesystem can"""
+        os.ftruncate(fd, 0)
+        try:
+            os.posix_fallocate(fd, 0, self.total_size)
+            self.allocated = self.total_size
+        except (AttributeError, OSError):
+            # Sparse file: bytes only take up disk as they are written
+            os.ftruncate(fd, self.total_size)
+    
+    async def _fetch_segment(self, session: aiohttp.ClientSession, fd: int, segment: list):
+        """Download one segment, retrying from its current position after connection errors"""
+        attempt = 0
+        while segment[2] <= segment[1]:
+            position_before = segment[2]
+            try:
+                await self._fetch_range(session, fd, segment)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+                # Only consecutive failures without progress count against the retry budget
+                attempt = attempt + 1 if segment[2] == position_before else 1
+                if attempt > self.max_retries:
+                    raise Exception(f"Segment {segment[0]}-{segment[1]} failed after {attempt} attempts: {e}")
+                print(f"Segment {segment[0]}-{segment[1]} interrupted at {segment[2]} ({e}), retrying")
+                await asyncio.sleep(min(30, 2 ** attempt))
+    
+    async def _fetch_range(self, session: aiohttp.ClientSession, fd: int, segment: list):
+        """Fetch the rest of a segment and write it at its offset"""
+        start, end, position = segment
+        headers = {"Range": f"bytes={position}-{end}"}
+        validator = self._if_range_validator()
+        if validator:
+            # The server sends the whole (changed) file instead of a 206 if the validator no longer matches
+            headers["If-Range"] = validator
+        async with session.get(self.url, headers=headers) as resp:
+            if resp.status == 200 and self._unchanged(resp.headers):
+                raise RangeIgnored(f"Server ignored range request (HTTP {resp.status})")
+            if resp.status != 206:
+                raise Exception(f"Server ignored range request or file changed (HTTP {resp.status})")
+            async for chunk in resp.content.iter_chunked(DIRECT_CHUNK_SIZE):
+                chunk = chunk[:end + 1 - segment[2]]
+                await run_fs_write(os.pwrite, fd, chunk, segment[2])
+                segment[2] += len(chunk)
+                self._advance(len(chunk))
+                if segment[2] > end:
+                    break
+                if self.limiter:
+                    await self.limiter.consume(len(chunk))
+        if segment[2] <= end:
+            raise aiohttp.ClientPayloadError(f"Segment {start}-{end} ended early at byte {segment[2]}")
+    
+    def _if_range_validator(self) -> Optional[str]:
+        """If-Range only accepts a strong ETag (servers ignore the range for a weak one); else Last-Modified"""
+        if self.etag and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified
+    
+    def _unchanged(self, headers) -> bool:
+        """Whether a response's validators still match the probed file (missing ones count as matching)"""
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        if etag and self.etag:
+            return etag == self.etag
+        if last_modified and self.last_modified:
+            return last_modified == self.last_modified
+        return True
+    
+    async def _checkpoint_loop(self, fd: int):
+        while True:
+            await asyncio.sleep(DIRECT_CHECKPOINT_INTERVAL)
+            try:
+                await self._save_checkpoint(fd)
+            except OSError as e:
+                print(f"Error saving download checkpoint: {e}")
+    
+    async def _save_checkpoint(self, fd: int):
+        """Flush written bytes to disk, then atomically record which ranges are complete"""
+        # Snapshot positions before syncing so the checkpoint never claims unsynced bytes
+        segments = [list(segment) for segment in self.segment_state]
+        await run_fs(os.fdatasync, fd)
+        checkpoint = {
+            "url": self.requested_url,
+            "final_url": self.url,
+            "file_name": self.file_name,
+            "total_size": self.total_size,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "segments": segments,
+        }
+        await run_fs(_write_atomic, self.checkpoint_path, json.dumps(checkpoint).encode())
+    
+    def _load_checkpoint(self) -> bool:
+        """Restore segment state if the checkpoint matches the remote file as it is now"""
+        if not (os.path.exists(self.checkpoint_path) and os.path.exists(self.part_path)):
+            return False
+        try:
+            with open(self.checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return False
         
-        data["downloads"].append(log_data)
+        same_url = self.requested_url in (checkpoint.get("url"), checkpoint.get("final_url"))
+        same_size = checkpoint.get("total_size") == self.total_size
+        if self.etag and checkpoint.get("etag"):
+            unchanged = checkpoint["etag"] == self.etag
+        elif self.last_modified and checkpoint.get("last_modified"):
+            unchanged = checkpoint["last_modified"] == self.last_modified
+        else:
+            # Nothing to validate against, so partial data can't be trusted
+            unchanged = False
+        if not (same_url and same_size and unchanged):
+            print(f"Discarding checkpoint for {self.file_name}: remote file changed or can't be validated")
+            return False
         
-        with open(self.history_file, 'w') as f:
-            json.dump(data, f, indent=2)
-    
-    def save_individual_log(self, download_id, log_data):
-        """Save individual log file"""
-        individual_log_path = f"/mnt/transformer/logs/{download_id}.json"
-        with open(individual_log_path, 'w') as f:
-            json.dump(log_data, f, indent=2)
-    
-    def save_archive_log(self, download_id, log_data):
-        """Save log with archive"""
-        archive_dir = f"/mnt/transformer/storage/archives/{download_id}"
-        os.makedirs(archive_dir, exist_ok=True)
+        self.segment_state = [list(segment) for segment in checkpoint.get("segments", [])]
+        return bool(self.segment_state)
+    
+    @classmethod
+    def find_checkpoint(cls, url: str, search_root: str, exclude=()):
+        """Find a checkpoint for `url` in any download dir under search_root. Returns its path or None."""
+        for path in glob.glob(os.path.join(search_root, "*", f"*{cls.CHECKPOINT_SUFFIX}")):
+            if os.path.basename(os.path.dirname(path)) in exclude:
+                continue
+            try:
+                with open(path, 'r') as f:
+                    checkpoint = json.load(f)
+            except (OSError, ValueError):
+                continue
+            part_path = path[:-len(cls.CHECKPOINT_SUFFIX)] + cls.PART_SUFFIX
+            if checkpoint.get("url") == url and os.path.exists(part_path):
+                return path
+        return None
+
+def _b64url_decode(data: str) -> bytes:
+    data = data.replace("-", "+").replace("_", "/").replace(",", "")
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+def _parse_mega_link(url: str):
+    """Return (kind, handle, key_bytes) for a MEGA file/folder link, or None"""
+    parsed = urlparse(url)
+    match = re.match(r"^/(file|folder)/([\w-]+)", parsed.path)
+    if match:
+        kind, handle, key = match.group(1), match.group(2), parsed.fragment.split("/")[0]
+    else:
+        match = re.match(r"^(F?)!([\w-]+)!([\w-]+)", parsed.fragment)
+        if not match:
+            return None
+        kind, handle, key = ("folder" if match.group(1) else "file"), match.group(2), match.group(3)
+    try:
+        return kind, handle, _b64url_decode(key) if key else b""
+    except ValueError:
+        return kind, handle, b""
+
+def _mega_node_key(key: bytes) -> bytes:
+    """File keys are 32 bytes: the AES key is the XOR of the two halves"""
+    if len(key) == 32:
+        return bytes(a ^ b for a, b in zip(key[:16], key[16:]))
+    return key[:16]
+
+def _mega_decrypt_name(attributes: str, key: bytes) -> Optional[str]:
+    """Decrypt a node's 'MEGA{...}' attribute block and return its name (needs cryptography)"""
+    if Cipher is None or not attributes or len(key) != 16:
+        return None
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(b"\0" * 16)).decryptor()
+    data = _b64url_decode(attributes)
+    data = data[:len(data) - len(data) % 16]
+    plain = (decryptor.update(data) + decryptor.finalize()).rstrip(b"\0")
+    if not plain.startswith(b"MEGA{"):
+        return None
+    return json.loads(plain[4:].decode("utf-8", errors="replace")).get("n")
+
+class SendUnsupported(Exception):
+    """The native Send client can't handle this link; the ffsend binary should be used instead"""
+
+def _hkdf_expand(prk: bytes, info: bytes, length: int) -> bytes:
+    output, block, counter = b"", b"", 1
+    while len(output) < length:
+        block = hmac.new(prk, block + info + bytes([counter]), hashlib.sha256).digest()
+        output += block
+        counter += 1
+    return output[:length]
+
+def _hkdf(ikm: bytes, info: bytes, length: int, salt: bytes = b"") -> bytes:
+    """HKDF-SHA256 (RFC 5869); an empty salt is the same as HashLen zero bytes"""
+    return _hkdf_expand(hmac.new(salt, ikm, hashlib.sha256).digest(), info, length)
+
+def _aes_gcm_decrypt(key: bytes, nonce: bytes, data: bytes) -> bytes:
+    """Decrypt ciphertext with its 16-byte tag appended"""
+    decryptor = Cipher(algorithms.AES(key), modes.GCM(nonce, data[-16:])).decryptor()
+    return decryptor.update(data[:-16]) + decryptor.finalize()
+
+def _parse_send_link(url: str):
+    """https://<host>/download/<id>/#<secret> -> (origin, file id, 16-byte secret), or None"""
+    parsed = urlparse(url)
+    match = re.match(r"^/download/([\w-]+)/?$", parsed.path)
+    if not match or not re.fullmatch(r"[\w-]{22}", parsed.fragment):
+        return None
+    return f"{parsed.scheme}://{parsed.netloc}", match.group(1), _b64url_decode(parsed.fragment)
+
+class EceDecryptor:
+    """
+    Incremental aes128gcm (RFC 8188) decryption, the content encoding Send uses for file bodies:
+    feed ciphertext as it arrives and get back the plaintext of every complete record.
+    """
+    def __init__(self, ikm: bytes):
+        self.ikm = ikm
+        self.buffer = bytearray()
+        self.key = None
+        self.record_size = None
+        self.sequence = 0
+    
+    def _read_header(self) -> bool:
+        # salt (16) | record size (4) | key id length (1) | key id
+        if len(self.buffer) < 21 or len(self.buffer) < 21 + self.buffer[20]:
+            return False
+        salt = bytes(self.buffer[:16])
+        self.record_size = struct.unpack(">I", self.buffer[16:20])[0]
+        prk = hmac.new(salt, self.ikm, hashlib.sha256).digest()
+        self.key = _hkdf_expand(prk, b"Content-Encoding: aes128gcm\0", 16)
+        self.nonce_base = _hkdf_expand(prk, b"Content-Encoding: nonce\0", 12)
+        del self.buffer[:21 + self.buffer[20]]
+        return True
+    
+    def feed(self, data: bytes) -> bytes:
+        self.buffer += data
+        if self.key is None and not self._read_header():
+            return b""
+        plaintext = []
+        # Hold back one record: only finish() knows which record is the last
+        while len(self.buffer) > self.record_size:
+            plaintext.append(self._decrypt_record(bytes(self.buffer[:self.record_size]), last=False))
+            del self.buffer[:self.record_size]
+        return b"".join(plaintext)
+    
+    def finish(self) -> bytes:
+        if self.key is None or not self.buffer:
+            raise Exception("Encrypted stream ended early")
+        plaintext = self._decrypt_record(bytes(self.buffer), last=True)
+        self.buffer.clear()
+        return plaintext
+    
+    def _decrypt_record(self, record: bytes, last: bool) -> bytes:
+        nonce = self.nonce_base[:8] + struct.pack(">I", struct.unpack(">I", self.nonce_base[8:])[0] ^ self.sequence)
+        self.sequence += 1
+        try:
+            padded = _aes_gcm_decrypt(self.key, nonce, record)
+        except Exception:
+            raise Exception(f"Decryption failed at record {self.sequence - 1} (wrong key or corrupted data)")
+        # data | delimiter (1, or 2 for the last record) | zero padding
+        end = len(padded.rstrip(b"\0"))
+        if not end or padded[end - 1] != (2 if last else 1):
+            raise Exception(f"Invalid padding in record {self.sequence - 1}")
+        return padded[:end - 1]
+
+class SendDownloader:
+    """
+    In-process client for Send instances (the service behind ffsend): signs requests with the
+    key from the link, decrypts the metadata for the name and size, then streams the encrypted
+    body and decrypts it record by record into a .part file, hashing the plaintext on the way.
+    Mirrors DirectDownloader's progress, streaming-extraction and retry hooks.
+    """
+    PART_SUFFIX = ".part"
+    
+    def __init__(self, url: str, dest_dir: str, max_retries: int = DIRECT_MAX_RETRIES,
+                 on_progress=None, limiter: BandwidthLimiter = None, on_probe=None):
+        if Cipher is None:
+            raise SendUnsupported("the cryptography package is not installed")
+        link = _parse_send_link(url)
+        if not link:
+            raise SendUnsupported("not a plain Send download link")
+        self.origin, self.file_id, self.secret = link
+        self.meta_key = _hkdf(self.secret, b"metadata", 16)
+        self.auth_key = _hkdf(self.secret, b"authentication", 64)
+        self.dest_dir = dest_dir
+        self.max_retries = max_retries
+        self.on_progress = on_progress
+        self.limiter = limiter
+        self.on_probe = on_probe
+        self.stream_consumer = None
+        self.nonce = None
+        self.file_name = None
+        self.path = None
+        self.part_path = None
+        self.total_size = None
+        self.downloaded = 0
+        self.digest = None  # blake2b of the plaintext, as ContentIndex computes it
+    
+    def _auth_headers(self) -> dict:
+        if not self.nonce:
+            return {}
+        signature = hmac.new(self.auth_key, _b64url_decode(self.nonce), hashlib.sha256).digest()
+        return {"Authorization": f"send-v1 {base64.urlsafe_b64encode(signature).decode().rstrip('=')}"}
+    
+    def _update_nonce(self, headers):
+        # Every response carries the nonce to sign next: "WWW-Authenticate: send-v1 <nonce>"
+        scheme, _, nonce = headers.get("WWW-Authenticate", "").partition(" ")
+        if scheme == "send-v1" and nonce:
+            self.nonce = nonce.strip()
+    
+    async def fetch_metadata(self, session: aiohttp.ClientSession):
+        """Learn the file's name and size (the first request only fetches a nonce to sign)"""
+        for attempt in range(2):
+            async with session.get(f"{self.origin}/api/metadata/{self.file_id}", headers=self._auth_headers()) as resp:
+                self._update_nonce(resp.headers)
+                if resp.status == 401 and attempt == 0:
+                    continue
+                if resp.status == 404:
+                    raise Exception("File not found (expired or download limit reached)")
+                if resp.status == 401:
+                    raise SendUnsupported("link needs a password")
+                if resp.status >= 400:
+                    raise Exception(f"HTTP {resp.status} from server")
+                data = await resp.json(content_type=None)
+                break
+        try:
+            metadata = json.loads(_aes_gcm_decrypt(self.meta_key, bytes(12), _b64url_decode(data["metadata"])))
+        except Exception as e:
+            raise SendUnsupported(f"metadata can't be decrypted ({e})")
+        self.file_name = os.path.basename(str(metadata.get("name") or self.file_id)) or self.file_id
+        self.total_size = int(metadata["size"]) if metadata.get("size") is not None else None
+    
+    async def run(self) -> str:
+        """Download and decrypt the file into dest_dir and return its path"""
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+        async with aiohttp.ClientSession(timeout=timeout, auto_decompress=False) as session:
+            await self.fetch_metadata(session)
+            self.path = os.path.join(self.dest_dir, self.file_name)
+            self.part_path = self.path + self.PART_SUFFIX
+            if self.on_probe:
+                self.on_probe(self)
+            await self._download(session)
         
-        archive_log_path = f"{archive_dir}/download_log.json"
-        with open(archive_log_path, 'w') as f:
-            json.dump(log_data, f, indent=2)
+        if self.total_size is not None and self.downloaded != self.total_size:
+            raise Exception(f"Incomplete download: {self.downloaded} of {self.total_size} bytes")
+        os.replace(self.part_path, self.path)
+        return self.path
+    
+    def _advance(self, nbytes: int):
+        self.downloaded += nbytes
+        if self.on_progress:
+            self.on_progress(self.downloaded, self.total_size)
+        if self.stream_consumer:
+            self.stream_consumer.feed(self.downloaded)
+    
+    def _write(self, fd: int, decrypt, *args) -> int:
+        """Decrypt, hash and write one piece (on an FS worker); returns the plaintext length"""
+        plaintext = decrypt(*args)
+        if plaintext:
+            os.write(fd, plaintext)
+            self.digest.update(plaintext)
+        return len(plaintext)
+    
+    async def _download(self, session: aiohttp.ClientSession):
+        """Stream and decrypt the body, restarting from zero on connection errors"""
+        attempt = 0
+        while True:
+            if self.downloaded and self.stream_consumer:
+                # A restarted stream rewrites the file from zero, so a streaming reader can't continue
+                asyncio.ensure_future(self.stream_consumer.finish(ok=False))
+                self.stream_consumer = None
+            self.downloaded = 0
+            self.digest = hashlib.blake2b(digest_size=32)
+            decryptor = EceDecryptor(self.secret)
+            fd = os.open(self.part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                async with session.get(f"{self.origin}/api/download/{self.file_id}", headers=self._auth_headers()) as resp:
+                    self._update_nonce(resp.headers)
+                    if resp.status == 404:
+                        raise Exception("File not found (expired or download limit reached)")
+                    if resp.status >= 400:
+                        raise Exception(f"HTTP {resp.status} from server")
+                    async for chunk in resp.content.iter_chunked(DIRECT_CHUNK_SIZE):
+                        self._advance(await run_fs_write(self._write, fd, decryptor.feed, chunk))
+                        if self.limiter:
+                            await self.limiter.consume(len(chunk))
+                    self._advance(await run_fs_write(self._write, fd, decryptor.finish))
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise Exception(f"Download failed after {attempt} attempts: {e}")
+                print(f"Send download interrupted ({e}), restarting (attempt {attempt}/{self.max_retries})")
+                await asyncio.sleep(min(30, 2 ** attempt))
+            finally:
+                os.close(fd)
+
+class PreflightProbe:
+    """
+    Learn a link's name and size before transferring anything: Send metadata (or `ffsend info`),
+    the MEGA API's public-link metadata, or an HTTP HEAD. Results are cached for PREFLIGHT_CACHE_TTL
+    seconds so re-posted links and retries don't probe again.
+    """
+    MEGA_API = "https://g.api.mega.co.nz/cs"
+    CACHE_MAX_ENTRIES = 256
+    _cache = {}  # url -> (expires, info), oldest first
+    
+    async def run(self, service: str, url: str) -> Dict[str, Any]:
+        """Return {"name": str or None, "size": bytes or None, "is_folder": bool}"""
+        cached = self._cache.get(url)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        if service == "ffsend":
+            info = await self._probe_ffsend(url)
+        elif service == "MEGA":
+            info = await self._probe_mega(url)
+        else:
+            info = await self._probe_direct(url)
+        self._remember(url, info)
+        return info
+    
+    def _remember(self, url: str, info: Dict[str, Any]):
+        """Cache a result, dropping expired entries and then the oldest ones beyond CACHE_MAX_ENTRIES"""
+        now = time.monotonic()
+        cache = PreflightProbe._cache
+        for key in [key for key, (expires, _) in cache.items() if expires <= now]:
+            del cache[key]
+        cache.pop(url, None)
+        cache[url] = (now + PREFLIGHT_CACHE_TTL, info)
+        while len(cache) > self.CACHE_MAX_ENTRIES:
+            del cache[next(iter(cache))]
+    
+    async def _probe_ffsend(self, url: str) -> Dict[str, Any]:
+        if SEND_NATIVE:
+            try:
+                return await self._probe_send(url)
+            except SendUnsupported:
+                pass
+        process = await asyncio.create_subprocess_exec(
+            "ffsend", "info", url,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            stdin=asyncio.subprocess.DEVNULL
+        )
+        try:
+            output, _ = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        # Name:       my-file.txt
+        # Size:       12 KiB
+        text = ProgressParser.ANSI_RE.sub("", output.decode(errors="ignore"))
+        name = re.search(r"^\s*Name:\s*(.+?)\s*$", text, re.MULTILINE)
+        size = re.search(r"^\s*Size:\s*([\d.,]+)\s*([KMGT]?i?B)?", text, re.MULTILINE | re.IGNORECASE)
+        if process.returncode != 0 or not (name or size):
+            raise Exception(f"ffsend info failed: {text.strip()[:200]}")
+        return {
+            "name": name.group(1) if name else None,
+            "size": _to_bytes(size.group(1), size.group(2)) if size else None,
+            "is_folder": False,
+        }
+    
+    async def _probe_send(self, url: str) -> Dict[str, Any]:
+        downloader = SendDownloader(url, None)
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=PREFLIGHT_TIMEOUT)) as session:
+            await downloader.fetch_metadata(session)
+        return {"name": downloader.file_name, "size": downloader.total_size, "is_folder": False}
+    
+    async def _probe_mega(self, url: str) -> Dict[str, Any]:
+        link = _parse_mega_link(url)
+        if link is None:
+            raise Exception("Unrecognised MEGA link")
+        kind, handle, key = link
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=PREFLIGHT_TIMEOUT)) as session:
+            if kind == "file":
+                result = await self._mega_request(session, {}, [{"a": "g", "p": handle}])
+                return {
+                    "name": _mega_decrypt_name(result.get("at"), _mega_node_key(key)),
+                    "size": result.get("s"),
+                    "is_folder": False,
+                }
+            result = await self._mega_request(session, {"n": handle}, [{"a": "f", "c": 1, "r": 1, "ca": 1}])
+        nodes = result.get("f", [])
+        size = sum(node.get("s", 0) for node in nodes if node.get("t") == 0)
+        # The shared folder itself is the node whose parent isn't in the listing
+        handles = {node.get("h") for node in nodes}
+        root = next((node for node in nodes if node.get("t") == 1 and node.get("p") not in handles), None)
+        name = None
+        if root and Cipher is not None and len(key) == 16:
+            encrypted_key = _b64url_decode(root.get("k", ":").split(":", 1)[1])
+            decryptor = Cipher(algorithms.AES(key), modes.ECB()).decryptor()
+            node_key = decryptor.update(encrypted_key) + decryptor.finalize()
+            name = _mega_decrypt_name(root.get("a"), _mega_node_key(node_key))
+        return {"name": name, "size": size, "is_folder": True}
+    
+    async def _mega_request(self, session: aiohttp.ClientSession, params: dict, payload: list) -> dict:
+        async with session.post(self.MEGA_API, params={"id": str(int(time.time())), **params}, json=payload) as resp:
+            data = await resp.json(content_type=None)
+        result = data[0] if isinstance(data, list) and data else data
+        if not isinstance(result, dict):
+            # MEGA reports errors as negative integers (-9: not found, -11: access denied, ...)
+            raise Exception(f"MEGA API error {result}")
+        return result
+    
+    async def _probe_direct(self, url: str) -> Dict[str, Any]:
+        timeout = aiohttp.ClientTimeout(total=PREFLIGHT_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout, auto_decompress=False) as session:
+            probe = DirectDownloader(url, None)
+            await probe.probe(session)
+        return {"name": probe.file_name, "size": probe.total_size, "is_folder": False}
+
+preflight = PreflightProbe()
+
+class MegaTransferPoller:
+    """
+    Follow MEGAcmd server transfers for all MEGA downloads with one `mega-transfers` call per
+    interval. Rows are matched to downloads by destination path, since each download has its
+    own temp dir; a watcher gets the full row list (or None if the call failed) on every poll.
+    """
+    SEPARATOR = "\t"
+    PROGRESS_RE = re.compile(r"([\d.,]+)\s*%\s*of\s*([\d.,]+)\s*([KMGT]?B)", re.IGNORECASE)
+    FINISHED = {"COMPLETED", "FAILED", "CANCELLED"}
+    
+    def __init__(self, interval: float = MEGA_POLL_INTERVAL):
+        self.interval = interval
+        self.watchers = {}  # destination dir -> callback(rows)
+        self.polls = 0
+        self._task = None
+    
+    def watch(self, path: str, callback):
+        self.watchers[path] = callback
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    def unwatch(self, path: str):
+        self.watchers.pop(path, None)
+    
+    async def _run(self):
+        while self.watchers:
+            try:
+                rows = await self.poll()
+            except Exception as e:
+                print(f"mega-transfers failed: {e}")
+                rows = None
+            for callback in list(self.watchers.values()):
+                callback(rows)
+            await asyncio.sleep(self.interval)
+    
+    async def poll(self):
+        """Every download transfer the MEGAcmd server knows about, finished ones included"""
+        process = await asyncio.create_subprocess_exec(
+            "mega-transfers", "--only-downloads", "--show-completed", "--limit=10000",
+            "--path-display-size=4096", f"--col-separator={self.SEPARATOR}",
+            "--output-cols=TAG,SOURCEPATH,DESTINYPATH,PROGRESS,STATE",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+        output, _ = await process.communicate()
+        self.polls += 1
+        text = ProgressParser.ANSI_RE.sub("", output.decode("utf-8", errors="replace"))
+        if process.returncode != 0:
+            raise Exception(text.strip() or f"exit code {process.returncode}")
+        return [row for row in map(self._parse_row, text.splitlines()) if row]
+    
+    def _parse_row(self, line: str) -> Optional[Dict[str, Any]]:
+        fields = [field.strip() for field in line.split(self.SEPARATOR)]
+        if len(fields) < 5 or fields[0] == "TAG":
+            return None
+        tag, source, path, progress, state = fields[:5]
+        match = self.PROGRESS_RE.search(progress)
+        if not match:
+            return None
+        percent = float(match.group(1).replace(",", "."))
+        total_bytes = _to_bytes(match.group(2), match.group(3))
+        return {
+            "tag": tag,
+            "source": source,
+            "path": path.rstrip("/"),
+            "percent": percent,
+            "total_bytes": total_bytes,
+            "done_bytes": total_bytes if state.upper() == "COMPLETED" else int(total_bytes * percent / 100),
+            "state": state.upper(),
+        }
+    
+    @staticmethod
+    def transfers_under(rows, root: str):
+        """Rows writing into root, without per-file rows already counted by their folder's row"""
+        root = root.rstrip("/")
+        mine = [row for row in rows if row["path"].startswith(root + "/") or row["path"] == root]
+        paths = {row["path"] for row in mine}
+        outermost = []
+        for row in mine:
+            parent = os.path.dirname(row["path"])
+            while len(parent) > len(root) and parent not in paths:
+                parent = os.path.dirname(parent)
+            if len(parent) <= len(root):
+                outermost.append(row)
+        return outermost
+    
+    async def cancel(self, tags):
+        for tag in tags:
+            process = await asyncio.create_subprocess_exec(
+                "mega-transfers", "-c", tag,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            await process.wait()
+
+mega_transfers = MegaTransferPoller()
+
+class SpaceAccountant:
+    """
+    Book disk space for downloads before they start so concurrent transfers and extractions
+    can't fill the drive between them. Each reservation has a transfer and an extract part;
+    the transfer part shrinks as bytes land on disk, and each part is dropped when its phase ends.
+    """
+    def __init__(self, path: str, floor: int = DISK_FREE_FLOOR):
+        self.path = path
+        self.floor = floor
+        self.reservations = {}  # manager -> {"transfer": bytes, "extract": bytes}
+        self._changed = asyncio.Event()
+    
+    def outstanding(self, manager) -> int:
+        """Reserved bytes this download hasn't written yet"""
+        reservation = self.reservations.get(manager)
+        if not reservation:
+            return 0
+        transfer_left = max(0, reservation["transfer"] - manager.transfer_bytes_on_disk())
+        return transfer_left + reservation["extract"]
+    
+    def reserved(self, exclude=None) -> int:
+        return sum(self.outstanding(manager) for manager in self.reservations if manager is not exclude)
+    
+    async def admit(self, manager, transfer_bytes: int, extract_bytes: int):
+        """Reserve the space if it fits above the floor. Returns (admitted, bytes available)."""
+        free = (await run_fs(shutil.disk_usage, self.path)).free
+        available = free - self.reserved(exclude=manager) - self.floor
+        if transfer_bytes + extract_bytes > available:
+            return False, max(0, available)
+        self.reservations[manager] = {"transfer": transfer_bytes, "extract": extract_bytes}
+        return True, available
+    
+    def finish_phase(self, manager, phase: str):
+        """The phase's bytes are on disk now (or never will be): stop counting them"""
+        reservation = self.reservations.get(manager)
+        if reservation and reservation.get(phase):
+            reservation[phase] = 0
+            self._changed.set()
+    
+    def release(self, manager):
+        if self.reservations.pop(manager, None) is not None:
+            self._changed.set()
+    
+    async def wait_for_change(self, timeout: float):
+        """Wait until a reservation is released or shrinks (or the timeout passes, as other things free space too)"""
+        self._changed.clear()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+space = SpaceAccountant(f"{STORAGE_ROOT}/tmp")
+
+class DownloadScheduler:
+    """
+    Register every DownloadManager and decide which may transfer now.
+    Downloads beyond the global or per-service limit wait in a FIFO queue
+    and show their position in the embed.
+    """
+    def __init__(self, max_active: int = MAX_CONCURRENT_DOWNLOADS, service_limits: dict = None,
+                 bandwidth_limit: int = BANDWIDTH_LIMIT):
+        self.max_active = max(1, max_active)
+        self.service_limits = service_limits if service_limits is not None else dict(SERVICE_CONCURRENCY)
+        self.limiter = BandwidthLimiter(bandwidth_limit) if bandwidth_limit > 0 else None
+        self.active = set()
+        self.queue = []  # (manager, future) in arrival order
+    
+    def register(self, manager):
+        """Track a download so commands can find it by id"""
+        downloads[manager.download_id] = manager
+    
+    def _service_count(self, service: str) -> int:
+        return sum(1 for manager in self.active if manager.service == service)
+    
+    def _can_start(self, manager) -> bool:
+        if len(self.active) >= self.max_active:
+            return False
+        limit = self.service_limits.get(manager.service)
+        return limit is None or self._service_count(manager.service) < max(1, limit)
+    
+    async def acquire(self, manager) -> bool:
+        """Wait for a transfer slot. Returns False if the download was cancelled while queued."""
+        if manager.is_cancelled:
+            return False
+        future = asyncio.get_running_loop().create_future()
+        self.queue.append((manager, future))
+        self._dispatch()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            self.queue = [(m, f) for m, f in self.queue if m is not manager]
+            self.active.discard(manager)
+            self._dispatch()
+            raise
+    
+    def release(self, manager):
+        """Give the slot back and start whatever can run next"""
+        if manager in self.active:
+            self.active.discard(manager)
+            self._dispatch()
+    
+    def _dispatch(self):
+        waiting = []
+        for manager, future in self.queue:
+            if future.done():
+                continue
+            if manager.is_cancelled:
+                future.set_result(False)
+            elif self._can_start(manager):
+                self.active.add(manager)
+                future.set_result(True)
+            else:
+                waiting.append((manager, future))
+        self.queue = waiting
+        for position, (manager, _) in enumerate(self.queue, start=1):
+            manager.set_queue_position(position)
 
 class DownloadManager:
-    def __init__(self, message: discord.Message, url: str):
+    # Journaled alongside id, URL, phase, message and paths so a restart can pick the download up again
+    JOURNAL_FIELDS = (
+        "service", "file_name", "destination", "note", "etag", "expected_bytes", "expected_is_folder",
+        "archive_size", "file_count", "download_duration", "has_archive_file",
+    )
+    
+    def __init__(self, message: discord.Message, url: str, download_id: str = None, batch=None):
         self.message = message
+        self.batch = batch  # BatchDownload sharing its message and renderer, if any
         self.url = format_url(url)
-        self.download_id = generate_download_id()
+        self.remote_key = remote_key(self.url)
+        self.etag = None  # Direct downloads: validator of what was fetched, for repeat detection
+        self.download_id = download_id or generate_download_id()
         self.destination = None
         self.note = None
         self.download_task = None
@@ -136,20 +3080,38 @@ class DownloadManager:
         self.total_size = 0
         self.downloaded_size = 0
         self.speed = 0
+        self.eta = None
+        self.speed_estimator = SpeedEstimator()
+        self.preflight_task = None
+        self.expected_bytes = None  # Size learned by the pre-flight probe
+        self.expected_is_folder = False
+        self.direct_downloader = None
+        self.known_digests = {}  # (st_dev, st_ino) -> content hash computed while downloading
         self.status = "🔎 Starting download..."
         self.file_name = "Unknown"
         self.service = "Unknown"
-        self.temp_dir = f"/mnt/transformer/tmp/{self.download_id}"
-        self.archive_dir = f"/mnt/transformer/storage/archives/{self.download_id}"
+        self.temp_dir = f"{STORAGE_ROOT}/tmp/{self.download_id}"
+        self.archive_dir = f"{STORAGE_ROOT}/storage/archives/{self.download_id}"
         self.download_start_time = None
         self.download_duration = 0
         self.archive_size = 0
         self.file_count = 0
+        self.tree_stats = None
         self.has_archive_file = False  # Track if we actually saved an archive file
-        self.history = DownloadHistory()
+        self.streamed_archives = set()  # Archives already extracted while downloading
+        self.extracted_entries = 0
+        self.extracting_entry = None
+        self.history = get_history()
+        self.error_message = None
+        self._rendered_status = None
+        self.renderer = batch.renderer if batch else EmbedRenderer(message, self._build_embed)
+        self.timer = PhaseTimer()
+        self._outcome_recorded = False
+        self._journal_lock = asyncio.Lock()
         
         # Track this as the user's last download for /note command
-        last_downloads[message.author.id] = self.download_id
+        if not batch:
+            last_downloads[message.author.id] = self.download_id
         
         # Ensure temp directory exists
         os.makedirs(self.temp_dir, exist_ok=True)
@@ -158,22 +3120,128 @@ class DownloadManager:
         """Start the download process and update status"""
         try:
             # Identify the service and file info
+            self._enter_phase("identify")
             await self._identify_source()
             
+            # Learn name and size while waiting for a transfer slot
+            self.preflight_task = asyncio.create_task(self._preflight())
+            
             # Start the actual download
             self.download_task = asyncio.create_task(self._perform_download())
             
-            # Start status updates
-            await self._update_status_loop()
+            # Wait for it to finish; progress is pushed to the embed by the renderer
+            await asyncio.wait([self.download_task])
             
         except Exception as e:
-            await self._update_embed(f"❌ Error: {str(e)}")
+            await self._render_final(f"❌ Error: {str(e)}")
+    
+    @classmethod
+    def restore(cls, message: discord.Message, state: Dict[str, Any], batch=None):
+        """Rebuild a manager from its journal entry"""
+        manager = cls(message, state["url"], download_id=state["id"], batch=batch)
+        for field in cls.JOURNAL_FIELDS:
+            if field in state:
+                setattr(manager, field, state[field])
+        manager.temp_dir = state.get("temp_dir", manager.temp_dir)
+        manager.archive_dir = state.get("archive_dir", manager.archive_dir)
+        if manager.archive_size:
+            # The transfer finished before the restart
+            manager.total_size = manager.downloaded_size = manager.archive_size / (1024 * 1024)
+        elif manager.expected_bytes:
+            manager.total_size = manager.expected_bytes / (1024 * 1024)
+        manager.status = "🔄 Resuming after restart..."
+        return manager
+    
+    def journal_state(self) -> Dict[str, Any]:
+        state = {
+            "id": self.download_id,
+            "url": self.url,
+            "phase": self.timer.current,
+            "message_id": self.message.id,
+            "channel_id": self.message.channel.id,
+            "temp_dir": self.temp_dir,
+            "archive_dir": self.archive_dir,
+            "updated": datetime.now().isoformat(),
+        }
+        for field in self.JOURNAL_FIELDS:
+            state[field] = getattr(self, field)
+        if self.batch:
+            state["batch_id"] = self.batch.batch_id
+        return state
+    
+    def _enter_phase(self, phase: str):
+        self.timer.enter(phase)
+        self._journal()
+    
+    def _journal(self):
+        """Persist the current state in the background (writes are serialized per download)"""
+        asyncio.create_task(self._save_journal())
+    
+    async def _save_journal(self):
+        async with self._journal_lock:
+            if self._outcome_recorded:
+                return
+            try:
+                await run_fs(journal.save, self.journal_state())
+            except Exception as e:
+                print(f"Error journaling {self.download_id}: {e}")
+    
+    async def _drop_journal(self):
+        async with self._journal_lock:
+            try:
+                await run_fs(journal.remove, self.download_id)
+            except Exception as e:
+                print(f"Error removing journal entry {self.download_id}: {e}")
+    
+    async def resume(self, phase: str):
+        """Continue a download interrupted by a restart from the phase it was in"""
+        try:
+            await self._update_embed()
+            if phase in ("wait_destination", "move", "logging"):
+                # Transfer and extraction are done; only the move (or the choice of destination) is left
+                self.progress = 100
+                extracted_dir = os.path.join(self.temp_dir, "extracted")
+                if phase == "wait_destination" and os.path.isdir(extracted_dir):
+                    self.tree_stats = await run_fs(TreeStats, extracted_dir)
+                if self.destination:
+                    self.status = "➡️ Moving to destination..."
+                    await self._update_embed()
+                    await self._complete_download()
+                else:
+                    self._enter_phase("wait_destination")
+                    self.status = "⏸️ Waiting for destination..."
+                    await self._update_embed()
+            elif phase == "extract":
+                await run_fs(shutil.rmtree, os.path.join(self.temp_dir, "extracted"), ignore_errors=True)
+                self.download_task = asyncio.create_task(self._perform_download(transferred=True))
+                await asyncio.wait([self.download_task])
+            else:
+                await run_fs(self._clear_partial_transfer)
+                await self.start_download()
+        except Exception as e:
+            await self._render_final(f"❌ Error: {str(e)}")
+    
+    def _clear_partial_transfer(self):
+        """
+        Direct downloads resume from their checkpoint and background MEGA transfers keep running
+        in the MEGAcmd server; the other tools start over
+        """
+        resumable = self.service == "Direct Download" or (self.service == "MEGA" and MEGA_TRANSFER_MODE == "background")
+        os.makedirs(self.temp_dir, exist_ok=True)
+        for item in os.listdir(self.temp_dir):
+            path = os.path.join(self.temp_dir, item)
+            if resumable and item != "extracted":
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
     
     async def _identify_source(self):
         if "mega.nz" in self.url or "mega.co.nz" in self.url:
             self.service = "MEGA"
             self.file_name = "MEGA File"  # Will be updated during download
-        elif "send.vis.ee" in self.url or "ffsend" in self.url:
+        elif is_send_link(self.url):
             self.service = "ffsend"
             self.file_name = "ffsend File"  # Will be updated after download
         else:
@@ -182,6 +3250,68 @@ class DownloadManager:
         
         await self._update_embed()
     
+    async def _preflight(self):
+        """Fill in the name and size up front; failures just leave the placeholders"""
+        try:
+            info = await asyncio.wait_for(preflight.run(self.service, self.url), timeout=PREFLIGHT_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Pre-flight probe failed for {self.url}: {e}")
+            return
+        if info.get("name"):
+            self.file_name = info["name"]
+        if info.get("size"):
+            self.expected_bytes = int(info["size"])
+            self.total_size = self.expected_bytes / (1024 * 1024)
+        self.expected_is_folder = info.get("is_folder", False)
+        self.renderer.mark_dirty()
+    
+    def _space_estimate(self):
+        """(transfer, extract) bytes to reserve; zeros if the size is unknown"""
+        if not self.expected_bytes:
+            return 0, 0
+        extract = 0
+        if not self.expected_is_folder and is_archive_file(self.file_name or ""):
+            extract = int(self.expected_bytes * EXTRACT_EXPANSION_FACTOR)
+        return self.expected_bytes, extract
+    
+    def transfer_bytes_on_disk(self) -> int:
+        """Bytes the transfer has taken on disk so far (preallocation included)"""
+        written = int(self.downloaded_size * 1024 * 1024)
+        if self.direct_downloader:
+            written = max(written, self.direct_downloader.allocated)
+        return written
+    
+    async def _wait_for_slot_and_space(self) -> bool:
+        """
+        Take a transfer slot and reserve disk space for this download. Waits while other
+        downloads hold slots or reservations (they free up); refuses if nothing else can change it.
+        """
+        while True:
+            if not await scheduler.acquire(self):
+                return False
+            if self.preflight_task:
+                await self.preflight_task
+            transfer, extract = self._space_estimate()
+            admitted, available = await space.admit(self, transfer, extract)
+            if admitted:
+                return True
+            
+            scheduler.release(self)
+            message = f"need {format_size(transfer + extract)}, {format_size(available)} available"
+            # Downloads parked for a destination keep an empty reservation; only booked bytes can free up
+            if not scheduler.active and not space.reserved():
+                self.status = f"❌ Not enough disk space ({message})"
+                self._record_outcome("failed")
+                await self._render_final()
+                return False
+            self.status = f"💾 Waiting for disk space ({message})"
+            await self._update_embed()
+            await space.wait_for_change(DISK_RECHECK_INTERVAL)
+            if self.is_cancelled:
+                return False
+    
     def _unwrap_nested_directories(self, base_path):
         """
         Unwrap unnecessary nested directories like /media/mousebits/actualfolderhere
@@ -221,8 +3351,37 @@ class DownloadManager:
             print(f"Error unwrapping directories: {e}")
             return base_path
     
-    async def _perform_download(self):
-        """Perform the actual download using ffsend"""
+    async def _perform_download(self, transferred: bool = False):
+        """Wait for a transfer slot, download (unless already on disk) and extract, then move to the destination"""
+        self._enter_phase("queue")
+        if not await self._wait_for_slot_and_space():
+            return
+        
+        try:
+            if not transferred and not await self._transfer():
+                return
+            
+            self._enter_phase("extract")
+            self.status = "📦 Extracting files..."
+            await self._update_embed()
+            await self._extract_files()
+            space.finish_phase(self, "extract")
+        finally:
+            scheduler.release(self)
+        
+        # Check if destination was already selected during download
+        if self.destination:
+            self.status = "➡️ Moving to destination..."
+            await self._update_embed()
+            await self._complete_download()
+        else:
+            self._enter_phase("wait_destination")
+            self.status = "⏸️ Waiting for destination..."
+            await self._update_embed()
+    
+    async def _transfer(self) -> bool:
+        """Run the service's downloader. Returns False if it failed or was cancelled."""
+        self._enter_phase("transfer")
         self.status = "⏳ Downloading..."
         self.download_start_time = time.time()
         await self._update_embed()
@@ -233,178 +3392,260 @@ class DownloadManager:
             elif self.service == "MEGA":
                 await self._download_with_mega()
             else:
-                await self._download_with_wget()
+                await self._download_direct()
                 
         except Exception as e:
             self.status = f"❌ Download failed: {str(e)}"
-            await self._update_embed()
+            self._record_outcome("failed")
+            await self._render_final()
+            return False
+        
+        if self.is_cancelled:
+            return False
+        
+        self._finish_speed()
+        space.finish_phase(self, "transfer")
+        self.timer.add_bytes("transfer", self.archive_size)
+        metrics.observe_transfer(self.service, self.archive_size, self.timer.seconds.get("transfer", 0))
+        return True
+    
+    def _record_outcome(self, status: str):
+        """Close the current phase and add this download to the metrics (once)"""
+        if self._outcome_recorded:
             return
+        self._outcome_recorded = True
+        space.release(self)
+        asyncio.create_task(self._drop_journal())
+        if self.batch:
+            self.batch.item_finished()
+        self.timer.stop()
+        metrics.record_download(self, status)
+    
+    def set_queue_position(self, position: int):
+        """Show this download's place in the scheduler queue"""
+        self.status = f"🕒 Queued (#{position})"
+        asyncio.create_task(self._update_embed())
+    
+    async def _follow_progress(self, process, grammar: str) -> int:
+        """Parse a download tool's output into progress as it arrives; returns its exit code"""
+        parser = ProgressParser(grammar)
+        while True:
+            chunk = await process.stdout.read(4096)
+            if not chunk:
+                break
+            event = parser.feed(chunk)
+            if event:
+                self._apply_progress(event)
+        event = parser.flush()
+        if event:
+            self._apply_progress(event)
+        return await process.wait()
+    
+    def _apply_progress(self, event: ProgressEvent):
+        """Copy a progress event (bytes) into the embed state (MB)"""
+        if event.total_bytes:
+            self.total_size = event.total_bytes / (1024 * 1024)
+        if event.percent is not None:
+            self.progress = event.percent
+        if event.done_bytes is not None:
+            self._track_speed(event.done_bytes, event.total_bytes)
+        elif event.speed is not None:
+            # Percent-only output with no size to measure against: fall back to the tool's own figures
+            self.speed = event.speed / (1024 * 1024)
+            self.eta = event.eta
+        self.renderer.mark_dirty()
+    
+    def _track_speed(self, done_bytes: int, total_bytes: int = None):
+        """Update downloaded size, smoothed speed and ETA from a bytes-done sample"""
+        self.downloaded_size = done_bytes / (1024 * 1024)
+        self.speed = self.speed_estimator.update(done_bytes) / (1024 * 1024)
+        self.eta = self.speed_estimator.eta(total_bytes or int(self.total_size * 1024 * 1024))
+    
+    def _finish_speed(self):
+        """Show the average speed once the transfer is over"""
+        if self.speed_estimator.average:
+            self.speed = self.speed_estimator.average / (1024 * 1024)
+        self.eta = None
+    
+    async def _download_with_ffsend(self):
+        """Download from a Send instance in-process, or with the ffsend binary if the native client can't"""
+        if SEND_NATIVE:
+            try:
+                await self._download_with_send_client()
+                return
+            except SendUnsupported as e:
+                print(f"Native Send client skipped for {self.url} ({e}), using ffsend")
+        await self._download_with_ffsend_binary()
+    
+    async def _download_with_send_client(self):
+        """Stream and decrypt a Send download in-process, unpacking tar/zip archives as they arrive"""
+        extractor = None
         
-        if not self.is_cancelled:
-            self.status = "📦 Extracting files..."
-            await self._update_embed()
-            await self._extract_files()
+        def on_probe(downloader):
+            nonlocal extractor
+            extractor = self._attach_streaming_extractor(downloader)
+        
+        downloader = SendDownloader(
+            self.url, self.temp_dir, on_progress=self._on_transfer_progress, limiter=scheduler.limiter, on_probe=on_probe
+        )
+        try:
+            try:
+                path = await downloader.run()
+            except BaseException:
+                if extractor:
+                    await extractor.finish(ok=False)
+                raise
+            if downloader.stream_consumer and await extractor.finish():
+                self.streamed_archives.add(os.path.basename(path))
+                print(f"Extracted {extractor.entries} entries from {downloader.file_name} during download")
             
-            # Check if destination was already selected during download
-            if self.destination:
-                self.status = "➡️ Moving to destination..."
-                await self._update_embed()
-                await self._complete_download()
-            else:
-                self.status = "⏸️ Waiting for destination..."
-                await self._update_embed()
+            self.download_duration = time.time() - self.download_start_time
+            self.file_name = downloader.file_name
+            st = await run_fs(os.stat, path)
+            self.known_digests[(st.st_dev, st.st_ino)] = downloader.digest.hexdigest()
+            self.tree_stats = await run_fs(TreeStats, path)
+            self.archive_size = self.tree_stats.total_bytes
+            self.file_count = self.tree_stats.file_count
+            self.total_size = self.archive_size / (1024 * 1024)
+            self.progress = 100
+            print(f"Send download completed in {self.download_duration:.2f} seconds: {path} ({self.archive_size} bytes)")
+        except (asyncio.CancelledError, SendUnsupported):
+            raise
+        except Exception as e:
+            raise Exception(f"Send download error: {str(e)}")
     
-    async def _download_with_ffsend(self):
+    async def _download_with_ffsend_binary(self):
         """Download using ffsend with progress parsing"""
+        process = None
         try:
             # Run ffsend download command
             process = await asyncio.create_subprocess_exec(
                 "ffsend", "download", "-y", self.url, "--output", self.temp_dir,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.STDOUT,
-                stdin=asyncio.subprocess.PIPE
-            )
-            # Stream output and parse progress as it arrives so the embed can be updated
-            buffer = ""
-            ansi_re = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
-            full_prog_re = re.compile(r'([\d\.,]+)\s*(B|KB|KIB|MB|MIB|GB|GIB)?\s*/\s*([\d\.,]+)\s*(B|KB|KIB|MB|MIB|GB|GIB)?.*?([\d\.,]+)\s*%', re.IGNORECASE)
-            pct_only_re = re.compile(r'([\d\.,]+)\s*%.*?([\d\.,]+)\s*(B|KB|KIB|MB|MIB|GB|GIB)?/s', re.IGNORECASE)
-            speed_re = re.compile(r'([\d\.,]+)\s*(B|KB|KIB|MB|MIB|GB|GIB)?/s', re.IGNORECASE)
-
-            while True:
-                chunk = await process.stdout.read(1024)
-                if not chunk:
-                    break
-                try:
-                    text = chunk.decode(errors='ignore')
-                except Exception:
-                    text = chunk.decode('utf-8', errors='ignore')
-
-                # Strip ANSI sequences
-                clean = ansi_re.sub('', text)
-                clean = clean.replace('\x1b[K', '')
-
-                # Append to buffer
-                buffer += clean
-
-                # Look for the last full progress match
-                full_matches = list(full_prog_re.finditer(buffer))
-                if full_matches:
-                    m = full_matches[-1]
-                    try:
-                        downloaded_raw = f"{m.group(1)} {m.group(2) or 'MB'}"
-                        total_raw = f"{m.group(3)} {m.group(4) or 'MB'}"
-                        perc_raw = m.group(5)
-                        self.downloaded_size = _parse_size_to_mb(downloaded_raw)
-                        self.total_size = _parse_size_to_mb(total_raw)
-                        self.progress = float(perc_raw.replace(',', '.'))
-                    except Exception:
-                        pass
-
-                    # speed
-                    sm = speed_re.search(buffer)
-                    if sm:
-                        try:
-                            speed_val = float(sm.group(1).replace(',', '.'))
-                            speed_unit = (sm.group(2) or 'MB').upper()
-                            if speed_unit in ('B',):
-                                self.speed = speed_val / (1024 * 1024)
-                            elif speed_unit in ('KB', 'KIB'):
-                                self.speed = speed_val / 1024
-                            elif speed_unit in ('MB', 'MIB'):
-                                self.speed = speed_val
-                            elif speed_unit in ('GB', 'GIB'):
-                                self.speed = speed_val * 1024
-                        except Exception:
-                            pass
-
-                    try:
-                        await self._update_embed()
-                    except Exception:
-                        pass
-
-                    # Truncate buffer up to the matched end to avoid repeated parsing
-                    buffer = buffer[m.end():]
-                    continue
-
-                # Otherwise, try percent-only
-                pct_matches = list(pct_only_re.finditer(buffer))
-                if pct_matches:
-                    m = pct_matches[-1]
-                    try:
-                        self.progress = float(m.group(1).replace(',', '.'))
-                        speed_val = float(m.group(2).replace(',', '.'))
-                        speed_unit = (m.group(3) or 'MB').upper()
-                        if speed_unit in ('B',):
-                            self.speed = speed_val / (1024 * 1024)
-                        elif speed_unit in ('KB', 'KIB'):
-                            self.speed = speed_val / 1024
-                        elif speed_unit in ('MB', 'MIB'):
-                            self.speed = speed_val
-                        elif speed_unit in ('GB', 'GIB'):
-                            self.speed = speed_val * 1024
-                    except Exception:
-                        pass
-
-                    try:
-                        await self._update_embed()
-                    except Exception:
-                        pass
-
-                    buffer = buffer[m.end():]
-
-                # Prevent buffer growth
-                if len(buffer) > 8192:
-                    buffer = buffer[-8192:]
-            # Wait for process to exit and get return code
-            returncode = await process.wait()
+                stdin=asyncio.subprocess.PIPE
+            )
+            returncode = await self._follow_progress(process, "ffsend")
 
             if returncode == 0:
                 self.download_duration = time.time() - self.download_start_time
                 print(f"Download completed in {self.download_duration:.2f} seconds")
                 # ffsend with -y flag auto-extracts, so we need to handle this differently
-                # First, try to unwrap any unnecessary nested directories
-                unwrapped_path = self._unwrap_nested_directories(self.temp_dir)
-                
-                # Calculate total size of extracted files and determine file name
-                total_size_bytes = 0
-                file_count = 0
-                
-                # Get the top-level directory name as the file name
-                temp_contents = os.listdir(unwrapped_path)
-                if temp_contents:
-                    # Use the first directory as the file name, or first file if no directories
-                    top_level_item = temp_contents[0]
-                    if os.path.isdir(os.path.join(unwrapped_path, top_level_item)):
-                        self.file_name = top_level_item
-                    else:
-                        # If it's a file, use the filename without extension
-                        self.file_name = os.path.splitext(top_level_item)[0]
-                
-                for root, dirs, files in os.walk(unwrapped_path):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        if os.path.isfile(file_path):
-                            file_size = os.path.getsize(file_path)
-                            total_size_bytes += file_size
-                            file_count += 1
-                
-                self.archive_size = total_size_bytes
-                self.file_count = file_count
-                
-                # Update total_size if we got it from ffsend info, otherwise use calculated size
-                if self.total_size == 0:
-                    self.total_size = total_size_bytes / (1024 * 1024)
-                
-                print(f"Downloaded and extracted: {self.file_name} ({file_count} files, {total_size_bytes} bytes)")
+                await run_fs(self._summarize_ffsend_output)
             else:
                 raise Exception("ffsend download failed")
                 
         except Exception as e:
             raise Exception(f"ffsend download error: {str(e)}")
+        finally:
+            await stop_process(process)
+    
+    def _summarize_ffsend_output(self):
+        """Unwrap ffsend's auto-extracted output and record its name, size and file count"""
+        # First, try to unwrap any unnecessary nested directories
+        unwrapped_path = self._unwrap_nested_directories(self.temp_dir)
+
+        # Use the top-level directory as the file name, or the first file's stem if there are none
+        stats = TreeStats(unwrapped_path)
+        if stats.top_level:
+            self.file_name = stats.top_level if stats.top_level_is_dir else os.path.splitext(stats.top_level)[0]
+        self.tree_stats = stats
+        self.archive_size = stats.total_bytes
+        self.file_count = stats.file_count
+        
+        # Update total_size if we got it from ffsend info, otherwise use calculated size
+        if self.total_size == 0:
+            self.total_size = stats.total_bytes / (1024 * 1024)
+        
+        print(f"Downloaded and extracted: {self.file_name} ({stats.file_count} files, {stats.total_bytes} bytes)")
     
     async def _download_with_mega(self):
+        """Queue the link in the MEGAcmd server and follow it through the shared transfer poller"""
+        if MEGA_TRANSFER_MODE != "background":
+            await self._download_with_mega_foreground()
+            return
+        try:
+            # A transfer into this temp dir may still be running from before a restart
+            rows = mega_transfers.transfers_under(await mega_transfers.poll(), self.temp_dir)
+            stale = {row["tag"] for row in rows if row["state"] in ("FAILED", "CANCELLED")}
+            if not any(row["tag"] not in stale for row in rows):
+                process = await asyncio.create_subprocess_exec(
+                    "mega-get", "-q", self.url, self.temp_dir,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.STDOUT,
+                    stdin=asyncio.subprocess.DEVNULL
+                )
+                output, _ = await process.communicate()
+                if process.returncode != 0:
+                    raise Exception(output.decode("utf-8", errors="replace").strip() or "mega-get failed")
+            
+            await self._follow_mega_transfer(stale)
+            self.download_duration = time.time() - self.download_start_time
+            print(f"MEGA download completed in {self.download_duration:.2f} seconds")
+            await run_fs(self._summarize_mega_output)
+        except asyncio.CancelledError:
+            # Stop the server-side transfer too, or it keeps writing into the temp dir
+            await self._cancel_mega_transfers()
+            raise
+        except Exception as e:
+            await self._cancel_mega_transfers()
+            raise Exception(f"MEGA download error: {str(e)}")
+    
+    async def _cancel_mega_transfers(self):
+        """Cancel every unfinished server-side transfer into this download's temp dir"""
+        try:
+            rows = mega_transfers.transfers_under(await mega_transfers.poll(), self.temp_dir)
+            await mega_transfers.cancel(
+                row["tag"] for row in rows if row["state"] not in ("COMPLETED", "FAILED", "CANCELLED")
+            )
+        except Exception as e:
+            print(f"Could not cancel MEGA transfers into {self.temp_dir}: {e}")
+    
+    async def _follow_mega_transfer(self, stale_tags: set):
+        """Wait for this download's transfers to finish, copying their byte counts into the embed"""
+        done = asyncio.get_running_loop().create_future()
+        started = time.monotonic()
+        failures = 0
+        
+        def on_rows(rows):
+            nonlocal failures
+            if done.done():
+                return
+            if rows is None:
+                failures += 1
+                if failures >= 3:
+                    done.set_exception(Exception("mega-transfers is not responding"))
+                return
+            failures = 0
+            mine = [row for row in mega_transfers.transfers_under(rows, self.temp_dir) if row["tag"] not in stale_tags]
+            if not mine:
+                if time.monotonic() - started > MEGA_TRANSFER_GRACE:
+                    done.set_exception(Exception("transfer not found in the MEGAcmd server"))
+                return
+            states = {row["state"] for row in mine}
+            for state in ("FAILED", "CANCELLED"):
+                if state in states:
+                    done.set_exception(Exception(f"transfer {state.lower()}"))
+                    return
+            done_bytes = sum(row["done_bytes"] for row in mine)
+            total_bytes = sum(row["total_bytes"] for row in mine)
+            if total_bytes:
+                self.total_size = total_bytes / (1024 * 1024)
+                self.progress = round(done_bytes * 100 / total_bytes, 2)
+            self._track_speed(done_bytes, total_bytes)
+            self.renderer.mark_dirty()
+            if states <= {"COMPLETED"}:
+                done.set_result(None)
+        
+        mega_transfers.watch(self.temp_dir, on_rows)
+        try:
+            await done
+        finally:
+            mega_transfers.unwatch(self.temp_dir)
+    
+    async def _download_with_mega_foreground(self):
         """Download using mega-get"""
+        process = None
         try:
             # Run mega-get command
             process = await asyncio.create_subprocess_exec(
@@ -414,144 +3655,157 @@ class DownloadManager:
                 stdin=asyncio.subprocess.PIPE
             )
             
-            # Stream output and parse progress as it arrives
-            buffer = ""
-            ansi_re = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
-            # MEGA progress format: TRANSFERRING ||#############################.........||(112/147 MB:  76.12 %)
-            mega_prog_re = re.compile(r'TRANSFERRING.*?\((\d+)/(\d+)\s*MB:\s*(\d+\.\d+)\s*%\s*\)', re.IGNORECASE)
-            
-            while True:
-                chunk = await process.stdout.read(1024)
-                if not chunk:
-                    break
-                try:
-                    text = chunk.decode(errors='ignore')
-                except Exception:
-                    text = chunk.decode('utf-8', errors='ignore')
-                
-                # Strip ANSI sequences and clean up the text
-                clean = ansi_re.sub('', text)
-                clean = clean.replace('\x1b[K', '')
-                clean = clean.replace('\x00', '')  # Remove null characters
-                clean = clean.replace('\r', '')  # Remove carriage returns
-                
-                # Append to buffer
-                buffer += clean
-                
-                # Look for MEGA progress in the buffer (handle overwriting lines)
-                matches = list(mega_prog_re.finditer(buffer))
-                if matches:
-                    m = matches[-1]  # Get the last (most recent) match
-                    try:
-                        downloaded_mb = float(m.group(1))
-                        total_mb = float(m.group(2))
-                        progress_pct = float(m.group(3))
-                        
-                        print(f"MEGA progress: {downloaded_mb}/{total_mb} MB ({progress_pct}%)")
-                        
-                        self.downloaded_size = downloaded_mb
-                        self.total_size = total_mb
-                        self.progress = progress_pct
-                        
-                        # Update embed with progress
-                        await self._update_embed()
-                    except Exception as e:
-                        print(f"MEGA progress parsing error: {e}")
-                        pass
-                    
-                    # Keep only the last part of the buffer to avoid memory issues
-                    buffer = buffer[-1024:]
-                
-                # Prevent buffer growth
-                if len(buffer) > 8192:
-                    buffer = buffer[-8192:]
-            
-            # Wait for process to exit
-            returncode = await process.wait()
+            returncode = await self._follow_progress(process, "mega-get")
             
             if returncode == 0:
                 self.download_duration = time.time() - self.download_start_time
                 print(f"MEGA download completed in {self.download_duration:.2f} seconds")
                 
                 # Discover actual file name and size after download
-                for file in os.listdir(self.temp_dir):
-                    file_path = os.path.join(self.temp_dir, file)
-                    if os.path.isfile(file_path):
-                        self.file_name = file
-                        self.archive_size = os.path.getsize(file_path)
-                        print(f"Downloaded file: {file} ({self.archive_size} bytes)")
-                        break
-                    elif os.path.isdir(file_path):
-                        # If it's a directory, use the directory name
-                        self.file_name = file
-                        # Calculate total size of directory
-                        total_size_bytes = 0
-                        file_count = 0
-                        for root, dirs, files in os.walk(file_path):
-                            for f in files:
-                                total_size_bytes += os.path.getsize(os.path.join(root, f))
-                                file_count += 1
-                        self.archive_size = total_size_bytes
-                        self.file_count = file_count
-                        print(f"Downloaded directory: {file} ({file_count} files, {total_size_bytes} bytes)")
-                        break
+                await run_fs(self._summarize_mega_output)
             else:
                 raise Exception("mega-get download failed")
                 
         except Exception as e:
             raise Exception(f"MEGA download error: {str(e)}")
+        finally:
+            await stop_process(process)
+    
+    def _summarize_mega_output(self):
+        """Record the name, size and file count of what mega-get wrote"""
+        stats = TreeStats(self.temp_dir)
+        if stats.top_level:
+            self.file_name = stats.top_level
+        self.tree_stats = stats
+        self.archive_size = stats.total_bytes
+        self.file_count = stats.file_count
+        kind = "directory" if stats.top_level_is_dir else "file"
+        print(f"Downloaded {kind}: {self.file_name} ({stats.file_count} files, {stats.total_bytes} bytes)")
+    
+    def _on_transfer_progress(self, downloaded_bytes: int, total_bytes: int = None):
+        """Progress callback of the in-process downloaders"""
+        if total_bytes:
+            self.total_size = total_bytes / (1024 * 1024)
+            self.progress = round(downloaded_bytes * 100 / total_bytes, 2)
+        self._track_speed(downloaded_bytes, total_bytes)
+        self.renderer.mark_dirty()
+    
+    def _attach_streaming_extractor(self, downloader):
+        """Tar and zip archives are unpacked while the bytes arrive; returns the extractor, if any"""
+        kind = streaming_archive_kind(downloader.file_name)
+        if not kind:
+            return None
+        extractor = StreamingExtractor(downloader.part_path, os.path.join(self.temp_dir, "extracted"), kind)
+        extractor.start()
+        downloader.stream_consumer = extractor
+        return extractor
+    
+    async def _download_direct(self):
+        """Download a plain HTTP(S) URL with the in-process segmented downloader"""
+        extractor = None
+        
+        def on_probe(downloader):
+            nonlocal extractor
+            extractor = self._attach_streaming_extractor(downloader)
+        
+        try:
+            await run_fs(self._adopt_direct_checkpoint)
+            downloader = DirectDownloader(
+                self.url, self.temp_dir, on_progress=self._on_transfer_progress, limiter=scheduler.limiter, on_probe=on_probe
+            )
+            self.direct_downloader = downloader
+            try:
+                path = await downloader.run()
+            except BaseException:
+                if extractor:
+                    await extractor.finish(ok=False)
+                raise
+            if downloader.stream_consumer and await extractor.finish():
+                self.streamed_archives.add(os.path.basename(path))
+                print(f"Extracted {extractor.entries} entries from {downloader.file_name} during download")
+            
+            self.download_duration = time.time() - self.download_start_time
+            self.file_name = downloader.file_name
+            self.etag = downloader.etag
+            self.tree_stats = await run_fs(TreeStats, path)
+            self.archive_size = self.tree_stats.total_bytes
+            self.file_count = self.tree_stats.file_count
+            self.total_size = self.archive_size / (1024 * 1024)
+            self.progress = 100
+            print(f"Direct download completed in {self.download_duration:.2f} seconds: {path} ({self.archive_size} bytes)")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            raise Exception(f"Direct download error: {str(e)}")
     
-    async def _download_with_wget(self):
-        """Download using wget (placeholder for now)"""
-        # TODO: Implement wget download
-        await asyncio.sleep(1)  # Placeholder
+    def _adopt_direct_checkpoint(self):
+        """Move a partial download of the same URL left behind by an earlier run into this temp dir"""
+        checkpoint_path = DirectDownloader.find_checkpoint(
+            self.url, f"{STORAGE_ROOT}/tmp", exclude=set(downloads) | {self.download_id}
+        )
+        if not checkpoint_path:
+            return
+        old_dir = os.path.dirname(checkpoint_path)
+        base = checkpoint_path[:-len(DirectDownloader.CHECKPOINT_SUFFIX)]
+        for path in (base + DirectDownloader.PART_SUFFIX, checkpoint_path):
+            shutil.move(path, os.path.join(self.temp_dir, os.path.basename(path)))
+        print(f"Adopted partial download from {old_dir}")
+        try:
+            os.rmdir(old_dir)
+        except OSError:
+            pass
     
     async def _extract_files(self):
-        """Extract downloaded files"""
+        """Extract downloaded archives (concurrently, including nested and multi-part sets)"""
         try:
             extracted_dir = os.path.join(self.temp_dir, "extracted")
             os.makedirs(extracted_dir, exist_ok=True)
             
-            # Find archive files and extract them
-            archive_files_found = False
-            for file in os.listdir(self.temp_dir):
-                file_path = os.path.join(self.temp_dir, file)
-                if os.path.isfile(file_path) and file.endswith(('.zip', '.rar', '.7z', '.tar', '.gz')):
-                    archive_files_found = True
-                    # Extract using appropriate tool
-                    if file.endswith('.zip'):
-                        result = await asyncio.create_subprocess_exec(
-                            "unzip", file_path, "-d", extracted_dir
-                        )
-                        await result.wait()
-                    elif file.endswith('.tar.gz') or file.endswith('.tgz'):
-                        result = await asyncio.create_subprocess_exec(
-                            "tar", "-xzf", file_path, "-C", extracted_dir
-                        )
-                        await result.wait()
-                    # Add more extraction methods as needed
+            loop = asyncio.get_running_loop()
+            def on_entry(name):
+                # May run on an extraction worker thread
+                loop.call_soon_threadsafe(self._on_extracted_entry, name)
+            
+            extractor = ArchiveExtractor(self.temp_dir, extracted_dir, on_entry=on_entry, skip=self.streamed_archives)
+            archives = await extractor.run()
             
             # Only count extracted files if we actually extracted something
-            if archive_files_found:
-                self.file_count = sum(len(files) for _, _, files in os.walk(extracted_dir))
+            if archives or self.streamed_archives:
+                self.tree_stats = await run_fs(TreeStats, extracted_dir)
+                self.file_count = self.tree_stats.file_count
+                self.timer.add_bytes("extract", self.tree_stats.total_bytes)
             # If no archive files found (e.g., ffsend auto-extracted), keep the existing file_count
             
         except Exception as e:
             print(f"Extraction error: {e}")
             # Continue even if extraction fails
     
-    async def _update_status_loop(self):
-        """Continuously update the status embed"""
-        while not self.is_cancelled and self.download_task and not self.download_task.done():
-            # Update embed periodically to reflect any progress parsed by the download tasks
-            try:
-                await self._update_embed()
-            except Exception:
-                pass
-            await asyncio.sleep(1)  # Update every second
+    def _on_extracted_entry(self, name: str):
+        self.extracted_entries += 1
+        self.extracting_entry = name
+        self.renderer.mark_dirty()
     
     async def _update_embed(self, error_message: str = None):
-        """Update the Discord embed with current status"""
+        """
+        Mark the embed dirty so the renderer picks up the current state.
+        Returns immediately; status transitions and errors are rendered sooner than progress ticks.
+        """
+        if error_message:
+            self.error_message = error_message
+        urgent = error_message is not None or self.status != self._rendered_status
+        self._rendered_status = self.status
+        self.renderer.mark_dirty(urgent=urgent)
+    
+    async def _render_final(self, error_message: str = None):
+        """Send the final state now and stop the renderer (a batch's shared one stays open for the others)"""
+        await self._update_embed(error_message)
+        await self.renderer.flush()
+        if not self.batch:
+            self.renderer.close()
+    
+    def _build_embed(self) -> discord.Embed:
+        """Build the status embed from the current state"""
+        error_message = self.error_message
         if error_message:
             description = f"❌ {error_message}"
         else:
@@ -568,15 +3822,14 @@ class DownloadManager:
             else:
                 size_info = f"{self.downloaded_size:.1f} MB of ?"
             
-            # Speed info (only for ffsend and direct downloads, not MEGA)
-            if self.service != "MEGA":
-                speed_info = f"{self.speed:.2f} MB/s" if self.speed > 0 else "0.00 MB/s"
-                
-                # Grey out speed info after completion
-                if self.status == "✅ Download complete.":
-                    speed_info = f"-# {speed_info}"
-            else:
-                speed_info = None
+            # Smoothed speed (and time left while transferring) for every service
+            speed_info = f"{self.speed:.2f} MB/s" if self.speed > 0 else "0.00 MB/s"
+            if self.eta is not None and self.progress < 100:
+                speed_info += f" · {format_duration(self.eta)} left"
+            
+            # Grey out speed info after completion
+            if self.status == "✅ Download complete.":
+                speed_info = f"-# {speed_info}"
             
             # Destination info
             dest_info = f"📁 {self.destination}" if self.destination else "📁 Select a destination"
@@ -584,16 +3837,20 @@ class DownloadManager:
             # Notes info - only show if note exists
             note_info = f"📒 {self.note}" if self.note else ""
             
+            # Show what's being unpacked while extracting
+            status_line = self.status
+            if self.status == "📦 Extracting files..." and self.extracted_entries:
+                entry = os.path.basename(self.extracting_entry.rstrip("/"))
+                status_line += f"\n-# {self.extracted_entries} files · {entry[:60]}"
+            
             # Build description parts
             description_parts = [
-                f"{self.status}\n\n",
+                f"{status_line}\n\n",
                 f"[{progress_bar}] - **{self.progress}%**\n\n",
                 f"{size_info}"
             ]
             
-            # Add speed info only if available (not for MEGA)
-            if speed_info is not None:
-                description_parts.append(f"\n{speed_info}")
+            description_parts.append(f"\n{speed_info}")
             
             description_parts.extend(["\n\n", f"{dest_info}"])
             
@@ -610,22 +3867,17 @@ class DownloadManager:
             color=discord.Color.blue() if not error_message else discord.Color.red()
         )
         embed.set_author(name=self.service, icon_url=get_service_icon(self.service))
-        
-        try:
-            await self.message.edit(embed=embed)
-            print(f"Embed updated: {self.file_name} - {self.progress}%")
-        except discord.NotFound:
-            # Message was deleted
-            pass
+        return embed
     
     def set_destination(self, destination: str):
         """Set the download destination"""
         self.destination = destination
+        self._journal()
         # Update the embed to show the selected destination
         asyncio.create_task(self._update_embed())
         
         # If download is already complete and waiting for destination, complete it now
-        if self.status == "⏸⚠️ Waiting for destination...":
+        if self.status == "⏸️ Waiting for destination...":
             self.status = "➡️ Moving to destination..."
             asyncio.create_task(self._update_embed())
             # Complete the download process
@@ -634,17 +3886,31 @@ class DownloadManager:
     def set_note(self, note: str):
         """Set a note for the download"""
         self.note = note
-        asyncio.create_task(self._update_embed())
+        self._journal()
+        if self.renderer.closed:
+            # Finished downloads have stopped rendering; show the note with one direct edit
+            asyncio.create_task(self._edit_embed_now())
+        else:
+            asyncio.create_task(self._update_embed())
         
         # If download is complete, save the note to logs
         if self.status == "✅ Download complete.":
             asyncio.create_task(self._save_note_to_logs())
     
+    async def _edit_embed_now(self):
+        try:
+            await self.message.edit(embed=self._build_embed())
+        except discord.HTTPException as e:
+            print(f"Error updating embed: {e}")
+    
     async def update_view_after_completion(self):
         """Update the view to hide cancel button and destination dropdown after completion"""
+        if self.batch:
+            # The batch swaps its view once every item has finished
+            return
         try:
             # Create a new view with only the note button
-            view = CompletedDownloadView(self)
+            view = CompletedDownloadView(self.download_id, has_note=bool(self.note))
             
             # Update the message with the new view
             await self.message.edit(view=view)
@@ -653,94 +3919,93 @@ class DownloadManager:
     
     async def _save_note_to_logs(self):
         """Save note to logs after download completion"""
-        try:
-            # Read the current log data
-            individual_log_path = f"/mnt/transformer/logs/{self.download_id}.json"
-            if os.path.exists(individual_log_path):
-                with open(individual_log_path, 'r') as f:
-                    log_data = json.load(f)
-                
-                # Update the note
-                log_data["note"] = self.note
-                
-                # Save back to individual log
-                with open(individual_log_path, 'w') as f:
-                    json.dump(log_data, f, indent=2)
-                
-                # Update main downloads log
-                self.history.add_download(log_data)
-                
-                # Update archive log if it exists
-                archive_log_path = f"/mnt/transformer/storage/archives/{self.download_id}/download_log.json"
-                if os.path.exists(archive_log_path):
-                    with open(archive_log_path, 'w') as f:
-                        json.dump(log_data, f, indent=2)
-                
-                print(f"Note saved to logs: {self.note}")
-        except Exception as e:
-            print(f"Error saving note to logs: {e}")
+        await run_fs(write_note_to_logs, self.download_id, self.note)
+    
+    def _move_to_destination(self, mover: MoveEngine, dedup: Deduplicator, final_path: str) -> bool:
+        """Keep archives in storage and move the content to final_path. Returns True if archives were kept."""
+        # Archive original files (if any exist) first: a hardlink costs nothing, and a
+        # plain archive download may itself be moved to the destination below
+        os.makedirs(self.archive_dir, exist_ok=True)
+        archive_files_found = False
+        for file in os.listdir(self.temp_dir):
+            file_path = os.path.join(self.temp_dir, file)
+            if os.path.isfile(file_path) and is_archive_file(file):
+                dedup.before_move(file_path)
+                if not os.path.exists(file_path):
+                    continue
+                archive_path = os.path.join(self.archive_dir, file)
+                mover.link(file_path, archive_path)
+                dedup.after_move(archive_path)
+                archive_files_found = True
+                self.has_archive_file = True
+        
+        # Move files - handle different extraction scenarios
+        extracted_dir = os.path.join(self.temp_dir, "extracted")
+        if os.path.exists(extracted_dir) and os.listdir(extracted_dir):
+            # Files were extracted to extracted directory (normal extraction)
+            source_dir = extracted_dir
+            items = os.listdir(extracted_dir)
+        else:
+            # No extracted directory or empty - ffsend auto-extracts into temp_dir,
+            # other services leave their files there directly
+            source_dir = self.temp_dir
+            items = [item for item in os.listdir(self.temp_dir) if item not in ["extracted", "unwrapped"]]
+        for item in items:
+            source = os.path.join(source_dir, item)
+            dedup.before_move(source)
+            if not os.path.lexists(source):
+                continue
+            mover.move(source, os.path.join(final_path, item))
+            dedup.after_move(os.path.join(final_path, item))
+        return archive_files_found
+    
+    def _on_move_progress(self, copied: int, total: int):
+        if total:
+            self.progress = round(min(copied, total) * 100 / total, 1)
+            self.renderer.mark_dirty()
+    
+    def _write_archive_note(self):
+        archive_note_path = os.path.join(self.archive_dir, "no_archive_note.txt")
+        with open(archive_note_path, 'w') as f:
+            f.write(f"Downloaded via {self.service} - files were auto-extracted\n")
+            f.write(f"Original URL: {self.url}\n")
+            f.write(f"Downloaded on: {datetime.now().isoformat()}\n")
     
     async def _complete_download(self):
         """Complete the download process"""
         try:
             # Move files to final destination
             if self.destination:
-                final_path = f"/mnt/transformer/{self.destination}"
+                self._enter_phase("move")
+                final_path = f"{STORAGE_ROOT}/{self.destination}"
                 os.makedirs(final_path, exist_ok=True)
                 
-                # Move files - handle different extraction scenarios
-                extracted_dir = os.path.join(self.temp_dir, "extracted")
-                if os.path.exists(extracted_dir) and os.listdir(extracted_dir):
-                    # Files were extracted to extracted directory (normal extraction)
-                    for item in os.listdir(extracted_dir):
-                        src = os.path.join(extracted_dir, item)
-                        dst = os.path.join(final_path, item)
-                        if os.path.isdir(src):
-                            shutil.copytree(src, dst)
-                        else:
-                            shutil.copy2(src, dst)
-                else:
-                    # No extracted directory or empty - check if ffsend auto-extracted or files are direct
-                    # For ffsend, files are already extracted to temp_dir
-                    # For other services, move files directly
-                    for item in os.listdir(self.temp_dir):
-                        if item in ["extracted", "unwrapped"]:  # Skip empty directories
-                            continue
-                        src = os.path.join(self.temp_dir, item)
-                        dst = os.path.join(final_path, item)
-                        if os.path.isdir(src):
-                            # Directory (likely from ffsend auto-extraction)
-                            shutil.copytree(src, dst)
-                        elif os.path.isfile(src):
-                            # Single file
-                            shutil.copy2(src, dst)
-                
-                # Archive original files (if any exist)
-                os.makedirs(self.archive_dir, exist_ok=True)
-                archive_files_found = False
-                for file in os.listdir(self.temp_dir):
-                    file_path = os.path.join(self.temp_dir, file)
-                    if os.path.isfile(file_path) and file.endswith(('.zip', '.rar', '.7z', '.tar', '.gz')):
-                        shutil.copy2(file_path, self.archive_dir)
-                        archive_files_found = True
-                        self.has_archive_file = True
+                # Move files with renames/hardlinks where possible, off the event loop
+                loop = asyncio.get_running_loop()
+                def on_progress(copied, total):
+                    loop.call_soon_threadsafe(self._on_move_progress, copied, total)
+                mover = MoveEngine(on_progress=on_progress)
+                dedup = Deduplicator(await run_fs(get_content_index), known_digests=self.known_digests)
+                archive_files_found = await run_fs(self._move_to_destination, mover, dedup, final_path)
+                print(f"Moved to {final_path}: {mover.renamed} renamed, {mover.linked} linked, {mover.bytes_copied} bytes copied")
+                if dedup.files:
+                    print(f"Deduplicated {dedup.files} files ({dedup.mode}), saving {format_size(dedup.bytes_saved)}")
+                self.timer.add_bytes("move", mover.bytes_copied)
                 
                 # If no archive files found (e.g., ffsend auto-extracted), create a note about it
                 if not archive_files_found:
-                    archive_note_path = os.path.join(self.archive_dir, "no_archive_note.txt")
-                    with open(archive_note_path, 'w') as f:
-                        f.write(f"Downloaded via {self.service} - files were auto-extracted\n")
-                        f.write(f"Original URL: {self.url}\n")
-                        f.write(f"Downloaded on: {datetime.now().isoformat()}\n")
+                    await run_fs(self._write_archive_note)
                 
-                # Create log data
+                # Create log data (phase timings up to the move; logging itself is only in the metrics)
+                self._enter_phase("logging")
                 log_data = {
                     "id": self.download_id,
                     "timestamp": datetime.now().isoformat(),
                     "url": self.url,
+                    "remote_key": self.remote_key,
                     "service": self.service,
                     "file_name": self.file_name,
-                    "destination": f"/mnt/transformer/{self.destination}",
+                    "destination": f"{STORAGE_ROOT}/{self.destination}",
                     "final_path": final_path,
                     "size_bytes": int(self.archive_size),  # Convert to integer bytes
                     "file_count": self.file_count,
@@ -749,38 +4014,225 @@ class DownloadManager:
                     "status": "completed"
                 }
                 
+                if self.etag:
+                    log_data["etag"] = self.etag
+                
+                if self.expected_bytes:
+                    log_data["expected_size_bytes"] = self.expected_bytes
+                
                 # Only include archive_size_bytes if we actually saved an archive file
                 if self.has_archive_file:
                     log_data["archive_size_bytes"] = int(self.archive_size)
                 
+                if self.tree_stats:
+                    log_data["content_size_bytes"] = self.tree_stats.total_bytes
+                    log_data["file_types"] = self.tree_stats.to_dict()
+                
+                if dedup.files:
+                    log_data["dedup"] = dedup.summary()
+                
+                log_data["phases"] = self.timer.to_dict()
+                if self.speed_estimator.average:
+                    log_data["average_bytes_per_second"] = round(self.speed_estimator.average)
+                    log_data["peak_bytes_per_second"] = round(self.speed_estimator.peak)
+                
                 # Save logs to all locations
-                self.history.add_download(log_data)
-                self.history.save_individual_log(self.download_id, log_data)
-                self.history.save_archive_log(self.download_id, log_data)
+                await run_fs(self.history.add_download, log_data)
+                await run_fs(self.history.write_log, self.download_id, log_data)
                 
                 # Clean up temp directory
-                shutil.rmtree(self.temp_dir, ignore_errors=True)
+                await run_fs(shutil.rmtree, self.temp_dir, ignore_errors=True)
             
+            self._record_outcome("completed")
             self.status = "✅ Download complete."
-            await self._update_embed()
+            await self._render_final()
             
             # Update the view to hide cancel button and destination dropdown
             await self.update_view_after_completion()
             
         except Exception as e:
+            self._record_outcome("failed")
             self.status = f"❌ Error completing download: {str(e)}"
-            await self._update_embed()
+            await self._render_final()
     
     def cancel(self):
         """Cancel the download"""
         self.is_cancelled = True
+        self._record_outcome("cancelled")
+        if self.preflight_task:
+            self.preflight_task.cancel()
+        if not self.batch:
+            self.renderer.close()
         if self.download_task:
             self.download_task.cancel()
 
 
-class DestinationDropdown(discord.ui.Select):
-    def __init__(self, download_manager: DownloadManager):
-        self.download_manager = download_manager
+scheduler = DownloadScheduler()
+
+
+class BatchDownload:
+    """
+    Downloads started together from one command: they share a destination, a note and a
+    single status message whose embed has a row per item, so Discord edits don't grow with the batch.
+    Each item is still a DownloadManager, queued through the scheduler like any other download.
+    """
+    def __init__(self, message: discord.Message, batch_id: str = None, destination: str = None, note: str = None):
+        self.message = message
+        self.batch_id = batch_id or generate_download_id()
+        self.destination = destination
+        self.note = note
+        self.managers = []
+        self.skipped = []  # (url, reason) of links that weren't started
+        self.renderer = EmbedRenderer(message, self._build_embed)
+        self._finished = False
+        self._cancelled = False
+        batches[self.batch_id] = self
+        last_downloads[message.author.id] = self.batch_id
+    
+    def add(self, url: str) -> DownloadManager:
+        download_manager = DownloadManager(self.message, url, batch=self)
+        download_manager.destination = self.destination
+        download_manager.note = self.note
+        self.adopt(download_manager)
+        return download_manager
+    
+    def adopt(self, download_manager: DownloadManager):
+        self.managers.append(download_manager)
+        scheduler.register(download_manager)
+    
+    def start(self):
+        self.renderer.mark_dirty(urgent=True)
+        for download_manager in self.managers:
+            asyncio.create_task(download_manager.start_download())
+    
+    @property
+    def status(self) -> str:
+        counts = {}
+        for download_manager in self.managers:
+            state = self._item_state(download_manager)
+            counts[state] = counts.get(state, 0) + 1
+        if self.managers and counts.get("done", 0) + counts.get("failed", 0) == len(self.managers):
+            return "✅ Download complete."
+        labels = (("active", "⏳ {} downloading"), ("queued", "🕒 {} queued"),
+                  ("waiting", "⏸️ {} waiting for destination"), ("done", "✅ {} done"), ("failed", "❌ {} failed"))
+        return " · ".join(label.format(counts[state]) for state, label in labels if counts.get(state))
+    
+    @staticmethod
+    def _item_state(download_manager: DownloadManager) -> str:
+        if download_manager.status == "✅ Download complete.":
+            return "done"
+        if download_manager._outcome_recorded or download_manager.error_message:
+            return "failed"
+        if download_manager.status.startswith("🕒") or download_manager.status.startswith("💾"):
+            return "queued"
+        if download_manager.status == "⏸️ Waiting for destination...":
+            return "waiting"
+        return "active"
+    
+    def _row(self, download_manager: DownloadManager) -> str:
+        icon = SERVICE_EMOJI.get(download_manager.service, "📁")
+        name = download_manager.file_name[:48]
+        status_icon = download_manager.status.split(" ", 1)[0]
+        if self._item_state(download_manager) == "failed":
+            reason = download_manager.error_message or download_manager.status
+            return f"{icon} ❌ {name} — {reason.lstrip('❌ ')[:60]}"
+        row = f"{icon} {status_icon} **{download_manager.progress:.0f}%** {name}"
+        if download_manager.total_size > 0:
+            row += f" · {download_manager.downloaded_size:.1f}/{download_manager.total_size:.1f} MB"
+        return row
+    
+    def _build_embed(self) -> discord.Embed:
+        """One row per item plus totals and overall throughput"""
+        downloaded = sum(download_manager.downloaded_size for download_manager in self.managers)
+        total = sum(download_manager.total_size for download_manager in self.managers)
+        speed = sum(download_manager.speed for download_manager in self.managers
+                    if self._item_state(download_manager) == "active")
+        speed_info = f"{speed:.2f} MB/s"
+        if speed > 0 and total > downloaded:
+            speed_info += f" · {format_duration((total - downloaded) / speed)} left"
+        
+        header = [
+            self.status,
+            "",
+            f"{downloaded:.1f} MB of {total:.1f} MB" if total else f"{downloaded:.1f} MB of ?",
+            speed_info,
+            "",
+        ]
+        footer = ["", f"📁 {self.destination}" if self.destination else "📁 Select a destination"]
+        if self.note:
+            footer.append(f"📒 {self.note}")
+        
+        rows = [self._row(download_manager) for download_manager in self.managers]
+        rows += [f"⏭️ {url[:60]} — {reason}" for url, reason in self.skipped]
+        # Stay inside Discord's description limit however many items there are
+        budget = 4000 - len("\n".join(header + footer))
+        shown = []
+        for index, row in enumerate(rows):
+            if len(row) + 1 > budget - 40:
+                shown.append(f"-# … and {len(rows) - index} more")
+                break
+            shown.append(row)
+            budget -= len(row) + 1
+        
+        embed = discord.Embed(
+            title=f"📦 {len(self.managers)} downloads",
+            description="\n".join(header + shown + footer),
+            color=discord.Color.blue()
+        )
+        embed.set_author(name="Bulk download", icon_url=get_service_icon("Direct Download"))
+        return embed
+    
+    def set_destination(self, destination: str):
+        self.destination = destination
+        for download_manager in self.managers:
+            if not download_manager._outcome_recorded:
+                download_manager.set_destination(destination)
+        self.renderer.mark_dirty(urgent=True)
+    
+    def set_note(self, note: str):
+        self.note = note
+        for download_manager in self.managers:
+            download_manager.set_note(note)
+        self.renderer.mark_dirty(urgent=True)
+    
+    def cancel(self):
+        # The cancel button clears the message's controls; _finish must not put the note button back
+        self._cancelled = True
+        for download_manager in self.managers:
+            if not download_manager._outcome_recorded:
+                download_manager.cancel()
+        self.renderer.close()
+        batches.pop(self.batch_id, None)
+    
+    def item_finished(self):
+        """Called as each item completes, fails or is cancelled"""
+        if self._finished or self._cancelled:
+            return
+        if not all(download_manager._outcome_recorded for download_manager in self.managers):
+            return
+        self._finished = True
+        asyncio.create_task(self._finish())
+    
+    async def _finish(self):
+        """Render the final state, leave only the note button and stop tracking the batch"""
+        self.renderer.mark_dirty(urgent=True)
+        await self.renderer.flush()
+        self.renderer.close()
+        batches.pop(self.batch_id, None)
+        finished_batches[self.batch_id] = [download_manager.download_id for download_manager in self.managers]
+        try:
+            await self.message.edit(view=CompletedDownloadView(self.batch_id, has_note=bool(self.note)))
+        except Exception as e:
+            print(f"Error updating view after batch completion: {e}")
+
+def get_download_target(target_id: str):
+    """The active download or batch with this id, or None"""
+    return downloads.get(target_id) or batches.get(target_id)
+
+
+class DestinationDropdown(discord.ui.DynamicItem[discord.ui.Select], template=r"zurg:dest:(?P<download_id>\w+)"):
+    def __init__(self, download_id: str):
+        self.download_id = download_id
         options = [
             discord.SelectOption(label="music/"),
             discord.SelectOption(label="media/"),
@@ -788,82 +4240,142 @@ class DestinationDropdown(discord.ui.Select):
             discord.SelectOption(label="downloads/"),
             discord.SelectOption(label="test/"),
         ]
-        super().__init__(
+        super().__init__(discord.ui.Select(
+            custom_id=f"zurg:dest:{download_id}",
             placeholder="Choose a destination...",
             min_values=1,
             max_values=1,
             options=options,
             row=0
-        )
+        ))
+    
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Select, match):
+        return cls(match["download_id"])
 
     async def callback(self, interaction: discord.Interaction):
-        destination = self.values[0]
-        self.download_manager.set_destination(destination)
+        download_manager = get_download_target(self.download_id)
+        if not download_manager:
+            await interaction.response.send_message("❌ This download is no longer active.", ephemeral=True)
+            return
+        download_manager.set_destination(self.item.values[0])
         await interaction.response.defer()
 
-class DownloadView(discord.ui.View):
-    def __init__(self, download_manager: DownloadManager):
-        super().__init__()
-        self.download_manager = download_manager
-        self.add_item(DestinationDropdown(download_manager))
-
-    @discord.ui.button(label="Add Note", style=discord.ButtonStyle.primary, row=1)
-    async def add_note_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await interaction.response.send_modal(NoteModal(self.download_manager))
+class NoteButton(discord.ui.DynamicItem[discord.ui.Button], template=r"zurg:note:(?P<download_id>\w+)"):
+    def __init__(self, download_id: str, has_note: bool = False, row: int = 0):
+        self.download_id = download_id
+        super().__init__(discord.ui.Button(
+            custom_id=f"zurg:note:{download_id}",
+            label="Edit Note" if has_note else "Add Note",
+            style=discord.ButtonStyle.primary,
+            row=row
+        ))
+    
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(match["download_id"], has_note=item.label == "Edit Note", row=item.row)
+    
+    async def callback(self, interaction: discord.Interaction):
+        await interaction.response.send_modal(NoteModal(self.download_id))
 
-    @discord.ui.button(label="Cancel", style=discord.ButtonStyle.danger, row=1)
-    async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.download_manager.cancel()
+class CancelButton(discord.ui.DynamicItem[discord.ui.Button], template=r"zurg:cancel:(?P<download_id>\w+)"):
+    def __init__(self, download_id: str):
+        self.download_id = download_id
+        super().__init__(discord.ui.Button(
+            custom_id=f"zurg:cancel:{download_id}",
+            label="Cancel",
+            style=discord.ButtonStyle.danger,
+            row=1
+        ))
+    
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(match["download_id"])
+    
+    async def callback(self, interaction: discord.Interaction):
+        download_manager = get_download_target(self.download_id)
+        if not download_manager:
+            await interaction.response.send_message("❌ This download is no longer active.", ephemeral=True)
+            return
+        download_manager.cancel()
         await interaction.response.edit_message(content="❌ Download cancelled.", view=None)
 
+# The controls are routed by custom_id (which carries the download id), so they keep
+# working on messages sent before a restart
+PERSISTENT_ITEMS = (DestinationDropdown, NoteButton, CancelButton)
+
+class DownloadView(discord.ui.View):
+    def __init__(self, download_id: str):
+        super().__init__(timeout=None)
+        self.add_item(DestinationDropdown(download_id))
+        self.add_item(NoteButton(download_id, row=1))
+        self.add_item(CancelButton(download_id))
+
 
 class CompletedDownloadView(discord.ui.View):
-    def __init__(self, download_manager: DownloadManager):
-        super().__init__()
-        self.download_manager = download_manager
+    def __init__(self, download_id: str, has_note: bool = False):
+        super().__init__(timeout=None)
         # Add the note button with correct initial text
-        self.add_item(NoteButton(download_manager))
-
-class NoteButton(discord.ui.Button):
-    def __init__(self, download_manager: DownloadManager):
-        self.download_manager = download_manager
-        super().__init__(
-            label="Edit Note" if download_manager.note else "Add Note",
-            style=discord.ButtonStyle.primary,
-            row=0
-        )
-    
-    async def callback(self, interaction: discord.Interaction):
-        await interaction.response.send_modal(NoteModal(self.download_manager))
+        self.add_item(NoteButton(download_id, has_note=has_note))
 
 
 class NoteModal(discord.ui.Modal, title="Add a Note"):
-    def __init__(self, download_manager: DownloadManager):
+    def __init__(self, download_id: str):
         super().__init__()
-        self.download_manager = download_manager
+        self.download_id = download_id
         self.note = discord.ui.TextInput(label="Note", style=discord.TextStyle.paragraph)
         self.add_item(self.note)
     
     async def on_submit(self, interaction: discord.Interaction):
-        self.download_manager.set_note(self.note.value)
-        
-        # Update the button text if we're in a CompletedDownloadView
-        if hasattr(interaction.message, 'view') and isinstance(interaction.message.view, CompletedDownloadView):
-            # Update the existing button text
-            for item in interaction.message.view.children:
-                if isinstance(item, NoteButton):
-                    item.label = "Edit Note" if self.download_manager.note else "Add Note"
-                    break
-            await interaction.message.edit(view=interaction.message.view)
+        download_manager = get_download_target(self.download_id)
+        if download_manager:
+            download_manager.set_note(self.note.value)
+            completed = download_manager.status == "✅ Download complete."
+        else:
+            # Finished (a batch) or finished before a restart: only the logs are left to update
+            for download_id in finished_batches.get(self.download_id, [self.download_id]):
+                await run_fs(write_note_to_logs, download_id, self.note.value)
+            completed = True
         
-        await interaction.response.defer()
+        if completed:
+            # Relabel the button now that there is a note
+            await interaction.response.edit_message(view=CompletedDownloadView(self.download_id, has_note=True))
+        else:
+            await interaction.response.defer()
 
 
-@bot.tree.command(name="download", description="Start download from URL")
-@app_commands.describe(url="The URL to download from")
-async def download(interaction: discord.Interaction, url: str):
-    # Format the URL to ensure it's valid for Discord embeds
-    formatted_url = format_url(url)
+async def _remote_etag(url: str) -> Optional[str]:
+    """Fetch the current ETag of a direct URL (None if it has none or can't be reached)"""
+    try:
+        # Kept short: the interaction has to be answered within a few seconds
+        timeout = aiohttp.ClientTimeout(total=2)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.head(url, allow_redirects=True) as resp:
+                return resp.headers.get("ETag") if resp.status < 400 else None
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+
+async def _find_previous_download(url: str):
+    """Return the history record if this exact remote file was already downloaded"""
+    previous = await run_fs(lambda: get_history().find_previous(url))
+    if previous and previous.get("etag") and remote_key(url).startswith("url:"):
+        # Same URL, but only the same file if the server still reports the same ETag
+        if await _remote_etag(url) != previous["etag"]:
+            return None
+    return previous
+
+class DuplicateDownloadView(discord.ui.View):
+    def __init__(self, url: str):
+        super().__init__(timeout=300)
+        self.url = url
+    
+    @discord.ui.button(label="Download anyway", style=discord.ButtonStyle.secondary)
+    async def force_download(self, interaction: discord.Interaction, button: discord.ui.Button):
+        button.disabled = True
+        self.stop()
+        await _start_download(interaction, self.url)
+
+async def _start_download(interaction: discord.Interaction, formatted_url: str):
     # Create initial embed
     description = (
         "🔎 Starting download...\n\n"
@@ -887,7 +4399,8 @@ async def download(interaction: discord.Interaction, url: str):
 
     # Create download manager and start the download
     download_manager = DownloadManager(message, formatted_url)
-    view = DownloadView(download_manager)
+    scheduler.register(download_manager)
+    view = DownloadView(download_manager.download_id)
     
     # Update the message with the view
     await message.edit(embed=embed, view=view)
@@ -895,6 +4408,94 @@ async def download(interaction: discord.Interaction, url: str):
     # Start the download process
     asyncio.create_task(download_manager.start_download())
 
+@bot.tree.command(name="download", description="Start download from URL")
+@app_commands.describe(url="The URL to download from", force="Download even if this link was downloaded before")
+async def download(interaction: discord.Interaction, url: str, force: bool = False):
+    # Format the URL to ensure it's valid for Discord embeds
+    formatted_url = format_url(url)
+    
+    if not force:
+        previous = await _find_previous_download(formatted_url)
+        if previous:
+            service_icon = SERVICE_EMOJI.get(previous.get("service", ""), "📁")
+            destination = _normalize_destination(previous.get("destination"))
+            embed = discord.Embed(
+                title=f"{service_icon} Already downloaded",
+                description=(
+                    f"**{previous.get('file_name') or 'Unknown'}** was already downloaded to "
+                    f"`{destination or 'Unknown'}/` on {format_timestamp(previous.get('timestamp', ''))} "
+                    f"({format_size(previous.get('size_bytes', 0))})."
+                ),
+                color=discord.Color.orange()
+            )
+            embed.set_footer(text=f"ID: {previous.get('id', 'Unknown')}")
+            await interaction.response.send_message(embed=embed, view=DuplicateDownloadView(formatted_url), ephemeral=True)
+            return
+    
+    await _start_download(interaction, formatted_url)
+
+DESTINATION_CHOICES = [
+    app_commands.Choice(name=folder, value=folder)
+    for folder in ("music/", "media/", "shared/", "downloads/", "test/")
+]
+
+@bot.tree.command(name="bulk", description="Download many URLs with one progress message")
+@app_commands.describe(
+    urls="Links separated by spaces or new lines",
+    file="A text file with one link per line",
+    destination="Where to put every download (can also be chosen later)",
+    note="Note added to every download",
+    force="Download links even if they were downloaded before"
+)
+@app_commands.choices(destination=DESTINATION_CHOICES)
+async def bulk_download(
+    interaction: discord.Interaction,
+    urls: Optional[str] = None,
+    file: Optional[discord.Attachment] = None,
+    destination: Optional[app_commands.Choice[str]] = None,
+    note: Optional[str] = None,
+    force: bool = False
+):
+    text = urls or ""
+    if file:
+        if file.size > 1024 * 1024:
+            await interaction.response.send_message("❌ The links file must be under 1 MB.", ephemeral=True)
+            return
+        text += "\n" + (await file.read()).decode("utf-8", errors="replace")
+    found = extract_urls(text)
+    if not found:
+        await interaction.response.send_message("❌ No links found. Paste URLs or attach a text file.", ephemeral=True)
+        return
+    if len(found) > BULK_MAX_URLS:
+        await interaction.response.send_message(
+            f"❌ Found {len(found)} links; at most {BULK_MAX_URLS} can be downloaded at once.", ephemeral=True
+        )
+        return
+    
+    # Checking history (and ETags) may take longer than Discord's 3s limit
+    await interaction.response.defer(thinking=True)
+    previous = [None] * len(found)
+    if not force:
+        previous = await asyncio.gather(*(_find_previous_download(url) for url in found))
+    
+    message = await interaction.original_response()
+    batch = BatchDownload(message, destination=destination.value if destination else None, note=note)
+    for url, record in zip(found, previous):
+        if record:
+            batch.skipped.append((url, f"already downloaded ({record.get('id', 'Unknown')})"))
+        else:
+            batch.add(url)
+    
+    if not batch.managers:
+        batch.renderer.close()
+        batches.pop(batch.batch_id, None)
+        await interaction.followup.send(
+            f"⏭️ All {len(found)} links were already downloaded. Use `force` to download them again."
+        )
+        return
+    await message.edit(embed=batch._build_embed(), view=DownloadView(batch.batch_id))
+    batch.start()
+
 @bot.tree.command(name="test", description="Test command to verify bot is working")
 @app_commands.guilds(GUILD_ID)
 async def test_command(interaction: discord.Interaction):
@@ -904,53 +4505,16 @@ async def test_command(interaction: discord.Interaction):
 @bot.tree.command(name="lastlog", description="Show the last download log")
 async def last_log(interaction: discord.Interaction):
     try:
-        # Read the downloads log file
-        downloads_file = "/mnt/transformer/logs/downloads.json"
-        if not os.path.exists(downloads_file):
-            await interaction.response.send_message("❌ No download logs found.", ephemeral=True)
-            return
-        
-        with open(downloads_file, 'r') as f:
-            data = json.load(f)
-        
-        downloads = data.get("downloads", [])
-        if not downloads:
+        # Get the last download from the tail of the history log
+        last_download = await run_fs(lambda: get_history().last_download())
+        if not last_download:
             await interaction.response.send_message("❌ No downloads found in logs.", ephemeral=True)
             return
         
-        # Get the last download
-        last_download = downloads[-1]
-        
         # Format the log data
-        service_emoji = {
-            "MEGA": "🔴",
-            "ffsend": "✉️", 
-            "Direct Download": "🔗"
-        }
-        
-        service_icon = service_emoji.get(last_download.get("service", ""), "📁")
-        
-        # Format timestamp
-        timestamp = last_download.get("timestamp", "")
-        if timestamp:
-            try:
-                dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                formatted_time = dt.strftime("%Y-%m-%d %H:%M:%S")
-            except:
-                formatted_time = timestamp
-        else:
-            formatted_time = "Unknown"
-        
-        # Format file size
-        size_bytes = last_download.get("size_bytes", 0)
-        if size_bytes >= 1024 * 1024 * 1024:  # GB
-            size_str = f"{size_bytes / (1024 * 1024 * 1024):.1f} GB"
-        elif size_bytes >= 1024 * 1024:  # MB
-            size_str = f"{size_bytes / (1024 * 1024):.1f} MB"
-        elif size_bytes >= 1024:  # KB
-            size_str = f"{size_bytes / 1024:.1f} KB"
-        else:
-            size_str = f"{size_bytes} bytes"
+        service_icon = SERVICE_EMOJI.get(last_download.get("service", ""), "📁")
+        formatted_time = format_timestamp(last_download.get("timestamp", ""))
+        size_str = format_size(last_download.get("size_bytes", 0))
         
         # Format duration
         duration = last_download.get("download_duration", 0)
@@ -995,6 +4559,149 @@ async def last_log(interaction: discord.Interaction):
             ephemeral=True
         )
 
+HISTORY_PAGE_SIZE = 10
+
+def _history_page(filters: dict, page: int):
+    """Run a history search and build the embed for one page. Returns (embed, page, total_pages)."""
+    records, total = get_history().search(**filters, limit=HISTORY_PAGE_SIZE, offset=(page - 1) * HISTORY_PAGE_SIZE)
+    total_pages = max(1, -(-total // HISTORY_PAGE_SIZE))
+    if page > total_pages:
+        page = total_pages
+        records, total = get_history().search(**filters, limit=HISTORY_PAGE_SIZE, offset=(page - 1) * HISTORY_PAGE_SIZE)
+    
+    lines = []
+    for index, record in enumerate(records, start=(page - 1) * HISTORY_PAGE_SIZE + 1):
+        icon = SERVICE_EMOJI.get(record.get("service", ""), "📁")
+        destination = _normalize_destination(record.get("destination")) or "?"
+        line = (
+            f"**{index}.** {icon} {record.get('file_name', 'Unknown File')} · "
+            f"{format_size(record.get('size_bytes', 0))} · `{destination}/` · "
+            f"{format_timestamp(record.get('timestamp', ''), '%Y-%m-%d')}"
+        )
+        note = record.get("note")
+        if note:
+            line += f"\n-# 📝 {note[:80]}{'…' if len(note) > 80 else ''}"
+        lines.append(line)
+    
+    filter_parts = []
+    if filters.get("query"):
+        filter_parts.append(f"\"{filters['query']}\"")
+    if filters.get("service"):
+        filter_parts.append(filters["service"])
+    if filters.get("destination"):
+        filter_parts.append(f"{_normalize_destination(filters['destination'])}/")
+    if filters.get("since"):
+        filter_parts.append(f"since {format_timestamp(filters['since'], '%Y-%m-%d')}")
+    
+    embed = discord.Embed(
+        title="📜 Download history" + (f" — {', '.join(filter_parts)}" if filter_parts else ""),
+        description="\n".join(lines) if lines else "No matching downloads.",
+        color=discord.Color.blue()
+    )
+    embed.set_footer(text=f"Page {page}/{total_pages} · {total} result{'s' if total != 1 else ''}")
+    return embed, page, total_pages
+
+class HistoryPageView(discord.ui.View):
+    def __init__(self, filters: dict, page: int, total_pages: int):
+        super().__init__(timeout=300)
+        self.filters = filters
+        self.page = page
+        self.total_pages = total_pages
+        self._update_buttons()
+    
+    def _update_buttons(self):
+        self.previous_page.disabled = self.page <= 1
+        self.next_page.disabled = self.page >= self.total_pages
+    
+    async def _show(self, interaction: discord.Interaction):
+        embed, self.page, self.total_pages = await run_fs(_history_page, self.filters, self.page)
+        self._update_buttons()
+        await interaction.response.edit_message(embed=embed, view=self)
+    
+    @discord.ui.button(label="◀ Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page -= 1
+        await self._show(interaction)
+    
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await self._show(interaction)
+
+@bot.tree.command(name="history", description="Search past downloads")
+@app_commands.describe(
+    query="Words to find in the file name, note or URL",
+    service="Only downloads from this service",
+    destination="Only downloads into this folder (e.g. music/)",
+    days="Only downloads from the last N days",
+    page="Page of results to show"
+)
+@app_commands.choices(service=[
+    app_commands.Choice(name="MEGA", value="MEGA"),
+    app_commands.Choice(name="ffsend", value="ffsend"),
+    app_commands.Choice(name="Direct Download", value="Direct Download"),
+])
+async def history_command(
+    interaction: discord.Interaction,
+    query: Optional[str] = None,
+    service: Optional[app_commands.Choice[str]] = None,
+    destination: Optional[str] = None,
+    days: Optional[app_commands.Range[int, 1, 3650]] = None,
+    page: app_commands.Range[int, 1] = 1
+):
+    try:
+        filters = {
+            "query": query,
+            "service": service.value if service else None,
+            "destination": destination,
+            "since": (datetime.now() - timedelta(days=days)).isoformat() if days else None,
+        }
+        embed, page, total_pages = await run_fs(_history_page, filters, page)
+        view = HistoryPageView(filters, page, total_pages) if total_pages > 1 else discord.utils.MISSING
+        await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+    except Exception as e:
+        await interaction.response.send_message(
+            f"❌ Error searching history: {str(e)}",
+            ephemeral=True
+        )
+
+@bot.tree.command(name="stats", description="Show download statistics since the bot started")
+async def stats_command(interaction: discord.Interaction):
+    lines = []
+    services = sorted({service for service, _ in metrics.downloads})
+    for service in services:
+        counts = {status: count for (name, status), count in metrics.downloads.items() if name == service}
+        outcome = " · ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+        transferred = metrics.phase_bytes.get((service, "transfer"), 0)
+        observed = metrics.throughput.count((service,))
+        line = f"{SERVICE_EMOJI.get(service, '📁')} **{service}:** {outcome} · {format_size(transferred)}"
+        if observed:
+            line += f" · avg {metrics.throughput.total((service,)) / observed / (1024 * 1024):.2f} MB/s"
+        lines.append(line)
+    if not lines:
+        lines.append("No downloads have finished since the bot started.")
+    
+    # Average time per phase across every finished download
+    phase_parts = []
+    for phase in DOWNLOAD_PHASES:
+        count = sum(metrics.phase_seconds.count((service, phase)) for service in services)
+        if count:
+            total = sum(metrics.phase_seconds.total((service, phase)) for service in services)
+            phase_parts.append(f"{phase.replace('_', ' ')} {total / count:.1f}s")
+    if phase_parts:
+        lines.append("")
+        lines.append("⏱️ **Average phase times:** " + " · ".join(phase_parts))
+    
+    lines.append("")
+    lines.append(f"📥 **Now:** {len(scheduler.active)} downloading · {len(scheduler.queue)} queued")
+    lines.append(f"💾 **Disk:** {format_size(space.reserved())} reserved")
+    lines.append(f"✏️ **Embed edits:** {metrics.embed_edits}")
+    lines.append(f"🔁 **Event loop:** max lag {loop_monitor.max_lag * 1000:.0f} ms · {loop_monitor.stalls} stalls")
+    
+    embed = discord.Embed(title="📊 Download Stats", description="\n".join(lines), color=discord.Color.blue())
+    embed.set_footer(text=f"Since {format_timestamp(datetime.fromtimestamp(metrics.started).isoformat())}")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 @bot.tree.command(name="note", description="Add or edit a note for your last download")
 @app_commands.describe(content="The note content to add or edit")
 async def note_command(interaction: discord.Interaction, content: str):
@@ -1011,22 +4718,25 @@ async def note_command(interaction: discord.Interaction, content: str):
         
         download_id = last_downloads[user_id]
         
-        # Check if the download still exists
-        if download_id not in downloads:
+        # A finished batch's items only have their logs left
+        if download_id in finished_batches:
+            for item_id in finished_batches[download_id]:
+                await run_fs(write_note_to_logs, item_id, content)
+            await interaction.response.send_message("✅ Note added to the batch's logs!", ephemeral=True)
+            return
+        
+        # Check if the download (or batch) still exists
+        download_manager = get_download_target(download_id)
+        if not download_manager:
             await interaction.response.send_message(
                 "❌ Your last download is no longer active. Start a new download first!",
                 ephemeral=True
             )
             return
         
-        download_manager = downloads[download_id]
-        
-        # Set the note
+        # Set the note (this also refreshes the embed)
         download_manager.set_note(content)
         
-        # Update the embed to show the new note
-        await download_manager._update_embed()
-        
         await interaction.response.send_message(
             f"✅ Note {'updated' if download_manager.note else 'added'} successfully!",
             ephemeral=True
@@ -1057,6 +4767,53 @@ async def refresh_commands(interaction: discord.Interaction):
             ephemeral=True
         )
 
+async def _journaled_message(state: Dict[str, Any]) -> discord.Message:
+    """The download's original status message, or a new one in the download channel if it's gone"""
+    try:
+        channel = bot.get_channel(state["channel_id"]) or await bot.fetch_channel(state["channel_id"])
+        return await channel.fetch_message(state["message_id"])
+    except (KeyError, discord.HTTPException) as e:
+        print(f"Status message of {state['id']} unavailable ({e}), posting a new one")
+    channel = bot.get_channel(DOWNLOAD_CHANNEL_ID) or await bot.fetch_channel(DOWNLOAD_CHANNEL_ID)
+    embed = discord.Embed(
+        title=state.get("file_name") or "Unknown File",
+        url=state["url"],
+        description="🔄 Resuming after restart...",
+        color=discord.Color.blue()
+    )
+    return await channel.send(embed=embed, view=DownloadView(state.get("batch_id") or state["id"]))
+
+async def recover_downloads():
+    """Pick up downloads that were in flight when the bot last stopped"""
+    managers = []
+    restored_batches = {}
+    for state in await run_fs(journal.load_all):
+        batch_id = state.get("batch_id")
+        try:
+            batch = restored_batches.get(batch_id)
+            if batch_id and not batch:
+                # Items of a bulk download share the batch's message; finished items aren't journaled
+                message = await _journaled_message(state)
+                batch = restored_batches[batch_id] = BatchDownload(
+                    message, batch_id=batch_id, destination=state.get("destination"), note=state.get("note")
+                )
+            message = batch.message if batch else await _journaled_message(state)
+            download_manager = DownloadManager.restore(message, state, batch=batch)
+        except Exception as e:
+            print(f"❌ Error recovering download {state.get('id')}: {e}")
+            continue
+        if batch:
+            batch.adopt(download_manager)
+        else:
+            scheduler.register(download_manager)
+        managers.append((download_manager, state.get("phase")))
+    # Register every download before resuming any, so none adopts another's partial transfer
+    for download_manager, phase in managers:
+        print(f"Resuming {download_manager.download_id} from {phase or 'start'}")
+        asyncio.create_task(download_manager.resume(phase))
+
+_recovered = False
+
 @bot.event
 async def on_connect():
     print("Connected to Discord")
@@ -1064,6 +4821,35 @@ async def on_connect():
 @bot.event
 async def on_ready():
     print("Logged in as {bot.user}")
+    global _recovered
+    loop_monitor.start()
+    try:
+        await start_metrics_server()
+    except Exception as e:
+        print(f"❌ Error starting metrics server: {e}")
+    try:
+        # Compact the history store (torn lines, superseded copies, WAL)
+        await run_fs(lambda: get_history().compact())
+    except Exception as e:
+        print(f"❌ Error compacting history: {e}")
+    if DEDUP_MODE in ("link", "skip"):
+        try:
+            # Index what is already in the library once so new downloads can be deduplicated against it
+            await run_fs(
+                get_content_index().scan_once,
+                [STORAGE_ROOT], DEDUP_MIN_SIZE,
+                exclude={f"{STORAGE_ROOT}/tmp", f"{STORAGE_ROOT}/logs"}
+            )
+        except Exception as e:
+            print(f"❌ Error indexing library: {e}")
+    if not _recovered:
+        # on_ready fires again after reconnects; only recover once per process
+        _recovered = True
+        bot.add_dynamic_items(*PERSISTENT_ITEMS)
+        try:
+            await recover_downloads()
+        except Exception as e:
+            print(f"❌ Error recovering downloads: {e}")
     try:
     # Sync commands globally (to all servers the bot is in)
         synced = await bot.tree.sync()